@@ -1,37 +1,48 @@
 import cv2
 import numpy as np
-from ultralytics import YOLO
-from collections import defaultdict
 from utils import calculateHomography, transformPoints
 #from database import Database
 from floorReplica import FloorPlanAnnotator
 from coordinateSelector import CoordinateSelector
+from mjpegStream import MJPEGStream
+from trackStore import TrackStore
+from detectionScheduler import DetectionScheduler
+from regionOfInterest import RegionOfInterest
+from detectorBackend import loadDetector
+from frameSlot import FrameSlot
 import time as time_module
 import os
 import threading
-import queue
 from datetime import datetime
 import platform
 
 class CameraProcessor:
-    def __init__(self, source=0, is_video=False, queue_size=20, process_every_n_frames=1):
+    def __init__(self, source=0, is_video=False, process_every_n_frames=1,
+                 adaptive_detection=True, detection_size=None, detector_backend="torch"):
         """
         Initialize the camera processor with multi-threading support
         
         Args:
             source (str/int): Camera index, video file path, or RTSP stream
             is_video (bool): Flag to indicate if source is a video file
-            queue_size (int): Maximum size of frame and results queues
-            process_every_n_frames (int): Process every Nth frame (skip frames in between)
+            process_every_n_frames (int): Run the detector on at least every Nth frame, the
+                boxes on the frames in between are propagated with optical flow
+            adaptive_detection (bool): Adapt the detection interval (1 to N frames) to the
+                scene motion and processing load instead of always detecting every Nth frame
+            detection_size (int): Inference size of the detection region, None keeps the
+                pixel density of a 1280 inference on the whole frame
+            detector_backend (str): Run YOLO with PyTorch ("torch") or exported to ONNX Runtime
+                or OpenVINO ("onnx", "onnx-int8", "openvino", "openvino-int8")
         """
         # Initialize YOLO model for object detection (use smaller model or lower image size for performance)
-        self.model = YOLO("yolov8n.pt")  # Consider 'yolov8n' or even 'yolov8s' for better performance
+        # The export for a non-torch backend is created on first use and reused afterwards
+        self.model = loadDetector("yolov8n.pt", detector_backend)  # Consider 'yolov8n' or even 'yolov8s' for better performance
         
         # Set up video source
         self.source = source
         self.is_video = is_video
         
-        # Process control - only process every Nth frame
+        # Process control - the detector runs on at least every Nth frame
         self.process_every_n_frames = process_every_n_frames
         self.frame_counter = 0
         
@@ -41,6 +52,19 @@ class CameraProcessor:
         
         self.cap = cv2.VideoCapture(source)
         
+        # Detection runs on keyframes only, the frames in between reuse the last
+        # detections moved with optical flow
+        source_fps = self.cap.get(cv2.CAP_PROP_FPS)
+        if not source_fps or source_fps <= 0 or source_fps > 240:
+            source_fps = 30.0
+        self.source_fps = source_fps
+        self.scheduler = DetectionScheduler(
+            min_interval=1,
+            max_interval=process_every_n_frames,
+            frame_period=1.0 / source_fps,
+            adaptive=adaptive_detection
+        )
+        
         # Set lower resolution for capture if possible
         if self.is_video:  # Only for video files, not live cameras which might have fixed resolution
             width = self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)
@@ -57,7 +81,8 @@ class CameraProcessor:
         floor_plan_path = os.path.join(current_dir, "/Users/apple/Desktop/Deakin/T2_2024/SIT764_Capstone/Crowd_Monitor/Stork Fountain.jpg")
         
         # Initialize tracking and annotation components
-        self.track_history = defaultdict(list)
+        # Fixed size ring buffer per track, stale tracks are evicted after 10 seconds
+        self.track_history = TrackStore(capacity=30, maxTracks=1000, ttl=10.0)
         self.floor_annotator = FloorPlanAnnotator(
             background_image=floor_plan_path,
             show_grid=True
@@ -67,27 +92,37 @@ class CameraProcessor:
         self.coordinator = CoordinateSelector(source, is_video)
         self.homography_matrix = self._calculate_homography()
         
+        # The detector only runs on the area around the points selected for the homography
+        self.region_of_interest = RegionOfInterest(self.homography_source, imgsz=detection_size)
+        
         # Database for tracking
         # self.db = Database()
         self.current_frame_id = 0
         
-        # Threading and queue setup
-        self.frame_queue = queue.Queue(maxsize=queue_size)
-        self.results_queue = queue.Queue(maxsize=queue_size)
+        # The capture thread hands only the newest frame to the processing thread,
+        # frames captured while a frame is processed replace each other and are dropped
+        self.frame_slot = FrameSlot()
         
         # Threading control
         self.running = False
         self.threads = []
         
-        # FPS calculation
+        # FPS calculation of the processed frames
         self.fps = 0
         self.frame_count = 0
         self.start_time = 0
         
         # Frames for display - used to pass frames between threads safely
+        # display_sequence increases with every processed frame, the display loop
+        # waits on the condition instead of polling
         self.display_frame = None
         self.display_floor_plan = None
-        self.display_lock = threading.Lock()
+        self.display_sequence = 0
+        self.display_condition = threading.Condition()
+        
+        # MJPEG streams - every processed frame is encoded once and shared by all clients
+        self.frame_stream = MJPEGStream(quality=80)
+        self.floor_stream = MJPEGStream(quality=80)
         
         # Detect operating system for platform-specific handling
         self.is_macos = platform.system() == 'Darwin'
@@ -96,19 +131,20 @@ class CameraProcessor:
     def _calculate_homography(self):
         """Calculate homography matrix with fallback to default points"""
         matrix = self.coordinator.get_homography_matrix()
+        self.homography_source = np.array(self.coordinator.camera_points)
         if matrix is None:
             print("Using default homography points as fallback")
             pts_src = np.array([[28, 1158], [2120, 1112], [1840, 488], [350, 518], [468, 1144]])
             pts_dst = np.array([[0, 990], [699, 988], [693, 658], [0, 661], [141, 988]])
             matrix = calculateHomography(pts_src, pts_dst)
+            self.homography_source = pts_src
         return matrix
     
     def capture_thread(self):
         """Thread function for capturing frames"""
         print("Capture thread started")
-        self.frame_count = 0
-        self.start_time = time_module.time()
-        frame_skip_counter = 0
+        frame_period = 1.0 / self.source_fps
+        next_frame_time = time_module.perf_counter()
         
         while self.running:
             success, frame = self.cap.read()
@@ -118,154 +154,201 @@ class CameraProcessor:
                     continue
                 print("Failed to read video stream")
                 self.running = False
+                self.frame_slot.close()
                 break
             
-            frame_skip_counter += 1
+            # Only the newest frame is kept, the detection scheduler decides whether
+            # it runs the detector or only propagates the last detections
+            # Optionally resize the frame to reduce processing load
+            # frame = cv2.resize(frame, (640, 480))  # Uncomment if needed
+            self.frame_slot.put(frame)
             
-            # Only process every Nth frame to reduce computational load
-            if frame_skip_counter >= self.process_every_n_frames:
-                frame_skip_counter = 0
-                
-                if not self.frame_queue.full():
-                    # Optionally resize the frame to reduce processing load
-                    # frame = cv2.resize(frame, (640, 480))  # Uncomment if needed
-                    
-                    self.frame_queue.put(frame)
-                    self.frame_count += 1
-                    
-                    # Calculate FPS every 30 frames
-                    if self.frame_count % 30 == 0:
-                        end_time = time_module.time()
-                        self.fps = 30 / (end_time - self.start_time)
-                        self.start_time = end_time
-                else:
-                    # If queue is full, skip this frame
-                    time_module.sleep(0.01)
-            # For skipped frames, we don't put them in the queue
+            # A video file is read at its own frame rate like a live camera, instead
+            # of decoding frames faster than they can be processed
+            if self.is_video:
+                next_frame_time = max(next_frame_time + frame_period,
+                                      time_module.perf_counter() - frame_period)
+                delay = next_frame_time - time_module.perf_counter()
+                if delay > 0:
+                    time_module.sleep(delay)
     
     def processing_thread(self):
         """Thread function for processing frames"""
         print("Processing thread started")
+        self.frame_count = 0
+        self.start_time = time_module.time()
         
         while self.running:
-            if not self.frame_queue.empty():
-                frame = self.frame_queue.get()
-                try:
-                    # Process frame
-                    annotated_frame, floor_annotated_frame = self.process_frame(frame)
-                    
-                    # Add timestamp
-                    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    cv2.putText(annotated_frame, f"FPS: {self.fps:.2f}", (10, 30), 
-                                cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
-                    cv2.putText(annotated_frame, timestamp, (10, 60), 
-                                cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
-                    
-                    # Update frames for display thread
-                    with self.display_lock:
-                        self.display_frame = annotated_frame
-                        self.display_floor_plan = floor_annotated_frame
-                except Exception as e:
-                    print(f"Error processing frame: {e}")
-            else:
-                # If no frames to process, wait a bit
-                time_module.sleep(0.01)
+            # Block until the capture thread delivers a frame, the timeout only
+            # rechecks whether the processor was stopped
+            frame, skipped = self.frame_slot.get(timeout=0.5)
+            if frame is None:
+                continue
+            try:
+                # Process frame
+                annotated_frame, floor_annotated_frame = self.process_frame(frame, skipped)
+                
+                # Calculate FPS every 30 frames
+                self.frame_count += 1
+                if self.frame_count % 30 == 0:
+                    end_time = time_module.time()
+                    self.fps = 30 / (end_time - self.start_time)
+                    self.start_time = end_time
+                
+                # Add timestamp
+                timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                cv2.putText(annotated_frame, f"FPS: {self.fps:.2f}", (10, 30), 
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
+                cv2.putText(annotated_frame, timestamp, (10, 60), 
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
+                cv2.putText(annotated_frame, f"Detect every {self.scheduler.interval:.1f} frames", (10, 90), 
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
+                
+                # The floor annotator draws into its own image, so stream a snapshot of it
+                floor_snapshot = floor_annotated_frame.copy()
+                
+                # Update frames for display thread
+                with self.display_condition:
+                    self.display_frame = annotated_frame
+                    self.display_floor_plan = floor_snapshot
+                    self.display_sequence += 1
+                    self.display_condition.notify_all()
+                
+                # Publish frames to the MJPEG streams
+                self.frame_stream.publish(annotated_frame)
+                self.floor_stream.publish(floor_snapshot)
+            except Exception as e:
+                print(f"Error processing frame: {e}")
     
-    def main_thread_display(self):
-        """Function to display frames from the main thread (macOS compatible)"""
+    def main_thread_display(self, last_sequence=0, timeout=0.05):
+        """
+        Function to display frames from the main thread (macOS compatible)
+        
+        Args:
+            last_sequence (int): Sequence number of the frames shown last
+            timeout (float): Seconds to wait for new frames, the window events are
+                handled at least this often
+        
+        Returns:
+            int: Sequence number of the frames shown now
+        """
         if not self.running:
-            return
+            return last_sequence
         
-        with self.display_lock:
-            if self.display_frame is not None:
-                cv2.imshow("Annotated Frame", self.display_frame)
-            if self.display_floor_plan is not None:
-                cv2.imshow("Floor Annotation", self.display_floor_plan)
+        # Wake up as soon as a new frame was processed
+        with self.display_condition:
+            self.display_condition.wait_for(lambda: self.display_sequence > last_sequence
+                                            or not self.running, timeout)
+            sequence = self.display_sequence
+            display_frame, display_floor_plan = self.display_frame, self.display_floor_plan
+        
+        if sequence > last_sequence:
+            if display_frame is not None:
+                cv2.imshow("Annotated Frame", display_frame)
+            if display_floor_plan is not None:
+                cv2.imshow("Floor Annotation", display_floor_plan)
                 
         # Check for exit key - must be called from main thread
         key = cv2.waitKey(1) & 0xFF
         if key == ord('q'):
             self.running = False
+        return sequence
+    
+    def detect_people(self, frame):
+        """
+        Run the detector and tracker on a keyframe
+        
+        Args:
+            frame (numpy.ndarray): Input video frame
+        
+        Returns:
+            tuple: (x, y, w, h) centre boxes and track IDs of the detected people
+        """
+        # Only the region of interest is detected, at its own inference size
+        region, imgsz = self.region_of_interest.crop(frame)
+        results = self.model.track(region, persist=True, show=False, imgsz=imgsz, verbose=False)
+        boxes = results[0].boxes
+        
+        # Track IDs are only assigned once the tracker confirmed a track
+        if boxes is None or boxes.id is None:
+            return np.empty((0, 4), dtype=np.float32), np.empty(0, dtype=int)
+        
+        # Filter for human detections (class 0)
+        human_indices = boxes.cls.cpu().numpy() == 0
+        return (self.region_of_interest.mapBoxes(boxes.xywh.cpu().numpy()[human_indices]),
+                boxes.id.int().cpu().numpy()[human_indices])
     
-    def process_frame(self, frame):
+    def process_frame(self, frame, skipped=0):
         """
         Process a single video frame
         
         Args:
             frame (numpy.ndarray): Input video frame
+            skipped (int): Number of frames dropped since the previous processed frame
         
         Returns:
             tuple: Annotated frame and floor plan annotation
         """
         try:
-            # Process with a smaller image size for better performance (reduced from 1280)
-            results = self.model.track(frame, persist=True, show=False, imgsz=1280, verbose=False)
+            # Run the detector on keyframes, otherwise move the last detections
+            # with the motion between the frames
+            # Dropped frames mean the processing falls behind the source
+            backlog = skipped / (skipped + 1)
+            if self.scheduler.should_detect(backlog):
+                detect_start = time_module.perf_counter()
+                human_boxes, human_track_ids = self.detect_people(frame)
+                self.scheduler.update_keyframe(frame, human_boxes, human_track_ids,
+                                               time_module.perf_counter() - detect_start)
+            else:
+                human_boxes, human_track_ids = self.scheduler.propagate(frame)
             
             # Prepare annotation frames
             annotated_frame = frame #.copy()
             floor_annotated_frame = self.floor_annotator.get_floor_plan()
             total_people = 0
             
-            # Process detections
-            if results[0].boxes is not None and hasattr(results[0].boxes, 'id'):
-                boxes = results[0].boxes.xywh.cpu().numpy()
-                track_ids = results[0].boxes.id.int().cpu().numpy()
-                classes = results[0].boxes.cls.cpu().numpy()
+            # Annotate trajectories and draw bounding boxes
+            current_time = time_module.time()
+            for box, track_id in zip(human_boxes, human_track_ids):
+                x, y, w, h = box
+                center = (int(x), int(y + h / 2))
                 
-                # Filter for human detections (class 0)
-                human_indices = classes == 0
-                human_boxes = boxes[human_indices]
-                human_track_ids = track_ids[human_indices]
+                # Update track history (keeps the last 30 points)
+                self.track_history.append(int(track_id), center, current_time)
                 
-                # Pre-calculate all transformed points in batch if possible
-                #updated_tracks = []
+                # Draw bounding box and ID
+                cv2.rectangle(annotated_frame, 
+                              (int(x - w/2), int(y - h/2)), 
+                              (int(x + w/2), int(y + h/2)), 
+                              (0, 255, 0), 2)
+                cv2.putText(annotated_frame, 
+                            f"ID: {int(track_id)}", 
+                            (int(x - w/2), int(y - h/2) - 10), 
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
                 
-                # Annotate trajectories and draw bounding boxes
-                for box, track_id in zip(human_boxes, human_track_ids):
-                    x, y, w, h = box
-                    center = (int(x), int(y + h / 2))
-                    
-                    # Update track history
-                    self.track_history[track_id].append(center)
-                    #updated_tracks.append(track_id)
-                    
-                    # Limit track history
-                    if len(self.track_history[track_id]) > 30:  # Reduced from 50
-                        self.track_history[track_id].pop(0)
+                total_people += 1
+                
+                # Draw the trajectory of the person
+                points = self.track_history.get(int(track_id))
+                if len(points) > 1:
+                    # Draw trajectory on original frame
+                    cv2.polylines(annotated_frame, 
+                                  [points], 
+                                  isClosed=False, 
+                                  color=(255, 0, 0), 
+                                  thickness=2)
                     
-                    # Draw bounding box and ID
-                    cv2.rectangle(annotated_frame, 
-                                  (int(x - w/2), int(y - h/2)), 
-                                  (int(x + w/2), int(y + h/2)), 
-                                  (0, 255, 0), 2)
-                    cv2.putText(annotated_frame, 
-                                f"ID: {int(track_id)}", 
-                                (int(x - w/2), int(y - h/2) - 10), 
-                                cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
+                    # Transform points for floor plan
+                    transformed_points = transformPoints(points, self.homography_matrix)
                     
-                    total_people += 1
-                
-                    # Draw trajectories for all remaining tracks
-                    if len(self.track_history[track_id]) > 1:
-                        points = np.array(self.track_history[track_id], dtype=np.int32)
-                        
-                        if len(points) > 1:
-                            
-                            # Draw trajectory on original frame
-                            cv2.polylines(annotated_frame, 
-                                            [points], 
-                                            isClosed=False, 
-                                            color=(255, 0, 0), 
-                                            thickness=2)
-                            
-                            # Transform points for floor plan
-                            transformed_points = transformPoints(points, self.homography_matrix)
-                            
-                            # Annotate trajectory on floor plan
-                            floor_annotated_frame = self.floor_annotator.annotate_trajectory(
-                                transformed_points
-                            )
-                
+                    # Annotate trajectory on floor plan
+                    floor_annotated_frame = self.floor_annotator.annotate_trajectory(
+                        transformed_points
+                    )
+            
+            # Forget the people who left the scene
+            self.track_history.evictStale(current_time)
+            
             # Record people count
             self.current_frame_id += 1
             #self.db.insertRecord(total_people, self.current_frame_id)
@@ -278,103 +361,58 @@ class CameraProcessor:
     
     def run(self):
         """Start processing with macOS-compatible threading"""
-        self.running = True
-        
-        # Create and start worker threads
-        capture_thread = threading.Thread(target=self.capture_thread)
-        process_thread = threading.Thread(target=self.processing_thread)
-        
-        # Set as daemon threads so they exit when main program exits
-        capture_thread.daemon = True
-        process_thread.daemon = True
-        
-        # Start threads
-        capture_thread.start()
-        process_thread.start()
-        
-        # Store threads
-        self.threads = [capture_thread, process_thread]
+        self.start_threads()
         
         # Main loop for UI operations (always runs on main thread)
         try:
+            display_sequence = 0
             while self.running:
-                # Display frames from main thread only
-                self.main_thread_display()
-                
-                # Yield to other threads
-                time_module.sleep(0.01)
+                # Display frames from main thread only, waits for the next frame
+                display_sequence = self.main_thread_display(display_sequence)
         except KeyboardInterrupt:
             print("Interrupted by user")
         finally:
             self.running = False
             self.release()
     
+    def start_threads(self):
+        """Start the capture and processing threads if they are not running yet"""
+        if self.running:
+            return
+        
+        self.running = True
+        self.frame_slot.reopen()
+        
+        # Daemon threads exit when the main program exits
+        capture_thread = threading.Thread(target=self.capture_thread)
+        process_thread = threading.Thread(target=self.processing_thread)
+        capture_thread.daemon = True
+        process_thread.daemon = True
+        capture_thread.start()
+        process_thread.start()
+        self.threads = [capture_thread, process_thread]
+    
     def get_frame(self):
         """Generator for streaming annotated frames"""
-        # Start worker threads if not already running
-        if not self.running:
-            self.running = True
-            capture_thread = threading.Thread(target=self.capture_thread)
-            process_thread = threading.Thread(target=self.processing_thread)
-            capture_thread.daemon = True
-            process_thread.daemon = True
-            capture_thread.start()
-            process_thread.start()
-            self.threads = [capture_thread, process_thread]
-        
-        while True:
-            try:
-                # Wait for frame to be processed
-                with self.display_lock:
-                    if self.display_frame is not None:
-                        # Make a copy to avoid race conditions
-                        frame_copy = self.display_frame.copy()
-                        ret, buffer = cv2.imencode('.jpg', frame_copy)
-                        frame_bytes = buffer.tobytes()
-                        yield (b'--frame\r\n'
-                               b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
-                    else:
-                        time_module.sleep(0.05)
-            except Exception as e:
-                print(f"Stream error: {e}")
-                time_module.sleep(0.1)
+        self.start_threads()
+        return self.frame_stream.subscribe()
     
     def get_annotated_frame(self):
         """Generator for streaming floor plan annotations"""
-        # Start worker threads if not already running
-        if not self.running:
-            self.running = True
-            capture_thread = threading.Thread(target=self.capture_thread)
-            process_thread = threading.Thread(target=self.processing_thread)
-            capture_thread.daemon = True
-            process_thread.daemon = True
-            capture_thread.start()
-            process_thread.start()
-            self.threads = [capture_thread, process_thread]
-        
-        while True:
-            try:
-                # Wait for floor plan to be processed
-                with self.display_lock:
-                    if self.display_floor_plan is not None:
-                        # Make a copy to avoid race conditions
-                        floor_copy = self.display_floor_plan.copy()
-                        ret, buffer = cv2.imencode('.jpg', floor_copy)
-                        frame_bytes = buffer.tobytes()
-                        yield (b'--frame\r\n'
-                               b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
-                    else:
-                        time_module.sleep(0.05)
-            except Exception as e:
-                print(f"Stream error: {e}")
-                time_module.sleep(0.1)
+        self.start_threads()
+        return self.floor_stream.subscribe()
     
     def release(self):
         """Release video capture and close windows"""
         self.running = False
         
-        # Give threads time to finish
-        time_module.sleep(1)
+        # Wake up the waiting threads and let them finish
+        self.frame_slot.close()
+        with self.display_condition:
+            self.display_condition.notify_all()
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join(timeout=1.0)
         
         # Release resources
         if self.cap is not None:
@@ -387,12 +425,12 @@ if __name__ == "__main__":
     # Use default camera
     #processor = CameraProcessor(source=1)
     
-    # For real-life scenarios, processing every 2-3 frames is often sufficient
-    # This reduces computational load while maintaining tracking accuracy
-    # For crowd monitoring, 5-10 FPS is typically enough, not 30 FPS
+    # For real-life scenarios, detecting every 2-3 frames is often sufficient
+    # The detection interval adapts between 1 and 10 frames, every frame is still
+    # annotated with the boxes propagated from the last detection
     processor = CameraProcessor(
         source="/Users/apple/Desktop/Deakin/T2_2024/SIT764_Capstone/Crowd_Monitor/market-square.mp4", 
         is_video=True,
-        process_every_n_frames=10  # Process every 2nd frame (reduces processing by 50%)
+        process_every_n_frames=10  # Detect at least every 10th frame
     )
     processor.run()
\ No newline at end of file
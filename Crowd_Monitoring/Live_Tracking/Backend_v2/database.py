@@ -1,17 +1,34 @@
-from pymongo import MongoClient
+from pymongo import DESCENDING, MongoClient
 import time
-from datetime import datetime
+from datetime import datetime, timezone
+from recordWriter import RecordWriter
 
 class Database:
-    def __init__(self):
+    def __init__(self, retentionDays=30, batchSize=100, flushInterval=2.0):
         # Initialize the MongoDB client and database
-        # self.client = MongoClient("")
+        # The client gives up on an unreachable server after a few seconds instead
+        # of the default 30, the writes are retried by the record writer anyway
+        # self.client = MongoClient("", serverSelectionTimeoutMS=5000)
         self.db = self.client["CrowdTracking"]
         self.collection = self.db["Crowd"]
         self.lastRecorded = time.time()  # Initialize with current timestamp
+        self.retentionDays = retentionDays
+
+        # The records are written on a background thread in batches, so a slow or
+        # unreachable database never blocks the frame processing
+        self.writer = RecordWriter(self.collection, batchSize=batchSize,
+                                   flushInterval=flushInterval, setup=self.createIndexes)
+
+        # The latest count recorded by this process, returned without a query
+        self.latestCount = None
+
+    def createIndexes(self):
+        # Timestamps are stored as native datetimes, the index serves the latest
+        # record queries and its TTL removes records older than the retention
+        self.collection.create_index([("timestamp", DESCENDING)],
+                                     expireAfterSeconds=self.retentionDays * 24 * 60 * 60)
 
     def insertRecord(self, count, frameId):
-        currentTime = datetime.now()  # Use datetime object for formatting
         currentTimestamp = time.time()  # Get current timestamp
 
         # Only record data every second
@@ -19,18 +36,27 @@ class Database:
             record = {
                 "frameId": frameId,
                 "peopleCount": count,
-                "timestamp": currentTime.strftime("%d-%m-%Y %H:%M:%S")  # Format datetime object
+                "timestamp": datetime.now(timezone.utc),
             }
-            try:
-                self.collection.insert_one(record)
-                print(f"Recorded: Frame {frameId}, Time {currentTime.strftime('%d-%m-%Y %H:%M:%S')}, People {count}")
-            except Exception as e:
-                print(f"Failed to insert record into database: {e}")
+            # Buffered, the record is written by the background writer
+            self.writer.add(record)
+            self.latestCount = count
             self.lastRecorded = currentTimestamp  # Update the last recorded timestamp
 
     def getlastestRecord(self):
-        latestRecord = self.collection.find_one(sort=[("timestamp", -1)])
+        if self.latestCount is not None:
+            return self.latestCount
+        try:
+            latestRecord = self.collection.find_one(sort=[("timestamp", DESCENDING)])
+        except Exception as e:
+            print(f"Failed to read the latest record from database: {e}")
+            return 0
         return latestRecord["peopleCount"] if latestRecord else 0
     
+    def getWriterStats(self):
+        return self.writer.getStats()
+    
     def close(self):
-        self.client.close()
+        # Write the buffered records before closing the connection
+        self.writer.close()
+        self.client.close()
\ No newline at end of file
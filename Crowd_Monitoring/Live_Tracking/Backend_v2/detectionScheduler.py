@@ -0,0 +1,226 @@
+import time
+import cv2
+import numpy as np
+
+class DetectionScheduler:
+    def __init__(self, min_interval=1, max_interval=10, frame_period=1 / 30,
+                 target_motion=24.0, flow_scale=0.5, smoothing=0.3, adaptive=True):
+        """
+        Decide on which frames the detector runs and move the boxes on the frames in between
+
+        The detector only runs on keyframes. On the frames between two keyframes the
+        boxes of the last detection are moved with sparse optical flow, falling back to
+        the constant velocity of a track when the flow of its box is lost. The keyframe
+        interval grows while people move slowly and the detector is expensive compared
+        to the frame rate, and shrinks again when the scene speeds up.
+
+        Args:
+            min_interval (int): Smallest number of frames between two detections
+            max_interval (int): Largest number of frames between two detections
+            frame_period (float): Seconds between two frames of the source
+            target_motion (float): Largest displacement in pixels a person may move
+                between two keyframes before the detector has to run again
+            flow_scale (float): Scale of the grayscale images the optical flow runs on
+            smoothing (float): Weight of new measurements in the moving averages
+            adaptive (bool): Adapt the interval, otherwise it stays at max_interval
+        """
+        self.min_interval = max(int(min_interval), 1)
+        self.max_interval = max(int(max_interval), self.min_interval)
+        self.frame_period = frame_period
+        self.target_motion = target_motion
+        self.flow_scale = flow_scale
+        self.smoothing = smoothing
+        self.adaptive = adaptive
+
+        # Current interval, kept as a float so it changes gradually
+        self.interval = float(self.min_interval if adaptive else self.max_interval)
+        self.frames_since_keyframe = 0
+
+        # Boxes (x, y, w, h) and IDs of the tracked people and their velocity in pixels per frame
+        self.boxes = np.empty((0, 4), dtype=np.float32)
+        self.keyframe_boxes = self.boxes
+        self.track_ids = np.empty(0, dtype=int)
+        self.velocities = np.empty((0, 2), dtype=np.float32)
+        self.previous_gray = None
+
+        # Moving averages of the motion in pixels per frame and of the stage timings in seconds
+        self.motion = 0.0
+        self.detect_time = 0.0
+        self.propagate_time = 0.0
+
+        # Sample points inside every box, relative to its size, tracked by the optical flow
+        self.sample_offsets = np.array(
+            [[0, 0], [-0.2, -0.25], [0.2, -0.25], [-0.2, 0.25], [0.2, 0.25]],
+            dtype=np.float32
+        )
+        self.flow_params = dict(
+            winSize=(15, 15),
+            maxLevel=2,
+            criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03)
+        )
+
+        # Metrics
+        self.keyframes = 0
+        self.propagated_frames = 0
+        self.postponed_keyframes = 0
+
+    def _to_gray(self, frame):
+        """Grayscale copy of the frame at the optical flow scale"""
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+        if self.flow_scale != 1.0:
+            gray = cv2.resize(gray, None, fx=self.flow_scale, fy=self.flow_scale,
+                              interpolation=cv2.INTER_AREA)
+        return gray
+
+    def _average(self, current, value):
+        return current + self.smoothing * (value - current)
+
+    def should_detect(self, backlog=0.0):
+        """
+        Check whether the detector has to run on the next frame
+
+        Args:
+            backlog (float): Share (0-1) of the captured frames dropped because the
+                processing fell behind the source
+
+        Returns:
+            bool: True when the next frame is a keyframe
+        """
+        if self.previous_gray is None:
+            return True
+        if self.frames_since_keyframe + 1 >= self.max_interval:
+            return True
+        if self.frames_since_keyframe + 1 < round(self.interval):
+            return False
+
+        # Postpone the detection while frames pile up, the propagation catches up quickly
+        if self.adaptive and backlog > 0.5:
+            self.postponed_keyframes += 1
+            return False
+        return True
+
+    def update_keyframe(self, frame, boxes, track_ids, detect_time):
+        """
+        Store the detections of a keyframe and adapt the detection interval
+
+        Args:
+            frame (numpy.ndarray): The keyframe
+            boxes (numpy.ndarray): Detected (x, y, w, h) centre boxes
+            track_ids (numpy.ndarray): Track ID of every box
+            detect_time (float): Seconds the detection took
+        """
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        track_ids = np.asarray(track_ids, dtype=int).reshape(-1)
+        frames = self.frames_since_keyframe + 1
+
+        # Velocity of every track that was already known, from its displacement
+        # between the last two keyframes
+        velocities = np.zeros((len(boxes), 2), dtype=np.float32)
+        if len(self.track_ids) and len(track_ids):
+            known = {int(track_id): index for index, track_id in enumerate(self.track_ids)}
+            matched = []
+            for index, track_id in enumerate(track_ids):
+                previous = known.get(int(track_id))
+                if previous is not None:
+                    velocities[index] = (boxes[index, :2] - self.keyframe_boxes[previous, :2]) / frames
+                    matched.append(index)
+            if matched:
+                speeds = np.linalg.norm(velocities[matched], axis=1)
+                self.motion = self._average(self.motion, float(np.percentile(speeds, 90)))
+
+        self.boxes = boxes
+        self.keyframe_boxes = boxes.copy()
+        self.track_ids = track_ids
+        self.velocities = velocities
+        self.previous_gray = self._to_gray(frame)
+        self.frames_since_keyframe = 0
+        self.keyframes += 1
+
+        if self.keyframes == 1:
+            self.detect_time = detect_time
+        else:
+            self.detect_time = self._average(self.detect_time, detect_time)
+        self._adapt_interval()
+
+    def propagate(self, frame):
+        """
+        Move the boxes of the last keyframe onto a frame without running the detector
+
+        Args:
+            frame (numpy.ndarray): The frame between two keyframes
+
+        Returns:
+            tuple: Propagated (x, y, w, h) boxes and their track IDs
+        """
+        start_time = time.perf_counter()
+        self.frames_since_keyframe += 1
+        self.propagated_frames += 1
+        gray = self._to_gray(frame)
+
+        count = len(self.boxes)
+        if count:
+            # Track a few points per box with pyramidal Lucas-Kanade
+            sample_count = len(self.sample_offsets)
+            centers = self.boxes[:, np.newaxis, :2]
+            sizes = self.boxes[:, np.newaxis, 2:]
+            points = ((centers + self.sample_offsets * sizes) * self.flow_scale).reshape(-1, 1, 2)
+            moved, status, _ = cv2.calcOpticalFlowPyrLK(
+                self.previous_gray, gray, points.astype(np.float32), None, **self.flow_params
+            )
+            displacement = (moved - points).reshape(count, sample_count, 2) / self.flow_scale
+            valid = status.reshape(count, sample_count).astype(bool)
+
+            # The median displacement of the points that were found moves the box,
+            # boxes without any point keep moving with their last velocity
+            displacement[~valid] = np.nan
+            tracked = valid.any(axis=1)
+            steps = self.velocities.copy()
+            if tracked.any():
+                steps[tracked] = np.nanmedian(displacement[tracked], axis=1)
+                self.velocities[tracked] = self._average(self.velocities[tracked], steps[tracked])
+                self.motion = self._average(
+                    self.motion, float(np.percentile(np.linalg.norm(steps[tracked], axis=1), 90))
+                )
+            self.boxes[:, :2] += steps
+
+        self.previous_gray = gray
+        self.propagate_time = self._average(self.propagate_time, time.perf_counter() - start_time)
+        return self.boxes.copy(), self.track_ids.copy()
+
+    def _adapt_interval(self):
+        """Choose the keyframe interval from the scene motion and the processing load"""
+        if not self.adaptive:
+            return
+
+        # Detect again before people can move further than the target motion
+        motion_interval = self.target_motion / max(self.motion, 1e-3)
+
+        # The detection and the propagated frames of one interval have to fit into
+        # the time the source needs for the same number of frames
+        spare_time = self.frame_period - self.propagate_time
+        if spare_time > 0:
+            load_interval = (self.detect_time - self.propagate_time) / spare_time
+        else:
+            load_interval = self.max_interval
+
+        target = min(max(motion_interval, load_interval, self.min_interval), self.max_interval)
+        self.interval = min(max(self._average(self.interval, target), self.min_interval), self.max_interval)
+
+    def get_stats(self):
+        """
+        Scheduler metrics
+
+        Returns:
+            dict: Current interval, frame counts, motion and timings
+        """
+        frames = self.keyframes + self.propagated_frames
+        return {
+            "interval": self.interval,
+            "keyframes": self.keyframes,
+            "propagated_frames": self.propagated_frames,
+            "postponed_keyframes": self.postponed_keyframes,
+            "detection_ratio": self.keyframes / frames if frames else 0.0,
+            "motion": self.motion,
+            "detect_time_ms": self.detect_time * 1000,
+            "propagate_time_ms": self.propagate_time * 1000,
+        }
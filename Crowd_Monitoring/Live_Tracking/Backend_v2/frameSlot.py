@@ -0,0 +1,82 @@
+import threading
+
+class FrameSlot:
+    def __init__(self):
+        """
+        Hand the newest frame from one thread to another
+
+        The slot holds at most one frame. A frame put while the previous one was not
+        taken yet replaces it, so a slow consumer always gets the newest frame and stale
+        frames are dropped at the source instead of waiting in a queue. Consumers block
+        on a condition variable until a frame arrives, nothing polls.
+        """
+        self.condition = threading.Condition()
+        self.frame = None
+        self.closed = False
+
+        # Frames replaced since the last get, and in total
+        self.skipped = 0
+        self.dropped_frames = 0
+        self.put_frames = 0
+
+    def put(self, frame):
+        """
+        Store a frame, replacing the one not taken yet
+
+        Args:
+            frame (numpy.ndarray): The new frame, must not be modified afterwards
+        """
+        with self.condition:
+            if self.closed:
+                return
+            if self.frame is not None:
+                self.skipped += 1
+                self.dropped_frames += 1
+            self.frame = frame
+            self.put_frames += 1
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """
+        Take the newest frame, waiting until one arrives
+
+        Args:
+            timeout (float): Seconds to wait, None waits until a frame arrives or the
+                slot is closed
+
+        Returns:
+            tuple: (frame, skipped) with the number of frames dropped since the
+                previous get, (None, 0) on a timeout or when the slot was closed
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.frame is not None or self.closed, timeout)
+            if self.frame is None:
+                return None, 0
+            frame, skipped = self.frame, self.skipped
+            self.frame = None
+            self.skipped = 0
+            return frame, skipped
+
+    def close(self):
+        """Wake up every waiting consumer, frames put from now on are ignored"""
+        with self.condition:
+            self.closed = True
+            self.frame = None
+            self.condition.notify_all()
+
+    def reopen(self):
+        """Accept frames again after close"""
+        with self.condition:
+            self.closed = False
+            self.skipped = 0
+
+    def get_stats(self):
+        """
+        Returns:
+            dict: Number of frames put and dropped before they were taken
+        """
+        with self.condition:
+            return {
+                "put_frames": self.put_frames,
+                "dropped_frames": self.dropped_frames,
+            }
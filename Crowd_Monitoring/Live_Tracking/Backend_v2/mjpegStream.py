@@ -0,0 +1,106 @@
+import threading
+import cv2
+
+
+class MJPEGStream:
+    def __init__(self, quality=80, width=None, height=None, timeout=5.0):
+        # quality is the JPEG quality (0-100) used for this stream
+        # width and height resize the frame before encoding, if only one of them is
+        # given the other one is derived from the aspect ratio of the frame
+        # timeout is how long a client waits for a new frame before checking again
+        self.quality = quality
+        self.width = width
+        self.height = height
+        self.timeout = timeout
+
+        # The latest raw frame and its sequence number, guarded by the condition
+        self.condition = threading.Condition()
+        self.frame = None
+        self.sequence = 0
+        self.subscribers = 0
+
+        # The latest encoded frame, each sequence number is encoded at most once
+        self.encodeLock = threading.Lock()
+        self.encodedFrame = None
+        self.encodedSequence = 0
+        self.encodeCount = 0
+
+    def configure(self, quality=None, width=None, height=None):
+        with self.encodeLock:
+            if quality is not None:
+                self.quality = quality
+            self.width = width
+            self.height = height
+
+            # Force the next request to re-encode with the new settings
+            self.encodedSequence = 0
+
+    def publish(self, frame):
+        # Store a new frame and wake up every waiting client
+        # The frame must not be modified by the caller after it was published
+        with self.condition:
+            self.frame = frame
+            self.sequence += 1
+            self.condition.notify_all()
+
+    def encode(self, frame):
+        height, width = frame.shape[:2]
+        targetWidth, targetHeight = self.width, self.height
+        if targetWidth is not None and targetHeight is None:
+            targetHeight = int(height * targetWidth / width)
+        elif targetHeight is not None and targetWidth is None:
+            targetWidth = int(width * targetHeight / height)
+
+        if targetWidth is not None and (targetWidth, targetHeight) != (width, height):
+            frame = cv2.resize(
+                frame, (targetWidth, targetHeight), interpolation=cv2.INTER_AREA
+            )
+
+        ret, buffer = cv2.imencode(
+            ".jpg", frame, [int(cv2.IMWRITE_JPEG_QUALITY), int(self.quality)]
+        )
+        return buffer.tobytes() if ret else None
+
+    def getJPEG(self, lastSequence=0, wait=True):
+        # Return (sequence, jpegBytes) for the newest frame after lastSequence
+        # Slow clients skip every frame they missed instead of queueing them
+        # Returns (lastSequence, None) when no newer frame arrived before the timeout
+        with self.condition:
+            if wait:
+                self.condition.wait_for(
+                    lambda: self.sequence > lastSequence, timeout=self.timeout
+                )
+            if self.sequence <= lastSequence:
+                return lastSequence, None
+            sequence, frame = self.sequence, self.frame
+
+        with self.encodeLock:
+            # Another client may already have encoded this or an even newer frame
+            if self.encodedSequence < sequence:
+                self.encodedFrame = self.encode(frame)
+                self.encodedSequence = sequence
+                self.encodeCount += 1
+            return self.encodedSequence, self.encodedFrame
+
+    def subscribe(self):
+        # Generator for a multipart MJPEG response
+        with self.condition:
+            self.subscribers += 1
+
+        try:
+            lastSequence = 0
+            while True:
+                lastSequence, jpegBytes = self.getJPEG(lastSequence)
+                if jpegBytes is None:
+                    continue
+                yield (
+                    b"--frame\r\n"
+                    b"Content-Type: image/jpeg\r\n\r\n" + jpegBytes + b"\r\n"
+                )
+        finally:
+            with self.condition:
+                self.subscribers -= 1
+
+    def subscriberCount(self):
+        with self.condition:
+            return self.subscribers
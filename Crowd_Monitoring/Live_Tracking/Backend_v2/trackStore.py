@@ -0,0 +1,168 @@
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+class TrackBuffer:
+    def __init__(self, capacity, dtype=np.int32):
+        # Fixed size ring buffer of (x, y) points, the oldest point is overwritten when full
+        self.points = np.zeros((capacity, 2), dtype=dtype)
+        self.start = 0
+        self.length = 0
+        self.lastSeen = 0.0
+
+    def append(self, point):
+        capacity = len(self.points)
+        self.points[(self.start + self.length) % capacity] = point
+        if self.length < capacity:
+            self.length += 1
+        else:
+            self.start = (self.start + 1) % capacity
+
+    def toArray(self):
+        # Chronological copy of the stored points, oldest first
+        end = self.start + self.length
+        if end <= len(self.points):
+            return self.points[self.start : end].copy()
+        return np.concatenate(
+            [self.points[self.start :], self.points[: end - len(self.points)]]
+        )
+
+    def last(self):
+        return self.points[(self.start + self.length - 1) % len(self.points)]
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            if index < 0:
+                index += self.length
+            if not 0 <= index < self.length:
+                raise IndexError("track point index out of range")
+            return self.points[(self.start + index) % len(self.points)]
+        return self.toArray()[index]
+
+
+class TrackStore:
+    def __init__(self, capacity=50, maxTracks=1000, ttl=10.0, dtype=np.int32):
+        # capacity is the number of points kept per track
+        # maxTracks caps the number of tracks, the least recently updated one is evicted first
+        # ttl is the number of seconds after which a track that was not updated is evicted
+        # tracks is ordered from the least to the most recently updated track
+        self.capacity = capacity
+        self.maxTracks = maxTracks
+        self.ttl = ttl
+        self.dtype = dtype
+        self.tracks = OrderedDict()
+
+        # Callbacks receiving the list of evicted track IDs, so other modules
+        # can drop their per-track state as well
+        self.evictionCallbacks = []
+
+        # Metrics
+        self.appendedPoints = 0
+        self.evictedByTTL = 0
+        self.evictedByLRU = 0
+
+    def onEvict(self, callback):
+        self.evictionCallbacks.append(callback)
+
+    def append(self, trackID, point, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+
+        track = self.tracks.get(trackID)
+        if track is None:
+            track = TrackBuffer(self.capacity, self.dtype)
+            self.tracks[trackID] = track
+        else:
+            self.tracks.move_to_end(trackID)
+
+        track.append(point)
+        track.lastSeen = timestamp
+        self.appendedPoints += 1
+
+        # Enforce the cap on the total number of tracks
+        if len(self.tracks) > self.maxTracks:
+            evicted = []
+            while len(self.tracks) > self.maxTracks:
+                evicted.append(self.tracks.popitem(last=False)[0])
+            self.evictedByLRU += len(evicted)
+            self.notifyEviction(evicted)
+
+        return track
+
+    def evictStale(self, now=None):
+        # Evict the tracks that were not updated within the TTL
+        # Tracks are ordered by their last update, so only the stale ones are visited
+        if now is None:
+            now = time.time()
+
+        evicted = []
+        while self.tracks:
+            trackID, track = next(iter(self.tracks.items()))
+            if now - track.lastSeen < self.ttl:
+                break
+            self.tracks.popitem(last=False)
+            evicted.append(trackID)
+
+        if evicted:
+            self.evictedByTTL += len(evicted)
+            self.notifyEviction(evicted)
+        return evicted
+
+    def remove(self, trackIDs):
+        # Remove tracks without notifying the eviction callbacks
+        for trackID in trackIDs:
+            self.tracks.pop(trackID, None)
+
+    def notifyEviction(self, trackIDs):
+        for callback in self.evictionCallbacks:
+            callback(trackIDs)
+
+    def get(self, trackID):
+        # Chronological (N, 2) array of the track points, empty for unknown tracks
+        track = self.tracks.get(trackID)
+        if track is None:
+            return np.empty((0, 2), dtype=self.dtype)
+        return track.toArray()
+
+    def lastPoints(self, since=None):
+        # Track IDs and (N, 2) array of the last point of every track,
+        # optionally only for the tracks updated at or after the given timestamp
+        trackIDs = []
+        points = []
+        for trackID, track in self.tracks.items():
+            if since is not None and track.lastSeen < since:
+                continue
+            trackIDs.append(trackID)
+            points.append(track.last())
+        return trackIDs, np.array(points, dtype=self.dtype).reshape(-1, 2)
+
+    def items(self):
+        for trackID, track in self.tracks.items():
+            yield trackID, track
+
+    def __contains__(self, trackID):
+        return trackID in self.tracks
+
+    def __getitem__(self, trackID):
+        return self.get(trackID)
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def getMetrics(self):
+        return {
+            "tracks": len(self.tracks),
+            "maxTracks": self.maxTracks,
+            "pointsPerTrack": self.capacity,
+            "memoryBytes": len(self.tracks)
+            * self.capacity
+            * 2
+            * np.dtype(self.dtype).itemsize,
+            "appendedPoints": self.appendedPoints,
+            "evictedByTTL": self.evictedByTTL,
+            "evictedByLRU": self.evictedByLRU,
+        }
@@ -2,12 +2,29 @@ import cv2
 import numpy as np
 import time
 from collections import defaultdict
+from layerCompositor import OverlayLayer
 
 
 class Integration:
-    def __init__(self, congestionDetection, dwellTimeAnalysis):
+    def __init__(
+        self,
+        congestionDetection,
+        dwellTimeAnalysis,
+        rollupStore=None,
+        cameraName="camera",
+        updateInterval=5,
+        opticalFlow=None,
+        clock=time.time,
+    ):
         # Initialize the integration analysis with necessary components
         # including congestion detection and dwell time analysis
+        # rollupStore keeps the per zone history of this camera under cameraName
+        # updateInterval is how often in seconds the full analysis and the floor
+        # prediction run, 0 runs them every frame
+        # opticalFlow predicts the trajectories of the tracked people, whose zone
+        # hits at the end of the prediction horizon flag zones as high risk
+        # clock returns the current time in seconds, e.g. the video time of a replay
+        self.clock = clock
         self.congestionDetection = congestionDetection
         self.dwellTimeAnalysis = dwellTimeAnalysis
         self.homographyMatrix = congestionDetection.homographyMatrix
@@ -16,97 +33,212 @@ class Integration:
         # and other necessary data structures
         self.highRiskZones = []
         self.zoneCongestionCorrelation = defaultdict(float)
-        self.zoneHistoricalData = defaultdict(list)
+
+        # Historical zone counts, dwell times and congestion, downsampled into
+        # 1 second, 1 minute and 15 minute aggregates
+        self.rollupStore = rollupStore
+        self.cameraName = cameraName
+        # Whether every zone was congested at the last integration analysis
+        self.zoneCongestion = np.zeros(0, dtype=bool)
 
         # Thresholds for triggering alerts
         self.highDwellThreshold = 5
         self.highCongestionThreshold = 3
 
         # Update timing settings
-        self.lastUpdateTime = time.time()
-        self.updateInterval = 5
-
-    def update(self, currentPositions, trackIDs, flow=None):
-        # Check if there are any current positions
+        self.lastUpdateTime = self.clock()
+        self.updateInterval = updateInterval
+
+        # Predicted congestion zones on the floor plan from the last prediction
+        # and the number of people predicted in every zone
+        self.opticalFlow = opticalFlow
+        self.predictedCongestion = []
+        self.predictedZoneCounts = np.zeros(0, dtype=np.int64)
+
+        # Callbacks receiving the compact state after every update, e.g. to push
+        # it to the event stream clients
+        self.updateCallbacks = []
+
+    def onUpdate(self, callback):
+        self.updateCallbacks.append(callback)
+
+    def notifyUpdate(self, peopleCount):
+        if not self.updateCallbacks:
+            return
+        state = self.getState(peopleCount)
+        for callback in self.updateCallbacks:
+            callback(state)
+
+    def getState(self, peopleCount):
+        # Compact JSON serialisable state: the counts per zone, the high risk zones
+        # and the predicted congestion, zone IDs are strings so they can be keys
+        return {
+            "peopleCount": int(peopleCount),
+            "zoneCounts": {
+                str(zoneID): int(
+                    self.dwellTimeAnalysis.zoneStats[zoneID]["currentCount"]
+                )
+                for zoneID in range(len(self.dwellTimeAnalysis.zones))
+            },
+            "highRiskZones": {
+                str(riskZone["zoneID"]): {
+                    "zoneName": riskZone["zoneName"],
+                    "riskScore": round(float(riskZone["riskScore"]), 2),
+                    "congestionCount": int(riskZone["congestionCount"]),
+                    "averageDwellTime": round(float(riskZone["averageDwellTime"]), 1),
+                    "predictedCongestion": bool(riskZone["predictedCongestion"]),
+                }
+                for riskZone in self.highRiskZones
+            },
+            "predictedCongestion": self.predictedCongestion,
+        }
+
+    def update(
+        self,
+        currentPositions,
+        trackIDs,
+        flow=None,
+        floorCongestionZones=None,
+        trackHistories=None,
+    ):
+        # floorCongestionZones are zones already in floor plan coordinates, e.g. from
+        # the density grid, in which case the camera positions are not re-clustered
+        # trackHistories maps the track IDs to their points, e.g. the tracks of a
+        # TrackStore, and is used to predict the trajectories of the current tracks
+        # Without any current positions nobody is in view, so the zone visits end
+        # and the congestion, risk zones and predictions are cleared before the
+        # empty zones are recorded
         if not currentPositions:
+            self.dwellTimeAnalysis.updateZones([], [])
+            self.integrationAnalysis([], [], None, flow, floorCongestionZones)
+            self.predictedCongestion = []
+            self.predictedZoneCounts = np.zeros(
+                len(self.dwellTimeAnalysis.zones), dtype=np.int64
+            )
+            self.recordHistory()
+            self.notifyUpdate(0)
             return self.highRiskZones
 
         # Identify congestion zones from current positions
-        congestionZones = self.congestionDetection.identifyCongestionZones(
-            currentPositions
-        )
+        if floorCongestionZones is None:
+            congestionZones = self.congestionDetection.identifyCongestionZones(
+                currentPositions
+            )
+        else:
+            congestionZones = None
 
         # Update dwell time analysis
         self.dwellTimeAnalysis.updateZones(currentPositions, trackIDs)
 
         # Periodic full analysis
-        currentTime = time.time()
-        if currentTime - self.lastUpdateTime > self.updateInterval:
-            self.integrationAnalysis(currentPositions, trackIDs, congestionZones, flow)
+        currentTime = self.clock()
+        if currentTime - self.lastUpdateTime >= self.updateInterval:
+            self.integrationAnalysis(
+                currentPositions, trackIDs, congestionZones, flow, floorCongestionZones
+            )
             self.lastUpdateTime = currentTime
 
-            # if optical flow is provided, perform prediction analysis
-            if flow is not None:
-                self.floorPrediction(currentPositions, flow)
+            # perform prediction analysis with the optical flow and the track histories
+            self.floorPrediction(currentPositions, flow, trackIDs, trackHistories)
+
+        self.recordHistory(currentTime)
+        self.notifyUpdate(len(currentPositions))
 
         # return the high risk zones
         return self.highRiskZones
 
-    def integrationAnalysis(self, currentPositions, trackIDs, congestionZones, flow):
+    def recordHistory(self, currentTime=None):
+        # Add the current state of every zone to the rollup store
+        if self.rollupStore is None:
+            return
+        if currentTime is None:
+            currentTime = self.clock()
+
+        zones = self.dwellTimeAnalysis.zones
+        counts = [
+            self.dwellTimeAnalysis.zoneStats[zoneID]["currentCount"]
+            for zoneID in range(len(zones))
+        ]
+        meanDwell, maxDwell = self.dwellTimeAnalysis.getZoneDwellTimes(currentTime)
+        congested = np.zeros(len(zones), dtype=bool)
+        known = min(len(zones), len(self.zoneCongestion))
+        congested[:known] = self.zoneCongestion[:known]
+
+        self.rollupStore.add(
+            self.cameraName,
+            currentTime,
+            [zoneName for zoneName, _, _ in zones],
+            counts,
+            meanDwell,
+            maxDwell,
+            congested,
+        )
+
+    def integrationAnalysis(
+        self,
+        currentPositions,
+        trackIDs,
+        congestionZones,
+        flow,
+        floorCongestionZones=None,
+    ):
         # Reset high risk zones for this update
         self.highRiskZones = []
+        self.zoneCongestion = np.zeros(len(self.dwellTimeAnalysis.zones), dtype=bool)
 
         # Get current dwell times for all zones
         dwellTimes = self.dwellTimeAnalysis.getCurrentDwellTimes()
 
         # Transform congestion centers to floor coordinates
+        # unless the zones were already detected on the floor plan
         floorCongestionCenters = []
-        for zone in congestionZones:
-            centre, radius, count = zone
-            if centre and radius:
-                floorCentre = self.transformPointToFloor(centre)
-                floorCongestionCenters.append((floorCentre, radius, count))
+        if floorCongestionZones is not None:
+            floorCongestionCenters = list(floorCongestionZones)
+        cameraZones = [
+            (centre, radius, count)
+            for centre, radius, count in congestionZones or []
+            if centre and radius
+        ]
+        if cameraZones:
+            floorCentres = self.transformPointsToFloor(
+                [centre for centre, _, _ in cameraZones]
+            ).astype(int)
+            for floorCentre, (_, radius, count) in zip(
+                floorCentres.tolist(), cameraZones
+            ):
+                floorCongestionCenters.append((tuple(floorCentre), radius, count))
+
+        # Match all congestion centers against all zones at once, a center hits a
+        # zone when it lies inside it or the zone centroid lies within its radius
+        zones = self.dwellTimeAnalysis.zones
+        zoneCentroids = self.getZoneCentroids()
+        hits = np.zeros((len(zones), len(floorCongestionCenters)), dtype=bool)
+        counts = np.zeros(len(floorCongestionCenters), dtype=np.int64)
+        if floorCongestionCenters:
+            centres = np.array(
+                [centre for centre, _, _ in floorCongestionCenters], dtype=np.float64
+            ).reshape(-1, 2)
+            radii = np.array([radius for _, radius, _ in floorCongestionCenters])
+            counts = np.array([count for _, _, count in floorCongestionCenters])
+            distances = np.linalg.norm(
+                zoneCentroids[:, None, :] - centres[None, :, :], axis=2
+            )
+            membership = self.dwellTimeAnalysis.getZoneMembership(centres)
+            hits = membership.T | (distances < radii[None, :])
+        congestionCounts = np.where(hits, counts[None, :], 0).max(axis=1, initial=0)
 
         # Analyze each zone defined in the dwell time analysis
-        for zoneID, (zoneName, zonePoly, zoneColor) in enumerate(
-            self.dwellTimeAnalysis.zones
-        ):
+        for zoneID, (zoneName, zonePoly, zoneColor) in enumerate(zones):
             zoneStats = self.dwellTimeAnalysis.zoneStats[zoneID]
-
-            # Calculate zone centroid
-            zoneCentroid = (int(np.mean(zonePoly[:, 0])), int(np.mean(zonePoly[:, 1])))
-
-            # Check if any congestion centers fall within this zone
-            zoneHasCongestion = False
-            congestionCount = 0
-            for floorCentre, radius, count in floorCongestionCenters:
-                # Check if congestion center is in or near the zone
-                distance = np.sqrt(
-                    (zoneCentroid[0] - floorCentre[0]) ** 2
-                    + (zoneCentroid[1] - floorCentre[1]) ** 2
-                )
-                if self.isPointInPolygon(zonePoly, floorCentre) or distance < radius:
-                    zoneHasCongestion = True
-                    congestionCount = max(congestionCount, count)
+            zoneCentroid = tuple(int(value) for value in zoneCentroids[zoneID])
+            zoneHasCongestion = bool(hits[zoneID].any())
+            congestionCount = congestionCounts[zoneID].item()
 
             # Get zone statistics
             averageDwellTime = zoneStats["averageDwellTime"]
-            currentCount = zoneStats["currentCount"]
 
-            # Store historical data for this zone
-            self.zoneHistoricalData[zoneID].append(
-                {
-                    "timestamp": time.time(),
-                    "count": currentCount,
-                    "averageDwellTime": averageDwellTime,
-                    "hasCongestion": zoneHasCongestion,
-                    "congestionCount": congestionCount,
-                }
-            )
-
-            # Limit historical data length
-            if len(self.zoneHistoricalData[zoneID]) > 100:
-                self.zoneHistoricalData[zoneID].pop(0)
+            # The congestion state is recorded in the rollup history every frame
+            self.zoneCongestion[zoneID] = zoneHasCongestion
 
             # Determine if this is a high-risk zone based on both dwell time and congestion
             if (
@@ -134,68 +266,151 @@ class Integration:
                     }
                 )
 
-    def floorPrediction(self, currentPositions, flow):
+    def floorPrediction(
+        self, currentPositions, flow, trackIDs=None, trackHistories=None
+    ):
+        riskZoneIndices = {
+            riskZone["zoneID"]: index
+            for index, riskZone in enumerate(self.highRiskZones)
+        }
+        self.predictCongestion(currentPositions, flow, riskZoneIndices)
+        self.predictTrackZones(trackIDs, trackHistories, riskZoneIndices)
+
+    def predictCongestion(self, currentPositions, flow, riskZoneIndices):
         # Get predicted congestion zones
+        self.predictedCongestion = []
+        if flow is None:
+            return
         futureCongestion = self.congestionDetection.predictCongestionZones(
             currentPositions, flow
         )
+        if not futureCongestion:
+            return
+
+        # Transform all predicted centres and look up the zones they fall in at once
+        floorCentres, membership = self.predictZoneHits(
+            [centre for centre, _, _ in futureCongestion]
+        )
+        floorCentres = floorCentres.astype(int)
 
         # Process each predicted congestion zone
-        for zone in futureCongestion:
-            centre, radius, count = zone
-            floorCentre = self.transformPointToFloor(centre)
+        for (_, radius, count), floorCentre, zoneHits in zip(
+            futureCongestion, floorCentres, membership
+        ):
+            self.predictedCongestion.append(
+                {
+                    "center": [int(floorCentre[0]), int(floorCentre[1])],
+                    "radius": int(radius),
+                    "count": int(count),
+                }
+            )
 
             # Check which zones this predicted congestion might affect
-            for zoneID, (zoneName, zonePoly, zoneColor) in enumerate(
-                self.dwellTimeAnalysis.zones
-            ):
-                zoneStats = self.dwellTimeAnalysis.zoneStats[zoneID]
-
-                # If dwell time is already high and predicted congestion is in this zone
-                if zoneStats[
-                    "averageDwellTime"
-                ] > self.highDwellThreshold and self.isPointInPolygon(
-                    zonePoly, floorCentre
-                ):
-
-                    # Check if zone is already in high risk zones
-                    zone_already_added = False
-                    for i, riskZone in enumerate(self.highRiskZones):
-                        if riskZone["zoneID"] == zoneID:
-                            # Increase risk score for existing zone
-                            self.highRiskZones[i]["riskScore"] *= 1.5
-                            self.highRiskZones[i]["predictedCongestion"] = True
-                            zone_already_added = True
-                            break
-
-                    # Add new high risk zone if not already added
-                    if not zone_already_added:
-                        zoneCentroid = (
-                            int(np.mean(zonePoly[:, 0])),
-                            int(np.mean(zonePoly[:, 1])),
-                        )
-                        riskScore = (
-                            zoneStats["averageDwellTime"] / self.highDwellThreshold
-                        ) * (count / self.highCongestionThreshold)
-                        self.highRiskZones.append(
-                            {
-                                "zoneID": zoneID,
-                                "zoneName": zoneName,
-                                "centroid": zoneCentroid,
-                                "averageDwellTime": zoneStats["averageDwellTime"],
-                                "congestionCount": count,
-                                "riskScore": riskScore,
-                                "predictedCongestion": True,
-                                "color": zoneColor,
-                            }
-                        )
+            for zoneID in np.flatnonzero(zoneHits):
+                self.flagPredictedZone(int(zoneID), count, riskZoneIndices)
+
+    def predictTrackZones(self, trackIDs, trackHistories, riskZoneIndices):
+        # Predict the trajectories of all current tracks in one pass, count the
+        # people in every zone at the end of the prediction horizon and flag the
+        # zones expected to hold at least highCongestionThreshold people
+        zoneCount = len(self.dwellTimeAnalysis.zones)
+        self.predictedZoneCounts = np.zeros(zoneCount, dtype=np.int64)
+        if self.opticalFlow is None or trackHistories is None or trackIDs is None:
+            return
+
+        currentTracks = {}
+        for trackID in trackIDs:
+            points = trackHistories.get(int(trackID))
+            if points is not None:
+                currentTracks[int(trackID)] = points
+        _, positions, velocities = self.opticalFlow.trackVelocities(currentTracks)
+        if not len(positions):
+            return
+
+        trajectories = self.opticalFlow.predictTrajectories(positions, velocities)
+        _, membership = self.predictZoneHits(trajectories)
+        self.predictedZoneCounts = membership[:, -1].sum(axis=0)
+
+        for zoneID in np.flatnonzero(
+            self.predictedZoneCounts >= self.highCongestionThreshold
+        ):
+            # Zones flagged by the predicted congestion are not raised twice
+            index = riskZoneIndices.get(int(zoneID))
+            if index is not None and self.highRiskZones[index]["predictedCongestion"]:
+                continue
+            self.flagPredictedZone(
+                int(zoneID), int(self.predictedZoneCounts[zoneID]), riskZoneIndices
+            )
+
+    def flagPredictedZone(self, zoneID, count, riskZoneIndices):
+        # Mark a zone with predicted congestion of count people as high risk if its
+        # dwell time is already high, riskZoneIndices maps the zone IDs to their
+        # index in highRiskZones and is updated when a zone is added
+        zoneStats = self.dwellTimeAnalysis.zoneStats[zoneID]
+        if zoneStats["averageDwellTime"] <= self.highDwellThreshold:
+            return
+
+        if zoneID in riskZoneIndices:
+            # Increase risk score for existing zone
+            riskZone = self.highRiskZones[riskZoneIndices[zoneID]]
+            riskZone["riskScore"] *= 1.5
+            riskZone["predictedCongestion"] = True
+            return
+
+        # Add new high risk zone if not already added
+        zoneName, zonePoly, zoneColor = self.dwellTimeAnalysis.zones[zoneID]
+        zoneCentroid = (int(np.mean(zonePoly[:, 0])), int(np.mean(zonePoly[:, 1])))
+        riskScore = (zoneStats["averageDwellTime"] / self.highDwellThreshold) * (
+            count / self.highCongestionThreshold
+        )
+        riskZoneIndices[zoneID] = len(self.highRiskZones)
+        self.highRiskZones.append(
+            {
+                "zoneID": zoneID,
+                "zoneName": zoneName,
+                "centroid": zoneCentroid,
+                "averageDwellTime": zoneStats["averageDwellTime"],
+                "congestionCount": count,
+                "riskScore": riskScore,
+                "predictedCongestion": True,
+                "color": zoneColor,
+            }
+        )
+
+    def predictZoneHits(self, trajectories):
+        # Floor plan coordinates and zone membership of camera points of any shape
+        # (..., 2), e.g. the (N, T, 2) trajectories of OpticalFlow.predictTrajectories
+        # Returns the (..., 2) floor points and a (..., zones) boolean array, a point
+        # in overlapping zones hits all of them
+        floorPoints = self.transformPointsToFloor(trajectories)
+        membership = self.dwellTimeAnalysis.getZoneMembership(floorPoints)
+        return floorPoints, membership.reshape(
+            floorPoints.shape[:-1] + (len(self.dwellTimeAnalysis.zones),)
+        )
+
+    def getZoneCentroids(self):
+        # (Z, 2) integer centroids of the zone polygons
+        return np.array(
+            [
+                (int(np.mean(zonePoly[:, 0])), int(np.mean(zonePoly[:, 1])))
+                for _, zonePoly, _ in self.dwellTimeAnalysis.zones
+            ],
+            dtype=np.float64,
+        ).reshape(-1, 2)
+
+    def transformPointsToFloor(self, cameraPoints):
+        # convert camera points of any shape (..., 2) to floor coordinates with a
+        # single product with the homography matrix
+        points = np.asarray(cameraPoints, dtype=np.float64)
+        flat = points.reshape(-1, 2)
+        projected = flat @ self.homographyMatrix[:, :2].T + self.homographyMatrix[:, 2]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            floorPoints = projected[:, :2] / projected[:, 2:]
+        return floorPoints.reshape(points.shape)
 
     def transformPointToFloor(self, cameraPoint):
         # convert camera point to floor coordinates using homography
-        pointArray = np.array([cameraPoint], dtype=np.float32).reshape(-1, 1, 2)
-        transformedPoint = cv2.perspectiveTransform(pointArray, self.homographyMatrix)[
-            0
-        ][0]
+        transformedPoint = self.transformPointsToFloor(cameraPoint)
         return (int(transformedPoint[0]), int(transformedPoint[1]))
 
     def transformPolygonToCamera(self, floorPolygon):
@@ -216,7 +431,13 @@ class Integration:
     def isPointInPolygon(self, zonePolygon, point):
         return cv2.pointPolygonTest(zonePolygon, tuple(map(int, point)), False) >= 0
 
-    def drawAnalytics(self, cameraFrame, floorFrame):
+    def drawAnalytics(self, cameraFrame, floorFrame, cameraOverlay=None):
+        # The risk zones on the camera view are drawn on an overlay layer that is
+        # blended in one pass, either by the caller or at the end of this function
+        composite = cameraOverlay is None
+        if composite:
+            cameraOverlay = OverlayLayer(cameraFrame.shape)
+
         # First draw dwell time information on the floor plan
         self.dwellTimeAnalysis.drawDwellTimes(floorFrame, None, None, True)
 
@@ -290,20 +511,17 @@ class Integration:
 
             # Draw on camera view if polygon transformation was successful
             if cameraPoly is not None:
-                # Create semi-transparent overlay
-                overlay = cameraFrame.copy()
-                cv2.fillPoly(overlay, [cameraPoly], riskColor)
-                cv2.addWeighted(overlay, 0.3, cameraFrame, 0.7, 0, cameraFrame)
+                # Fill the zone with a semi-transparent risk color
+                cameraOverlay.fillPoly([cameraPoly], riskColor, alpha=0.3)
 
                 # Draw polygon outline
-                cv2.polylines(cameraFrame, [cameraPoly], True, riskColor, 2)
+                cameraOverlay.polylines([cameraPoly], True, riskColor, 2)
 
                 # Calculate camera view centroid for labels
                 cameraCentroid = np.mean(cameraPoly, axis=0).astype(int)
 
                 # Draw labels on camera view
-                cv2.putText(
-                    cameraFrame,
+                cameraOverlay.putText(
                     label,
                     (cameraCentroid[0] - 80, cameraCentroid[1] - 15),
                     cv2.FONT_HERSHEY_SIMPLEX,
@@ -313,8 +531,7 @@ class Integration:
                 )
 
                 # Draw risk score on camera
-                cv2.putText(
-                    cameraFrame,
+                cameraOverlay.putText(
                     f"Risk: {riskScore:.1f}",
                     (cameraCentroid[0] - 50, cameraCentroid[1] + 15),
                     cv2.FONT_HERSHEY_SIMPLEX,
@@ -323,4 +540,7 @@ class Integration:
                     2,
                 )
 
+        if composite:
+            cameraOverlay.composite(cameraFrame)
+
         return cameraFrame, floorFrame
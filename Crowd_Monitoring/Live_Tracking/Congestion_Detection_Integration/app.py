@@ -1,4 +1,7 @@
-from flask import Flask, jsonify, Response, stream_with_context
+import math
+import time
+from datetime import datetime, timedelta, timezone
+from flask import Flask, jsonify, request, Response, stream_with_context
 from flask_cors import CORS
 from cameraProcessing import CameraProcessor
 from database import Database
@@ -9,11 +12,74 @@ cameraProcessor = CameraProcessor()
 db = Database()
 
 
-# routes for people count
+# routes for people count, congestion zones and dwell statistics
+# served from the in-memory snapshot of the processor, polling clients send the
+# ETag back in If-None-Match and get a 304 while nothing changed
 @app.route("/api/peopleCount", methods=["GET"])
 def getPeopleCount():
-    count = db.getlastestRecord()
-    return jsonify({"peopleCount": count})
+    cameraProcessor.startAnalytics()
+    snapshot = cameraProcessor.getSnapshot()
+    if snapshot is None:
+        return jsonify({"error": "No frame analysed yet"}), 503
+
+    sequence, etag, _, body = snapshot
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.headers["X-Sequence"] = str(sequence)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+# routes for the recorded people counts of the last minutes (default 60)
+@app.route("/api/peopleCount/history", methods=["GET"])
+def getPeopleCountHistory():
+    minutes = request.args.get("minutes", default=60, type=float)
+    since = datetime.now(timezone.utc) - timedelta(minutes=minutes)
+    return jsonify(db.getHistory(since))
+
+
+# routes for the structured analytics of the latest analysed frame
+# the camera is analysed headless, frames are only rendered for video clients
+@app.route("/api/analytics", methods=["GET"])
+def getAnalytics():
+    cameraProcessor.startAnalytics()
+    analytics = cameraProcessor.getAnalytics()
+    if analytics is None:
+        return jsonify({"error": "No frame analysed yet"}), 503
+    return jsonify(analytics)
+
+
+# routes for the historical zone aggregates between two unix timestamps
+# e.g. the peak occupancy of every zone during a match, answered from the rollups
+@app.route("/api/zoneHistory", methods=["GET"])
+def getZoneHistory():
+    end = request.args.get("end", default=time.time(), type=float)
+    start = request.args.get("start", default=end - 3600, type=float)
+    if not (math.isfinite(start) and math.isfinite(end)) or end < start:
+        return jsonify({"error": "start and end must be finite with start <= end"}), 400
+    zone = request.args.get("zone")
+    if request.args.get("timeline") and zone is not None:
+        timeline = cameraProcessor.rollupStore.timeline(
+            cameraProcessor.cameraName, zone, start, end
+        )
+        if timeline is None:
+            return jsonify({"error": f"Unknown zone: {zone}"}), 404
+        return jsonify(timeline)
+    return jsonify(cameraProcessor.rollupStore.query(start, end, zone=zone))
+
+
+# routes for the Server-Sent Events stream of the crowd analytics
+# the first event holds the full state, later events only the changes
+@app.route("/api/events", methods=["GET"])
+def events():
+    return Response(
+        stream_with_context(cameraProcessor.getEvents()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 # routes for main camera display
@@ -0,0 +1,37 @@
+import threading
+from mjpegStream import MJPEGStream
+
+
+class BroadcastHub:
+    def __init__(self, streamSettings=None):
+        # streams maps a channel name to the MJPEGStream serving it
+        # streamSettings optionally maps a channel name to its MJPEGStream arguments,
+        # e.g. {"camera": {"quality": 70, "width": 1280}}
+        self.streams = {}
+        self.streamSettings = streamSettings or {}
+        self.lock = threading.Lock()
+
+    def getStream(self, channel):
+        with self.lock:
+            if channel not in self.streams:
+                self.streams[channel] = MJPEGStream(
+                    **self.streamSettings.get(channel, {})
+                )
+            return self.streams[channel]
+
+    def configureStream(self, channel, quality=None, width=None, height=None):
+        self.getStream(channel).configure(quality, width, height)
+
+    def publish(self, channel, frame):
+        # Publish a raw frame, it is encoded once when the first client asks for it
+        self.getStream(channel).publish(frame)
+
+    def subscribe(self, channel):
+        return self.getStream(channel).subscribe()
+
+    def subscriberCount(self, channel=None):
+        if channel is not None:
+            return self.getStream(channel).subscriberCount()
+        with self.lock:
+            streams = list(self.streams.values())
+        return sum(stream.subscriberCount() for stream in streams)
@@ -0,0 +1,351 @@
+import sys
+import threading
+import time
+import numpy as np
+import yaml
+from ultralytics.trackers.byte_tracker import BYTETracker
+from ultralytics.utils import IterableSimpleNamespace
+from ultralytics.utils.checks import check_yaml
+from cameraProcessing import CameraProcessor
+from framePipeline import StageStats
+from rollupStore import RollupStore
+from detectorBackend import loadDetector
+
+
+class LatestSlot:
+    def __init__(self):
+        # Holds only the newest item, an item that is not taken before the next one
+        # arrives is dropped, so a slow consumer always works on fresh data
+        self.condition = threading.Condition()
+        self.item = None
+
+    def put(self, item):
+        # Returns True when an unconsumed item was dropped
+        with self.condition:
+            dropped = self.item is not None
+            self.item = item
+            self.condition.notify()
+            return dropped
+
+    def take(self):
+        with self.condition:
+            item, self.item = self.item, None
+            return item
+
+    def wait(self, timeout=None):
+        with self.condition:
+            self.condition.wait_for(lambda: self.item is not None, timeout=timeout)
+            item, self.item = self.item, None
+            return item
+
+    def ready(self):
+        with self.condition:
+            return self.item is not None
+
+
+class ManagedCamera:
+    def __init__(self, name, processor, tracker):
+        # frames holds the newest captured frame waiting for detection
+        # detections holds the newest tracked frame waiting for the analytics
+        self.name = name
+        self.processor = processor
+        self.tracker = tracker
+        self.frames = LatestSlot()
+        self.detections = LatestSlot()
+        self.stats = {
+            "capture": StageStats("capture"),
+            "detection": StageStats("detection"),
+            "analytics": StageStats("analytics"),
+        }
+
+
+class CameraManager:
+    def __init__(
+        self,
+        modelPath="yolov8n.pt",
+        batchSize=8,
+        imgsz=640,
+        confidence=0.25,
+        trackerConfig="bytetrack.yaml",
+        backend="torch",
+        **processorOptions,
+    ):
+        # One detector serves every camera, frames of up to batchSize cameras are
+        # detected in a single inference call
+        # Every camera keeps its own tracker, homography and analytics state
+        # backend selects PyTorch or an ONNX Runtime or OpenVINO export of the model,
+        # see detectorBackend.py
+        # processorOptions are passed on to every CameraProcessor
+        self.model = loadDetector(modelPath, backend, imgsz)
+        self.batchSize = batchSize
+        self.imgsz = imgsz
+        self.confidence = confidence
+        self.trackerConfig = trackerConfig
+        self.processorOptions = processorOptions
+
+        self.cameras = []
+        self.camerasByName = {}
+        # Zone history of all cameras, queried across cameras
+        self.rollupStore = RollupStore()
+
+        # nextCamera is where the next batch starts looking for frames, so every
+        # camera gets its turn when more cameras have frames than fit in a batch
+        self.nextCamera = 0
+        self.frameReady = threading.Condition()
+        self.batchStats = StageStats("batch")
+        self.batchedFrames = 0
+
+        self.running = False
+        self.startLock = threading.Lock()
+        self.threads = []
+
+    def addCamera(self, name, source, homographyPoints=None, **options):
+        # Register a camera, its CameraProcessor shares the detector of the manager
+        processorOptions = dict(self.processorOptions)
+        processorOptions.update(options)
+        processor = CameraProcessor(
+            source=source,
+            model=self.model,
+            homographyPoints=homographyPoints,
+            cameraName=name,
+            rollupStore=self.rollupStore,
+            **processorOptions,
+        )
+        processor.manager = self
+        # Regions without their own inference size keep the pixel density of the
+        # manager inference size
+        processor.regionOfInterest.baseImgsz = self.imgsz
+
+        camera = ManagedCamera(name, processor, self.createTracker())
+        self.cameras.append(camera)
+        self.camerasByName[name] = camera
+        if self.running:
+            self.startCameraThreads(camera)
+        return processor
+
+    def createTracker(self):
+        # The same tracker settings YOLO.track uses, one tracker per camera
+        with open(check_yaml(self.trackerConfig)) as file:
+            settings = IterableSimpleNamespace(**yaml.safe_load(file))
+        return BYTETracker(settings)
+
+    def getProcessor(self, name):
+        return self.camerasByName[name].processor
+
+    def start(self):
+        with self.startLock:
+            if self.running:
+                return
+
+            self.running = True
+            self.threads = [
+                threading.Thread(
+                    target=self.inferenceWorker, name="inference", daemon=True
+                )
+            ]
+            self.threads[0].start()
+            for camera in self.cameras:
+                self.startCameraThreads(camera)
+
+    def startCameraThreads(self, camera):
+        for target, name in (
+            (self.captureWorker, "capture"),
+            (self.analyticsWorker, "analytics"),
+        ):
+            thread = threading.Thread(
+                target=target, args=(camera,), name=f"{camera.name}-{name}", daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout=2.0):
+        self.running = False
+        with self.frameReady:
+            self.frameReady.notify_all()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def captureWorker(self, camera):
+        stats = camera.stats["capture"]
+
+        while self.running:
+            startTime = time.perf_counter()
+            success, frame = camera.processor.cap.read()
+            if not success:
+                stats.recordError()
+                time.sleep(0.01)
+                continue
+            stats.record(time.perf_counter() - startTime)
+
+            # Only the newest frame of every camera waits for detection
+            if camera.frames.put(frame):
+                camera.stats["detection"].recordDrop()
+            with self.frameReady:
+                self.frameReady.notify()
+
+    def hasFrames(self):
+        return not self.running or any(camera.frames.ready() for camera in self.cameras)
+
+    def selectBatch(self):
+        # Round robin over the cameras with at most one frame per camera, starting
+        # after the last camera that was looked at for the previous batch
+        batch = []
+        count = len(self.cameras)
+        for offset in range(count):
+            camera = self.cameras[(self.nextCamera + offset) % count]
+            frame = camera.frames.take()
+            if frame is not None:
+                batch.append((camera, frame))
+                if len(batch) == self.batchSize:
+                    break
+        if count:
+            self.nextCamera = (self.nextCamera + offset + 1) % count
+        return batch
+
+    def groupBySize(self, batch):
+        # Crop every frame to the region of interest of its camera and group the
+        # crops by inference size, each group is detected in one forward pass
+        # Sizes are rounded up to multiples of 128, so cameras with similar regions
+        # still share a batch
+        groups = {}
+        for camera, frame in batch:
+            region, imgsz = camera.processor.regionOfInterest.crop(frame)
+            imgsz = int(np.ceil(imgsz / 128) * 128)
+            groups.setdefault(imgsz, []).append((camera, frame, region))
+        return groups
+
+    def inferenceWorker(self):
+        while self.running:
+            with self.frameReady:
+                self.frameReady.wait_for(self.hasFrames, timeout=0.5)
+            batch = self.selectBatch()
+            if not batch:
+                continue
+
+            # One forward pass for the frames of all selected cameras that share
+            # an inference size
+            for imgsz, group in self.groupBySize(batch).items():
+                self.detectGroup(imgsz, group)
+
+    def detectGroup(self, imgsz, group):
+        startTime = time.perf_counter()
+        try:
+            results = self.model.predict(
+                [region for _, _, region in group],
+                imgsz=imgsz,
+                conf=self.confidence,
+                classes=[0],
+                verbose=False,
+            )
+        except Exception as e:
+            print(f"Batched detection failed: {e}")
+            self.batchStats.recordError()
+            return
+        latency = time.perf_counter() - startTime
+        self.batchStats.record(latency)
+        self.batchedFrames += len(group)
+
+        # Route the detections back to the tracker and analytics of each camera
+        for (camera, frame, region), result in zip(group, results):
+            camera.stats["detection"].record(latency)
+            try:
+                boxes, trackIDs = self.updateTracker(camera, result, region)
+                boxes = camera.processor.regionOfInterest.mapBoxes(boxes)
+            except Exception as e:
+                print(f"Tracking failed for camera '{camera.name}': {e}")
+                camera.stats["detection"].recordError()
+                continue
+            if camera.detections.put((frame, boxes, trackIDs)):
+                camera.stats["analytics"].recordDrop()
+
+    def updateTracker(self, camera, result, frame):
+        # Returns the (x, y, w, h) centre boxes and IDs of the tracked people, in the
+        # coordinates of the detected frame region
+        tracks = camera.tracker.update(result.boxes.cpu().numpy(), frame)
+        if len(tracks) == 0:
+            return np.empty((0, 4), dtype=np.float32), np.empty(0, dtype=int)
+
+        x1, y1, x2, y2 = tracks[:, 0], tracks[:, 1], tracks[:, 2], tracks[:, 3]
+        boxes = np.stack([(x1 + x2) / 2, (y1 + y2) / 2, x2 - x1, y2 - y1], axis=1)
+        return boxes, tracks[:, 4].astype(int)
+
+    def analyticsWorker(self, camera):
+        processor = camera.processor
+        stats = camera.stats["analytics"]
+
+        while self.running:
+            item = camera.detections.wait(timeout=0.5)
+            if item is None:
+                continue
+
+            startTime = time.perf_counter()
+            frame, boxes, trackIDs = item
+            try:
+                frameData = processor.analyseFrame(
+                    processor.applyDetections(frame, boxes, trackIDs)
+                )
+
+                # Frames are only rendered when somebody is watching this camera
+                frames = processor.renderIfWatched(frameData)
+                if frames is not None:
+                    processor.storeDisplayFrames(frames)
+            except Exception as e:
+                print(f"Analytics failed for camera '{camera.name}': {e}")
+                stats.recordError()
+                continue
+            stats.record(time.perf_counter() - startTime)
+
+    def getStats(self):
+        batches = self.batchStats.snapshot()
+        batches["averageBatchSize"] = (
+            self.batchedFrames / batches["processed"] if batches["processed"] else 0
+        )
+        cameras = {}
+        for camera in self.cameras:
+            cameras[camera.name] = {
+                name: stageStats.snapshot() for name, stageStats in camera.stats.items()
+            }
+        return {"batches": batches, "cameras": cameras}
+
+    def printStats(self):
+        stats = self.getStats()
+        batches = stats["batches"]
+        print(
+            f"batches: fps={batches['fps']:.1f} "
+            f"avg={batches['avgLatencyMs']:.1f}ms "
+            f"size={batches['averageBatchSize']:.1f}"
+        )
+        for name, cameraStats in stats["cameras"].items():
+            print(
+                f"{name:>12}: "
+                f"captured={cameraStats['capture']['processed']} "
+                f"detected={cameraStats['detection']['processed']} "
+                f"dropped before detection={cameraStats['detection']['dropped']} "
+                f"analysed={cameraStats['analytics']['processed']} "
+                f"dropped before analytics={cameraStats['analytics']['dropped']}"
+            )
+
+    def release(self):
+        self.stop()
+        for camera in self.cameras:
+            camera.processor.manager = None
+            camera.processor.release()
+
+
+if __name__ == "__main__":
+    # Usage: python cameraManager.py <source> [<source> ...]
+    # Sources are camera indices, video files or RTSP URLs
+    manager = CameraManager()
+    for index, source in enumerate(sys.argv[1:] or ["0"]):
+        manager.addCamera(f"camera{index}", int(source) if source.isdigit() else source)
+
+    manager.start()
+    try:
+        while True:
+            time.sleep(10)
+            manager.printStats()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        manager.release()
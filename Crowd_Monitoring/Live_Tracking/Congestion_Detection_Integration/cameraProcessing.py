@@ -1,20 +1,57 @@
 import cv2
 import numpy as np
-from ultralytics import YOLO
-from collections import defaultdict
 from utils import calculateHomography, transformPoints
 
 # from database import Database
 from floorReplica import floorReplica
 import time as time_module
+import threading
+import multiprocessing
+import queue
+from framePipeline import FramePipeline
+from broadcastHub import BroadcastHub
 from opticalFlow import OpticalFlow
 from congestionDetection import CongestionDetection
 from dwellTime import DwellTimeAnalysis
 from Integration import Integration
+from trackStore import TrackStore
+from trailRenderer import TrailRenderer
+from layerCompositor import OverlayLayer
+from regionOfInterest import RegionOfInterest
+from stateSnapshot import StateSnapshot
+from eventStream import EventStream
+from rollupStore import RollupStore
+from sharedFrameRing import SharedFrameRing
+from frameProcesses import CAPTURE_STATS, captureFrames, renderFrames
+from resilientCapture import ResilientCapture
+from detectorBackend import loadDetector
 
 
 class CameraProcessor:
-    def __init__(self):
+    def __init__(
+        self,
+        pipelineMode=False,
+        pipelineQueueSize=2,
+        flowMode="dense",
+        flowDownscale=0.25,
+        congestionMode="cluster",
+        trackTTL=10.0,
+        maxTracks=1000,
+        source=0,
+        model=None,
+        homographyPoints=None,
+        detectionRegion="homography",
+        detectionSize=None,
+        cameraName="camera",
+        rollupStore=None,
+        processMode=False,
+        renderProcess=False,
+        ringSlots=4,
+        capture=None,
+        detectorBackend="torch",
+        integrationInterval=0.0,
+        clock=time_module.time,
+    ):
         # initialize the YOLO model
         # RTSP stream URL for the video feed
         # trackHistory is a dictionary to store the movement history of each person
@@ -22,12 +59,38 @@ class CameraProcessor:
         # homographyMatrix is the homography matrix for transforming points
         # db is an instance of the Database class
         # lastRecorded is the timestamp of the last recorded data
-        self.model = YOLO("yolov8n.pt")
-        self.rtspUrl = 0
-        self.cap = cv2.VideoCapture(self.rtspUrl)
-        self.trackHistory = defaultdict(list)
-        self.floorImage = floorReplica(1000, 700, 25, 15, self.rtspUrl)
+        # model can be shared between cameras, e.g. by the CameraManager which runs
+        # the detection of all its cameras in one batch
+        # homographyPoints optionally gives the (source, destination) points of this camera
+        # detectionRegion is the camera polygon the detector runs on, "homography" uses
+        # the homography source points and None the whole frame
+        # detectionSize is the inference size of the region, None keeps the pixel
+        # density of a 1280 inference on the whole frame
+        # rollupStore keeps the zone history under cameraName, it can be shared by
+        # several cameras, e.g. by the CameraManager
+        # capture optionally replaces the ResilientCapture of the source, which reads
+        # the newest frame on its own thread and reconnects lost streams
+        # detectorBackend runs the detector with PyTorch ("torch") or exported to
+        # ONNX Runtime or OpenVINO ("onnx", "onnx-int8", "openvino", "openvino-int8")
+        # integrationInterval is how often in seconds the integration analysis and
+        # floor prediction run, the default runs them on every analysed frame
+        # clock returns the current time in seconds for the analytics stage, e.g. the
+        # video time of a replay, so the track TTL and dwell times follow the video
+        self.clock = clock
+        self.model = (
+            loadDetector("yolov8n.pt", detectorBackend) if model is None else model
+        )
+        self.rtspUrl = source
+        self.cap = ResilientCapture(self.rtspUrl) if capture is None else capture
+        # trackHistory keeps the last 50 positions per track in fixed size ring buffers
+        # and evicts tracks that have not been seen for trackTTL seconds
+        self.trackHistory = TrackStore(capacity=50, maxTracks=maxTracks, ttl=trackTTL)
+        self.floorImage = floorReplica(1000, 700, 25, 15)
+        self.homographyPoints = homographyPoints
         self.homographyMatrix = self.calculateHomography()
+        if isinstance(detectionRegion, str) and detectionRegion == "homography":
+            detectionRegion = self.homographySource
+        self.regionOfInterest = RegionOfInterest(detectionRegion, imgsz=detectionSize)
         # self.db = Database()
         # self.lastRecorded = 0
 
@@ -38,9 +101,47 @@ class CameraProcessor:
         self.congestionDetection = CongestionDetection(
             self.homographyMatrix, debug=True
         )
-        self.opticalFlow = OpticalFlow(predictionStep=5, predictionScale=3)
-        self.dwellTimeAnalysis = DwellTimeAnalysis(self.homographyMatrix)
-        self.integration = Integration(self.congestionDetection, self.dwellTimeAnalysis)
+
+        # congestionMode "grid" detects congestion on an incremental floor plan
+        # density grid instead of clustering the camera positions every frame
+        self.congestionMode = congestionMode
+        if congestionMode == "grid":
+            self.congestionDetection.enableDensityGrid(700, 1000)
+        # flowMode selects dense, downscaled or sparse optical flow for this camera
+        self.opticalFlow = OpticalFlow(
+            predictionStep=5,
+            predictionScale=3,
+            mode=flowMode,
+            downscale=flowDownscale,
+        )
+        self.lastPositions = []
+        self.dwellTimeAnalysis = DwellTimeAnalysis(self.homographyMatrix, clock=clock)
+        self.cameraName = cameraName
+        self.rollupStore = RollupStore() if rollupStore is None else rollupStore
+        self.integration = Integration(
+            self.congestionDetection,
+            self.dwellTimeAnalysis,
+            self.rollupStore,
+            cameraName,
+            updateInterval=integrationInterval,
+            opticalFlow=self.opticalFlow,
+            clock=clock,
+        )
+
+        # Floor plan trails are transformed once per point and cached per track
+        self.trailRenderer = TrailRenderer(
+            self.homographyMatrix, capacity=50, maxTracks=maxTracks, ttl=trackTTL
+        )
+
+        # Reusable overlay layers for the translucent drawings of the render stage
+        self.cameraOverlay = OverlayLayer()
+        self.floorOverlay = OverlayLayer()
+
+        # Drop the per-track analytics state together with evicted tracks
+        self.trackHistory.onEvict(self.dwellTimeAnalysis.removeTracks)
+        self.trackHistory.onEvict(self.trailRenderer.removeTracks)
+        if self.congestionDetection.densityGrid is not None:
+            self.trackHistory.onEvict(self.congestionDetection.densityGrid.removeTracks)
 
         # Visualization settings
         self.lastFlowVisualizationTime = 0
@@ -57,227 +158,359 @@ class CameraProcessor:
             "integration"  # Options: "basic", "congestion", "dwell", "integration"
         )
 
+        # Staged pipeline settings
+        # pipelineMode runs capture, detection, analytics and rendering on separate threads
+        # analyticsLock guards the analytics state shared by the analytics and render stages
+        self.pipelineMode = pipelineMode
+        self.pipelineQueueSize = pipelineQueueSize
+        self.pipeline = None
+        self.analyticsLock = threading.Lock()
+        self.displayLock = threading.Lock()
+        self.displayFrames = None
+        self.lastStatsTime = 0
+        self.statsInterval = 10  # Print pipeline stats every 10 seconds
+
+        # Multi-process settings
+        # processMode decodes the frames in a separate capture process, which writes
+        # them into a shared memory ring read here without copies, so the capture
+        # never competes with the analytics for the GIL
+        # renderProcess also draws and shows the frames in a separate process
+        # ringSlots is the number of frame slots of the ring
+        self.processMode = processMode
+        self.renderProcess = renderProcess
+        self.ringSlots = ringSlots
+        self.frameRing = None
+        self.processes = []
+        self.renderQueue = None
+        self.commandQueue = None
+        self.processesRunning = False
+        # Capture counters published by the capture process
+        self.captureStats = None
+
+        # Single processing loop shared by all MJPEG clients
+        # the hub holds the latest camera and floor plan JPEGs for every subscriber
+        self.broadcastHub = BroadcastHub(
+            {"camera": {"quality": 80}, "floor": {"quality": 80}}
+        )
+        self.broadcastLock = threading.Lock()
+        self.broadcastThread = None
+        self.broadcasting = False
+        # CameraManager driving this processor, if any
+        self.manager = None
+
+        # Headless analytics: frames are only rendered when a window is open or an
+        # MJPEG client is subscribed, the structured results are always produced
+        # showWindow is set while the frames are displayed with cv2.imshow
+        self.showWindow = False
+        self.resultsLock = threading.Lock()
+        self.latestAnalytics = None
+        # Latest count, congestion zones and dwell statistics served by the API
+        self.snapshot = StateSnapshot()
+        # Compact deltas of every integration update pushed to the event clients
+        self.eventStream = EventStream()
+        self.integration.onUpdate(self.eventStream.publish)
+        self.renderedFrames = 0
+        self.skippedRenders = 0
+
     # Function to calculate the homography matrix
     def calculateHomography(self):
-        ptsSRC = np.array(
-            [[28, 1158], [2120, 1112], [1840, 488], [350, 518], [468, 1144]]
-        )
-        ptsDST = np.array([[0, 990], [699, 988], [693, 658], [0, 661], [141, 988]])
+        # The source points are kept, they also outline the detection region
+        if self.homographyPoints is not None:
+            ptsSRC, ptsDST = (np.array(points) for points in self.homographyPoints)
+        else:
+            ptsSRC = np.array(
+                [[28, 1158], [2120, 1112], [1840, 488], [350, 518], [468, 1144]]
+            )
+            ptsDST = np.array([[0, 990], [699, 988], [693, 658], [0, 661], [141, 988]])
+        self.homographySource = ptsSRC
         return calculateHomography(ptsSRC, ptsDST)
 
-    def processFrame(self, frame):
-        # Calculate optical flow for this frame
-        # and initialise the current position list to store the current positions of detected people
-        # and track IDs to store the IDs of detected people
-        flow = self.opticalFlow.calculateFlow(frame)
-        currentPositions = []
-        trackIDs = []
+    def newFrameData(self, frame):
+        # The dictionary passed from the detection to the analytics and render stages
+        return {
+            "frame": frame,
+            "flow": None,
+            "boxes": None,
+            "trackIDs": None,
+            "error": None,
+        }
 
-        # Check if it's time to update the flow visualization based on the interval
-        currentTime = time_module.time()
-
-        # Start visualization if interval has passed
-        if (
-            currentTime - self.lastFlowVisualizationTime
-            >= self.flowVisualizationInterval
-        ):
-            self.showFlowVisualization = True
-            self.lastFlowVisualizationTime = currentTime
+    def calculateFlow(self, frameData):
+        # Calculate optical flow for this frame
+        # sparse mode only tracks the positions from the previous frame
+        frameData["flow"] = self.opticalFlow.calculateFlow(
+            frameData["frame"], self.lastPositions
+        )
 
-        # Create copies of the frame for annotations
-        # and initialise the total people count
-        annotatedFrame = frame.copy()
-        floorAnnotatedFrame = self.floorImage.copy()
-        totalPeople = 0
+    def detectFrame(self, frame):
+        # Detection stage: optical flow and YOLO tracking for a single frame
+        # The returned dictionary is passed on to the analytics and render stages
+        frameData = self.newFrameData(frame)
 
         try:
+            self.calculateFlow(frameData)
+
+            # Only the region of interest is detected, at its own inference size
+            region, imgsz = self.regionOfInterest.crop(frame)
             results = self.model.track(
-                frame, persist=True, show=False, imgsz=1280, verbose=False
+                region, persist=True, show=False, imgsz=imgsz, verbose=False
             )
 
-            # # Get predicted positions based on optical flow
-            # predictedPositions = {}
-            # if flow is not None and self.showFlowVisualization:
-            #     predictedPositions = self.opticalFlow.predictPosition(
-            #         self.trackHistory, flow
-            #     )
-
             # verify if the bounding boxes were detected and having the id attribute
             # get the boxes coordinates, track IDs and classes
-            if results[0].boxes is not None and hasattr(results[0].boxes, "id"):
-                boxes = results[0].boxes.xywh.cpu().numpy()
+            if results[0].boxes is not None and results[0].boxes.id is not None:
+                boxes = self.regionOfInterest.mapBoxes(
+                    results[0].boxes.xywh.cpu().numpy()
+                )
                 trackIDs = results[0].boxes.id.int().cpu().numpy()
                 classes = results[0].boxes.cls.cpu().numpy()
 
                 # Filter for human detections (assuming 'person' class is 0)
-                human_indices = classes == 0
-                human_boxes = boxes[human_indices]
-                human_trackIDs = trackIDs[human_indices]
+                humanIndices = classes == 0
+                frameData["boxes"] = boxes[humanIndices]
+                frameData["trackIDs"] = trackIDs[humanIndices]
+
+        except Exception as e:
+            frameData["error"] = str(e)
+
+        return frameData
+
+    def applyDetections(self, frame, boxes, trackIDs):
+        # Detection stage for tracks produced outside this processor, e.g. by the
+        # CameraManager, boxes are (x, y, w, h) centre boxes of people
+        frameData = self.newFrameData(frame)
 
+        try:
+            self.calculateFlow(frameData)
+            if len(boxes):
+                frameData["boxes"] = np.asarray(boxes)
+                frameData["trackIDs"] = np.asarray(trackIDs).astype(int)
+
+        except Exception as e:
+            frameData["error"] = str(e)
+
+        return frameData
+
+    def analyseFrame(self, frameData):
+        # Analytics stage: track history, congestion, dwell time and integration
+        # Trails are copied into the frame data so the render stage never reads
+        # the track history while this stage is updating it
+        frameData["analysisMode"] = self.analysisMode
+        frameData["positions"] = []
+        frameData["trails"] = []
+        frameData["futureCongestion"] = []
+        frameData["highRiskZones"] = []
+
+        if frameData["error"] is not None:
+            return frameData
+
+        # A frame without detections runs the same bookkeeping with no people, so
+        # departed tracks are evicted and the empty zones reach the rollup history
+        boxes = frameData["boxes"]
+        humanTrackIDs = frameData["trackIDs"]
+        if boxes is None:
+            boxes = np.empty((0, 4), dtype=np.float32)
+            humanTrackIDs = np.empty(0, dtype=int)
+
+        try:
+            with self.analyticsLock:
                 # Store current positions of all detected people
                 currentPositions = []
 
+                currentTime = self.clock()
+
                 # Process each tracked person
-                for idx, trackID in enumerate(human_trackIDs):
-                    # Get box dimensions
-                    x, y, w, h = human_boxes[idx]
+                for (x, y, w, h), trackID in zip(boxes, humanTrackIDs):
                     # Define center point (feet position)
                     center = (int(x), int(y + h / 2))
 
                     # Add to current positions and tracking history
                     currentPositions.append(center)
-                    self.trackHistory[trackID].append(center)
+                    self.trackHistory.append(int(trackID), center, currentTime)
 
-                    # Limit history length
-                    if len(self.trackHistory[trackID]) > 50:
-                        self.trackHistory[trackID].pop(0)
+                # Forget the people who left the scene
+                self.trackHistory.evictStale(currentTime)
 
-                    # Draw history trails
-                    history = self.trackHistory[trackID]
-                    if len(history) > 1:
-                        points = np.array(history, dtype=np.int32)
+                # Transform only the new points to the floor plan and copy the trails
+                floorPositions = self.trailRenderer.update(
+                    humanTrackIDs, currentPositions, currentTime
+                )
+                frameData["trails"] = self.trailRenderer.getTrails(humanTrackIDs)
 
-                        # Transform points to floor coordinates
-                        floorPoints = transformPoints(points, self.homographyMatrix)
-                        floorPoints = floorPoints.astype(np.int32)
+                frameData["positions"] = currentPositions
+                self.lastPositions = currentPositions
+                analysisMode = frameData["analysisMode"]
+                flow = frameData["flow"]
 
-                        # Draw the history trail on floor plan
-                        cv2.polylines(
-                            floorAnnotatedFrame,
-                            [floorPoints],
-                            isClosed=False,
-                            color=(0, 0, 255),
-                            thickness=2,
-                        )
+                # Update the density grid with the floor positions of everybody in view
+                floorCongestionZones = None
+                if self.congestionMode == "grid":
+                    floorCongestionZones = self.congestionDetection.updateDensityGrid(
+                        humanTrackIDs, floorPositions
+                    )
 
-                    # Draw bounding box and ID on the original frame
-                    cv2.rectangle(
-                        annotatedFrame,
-                        (int(x - w / 2), int(y - h / 2)),
-                        (int(x + w / 2), int(y + h / 2)),
-                        (0, 255, 0),
-                        2,
+                if analysisMode == "basic" or analysisMode == "congestion":
+                    # Predict future congestion
+                    frameData["futureCongestion"] = (
+                        self.congestionDetection.predictCongestionZones(
+                            currentPositions, flow
+                        )
                     )
-                    cv2.putText(
-                        annotatedFrame,
-                        f"ID: {int(trackID)}",
-                        (int(x - w / 2), int(y - h / 2) - 10),
-                        cv2.FONT_HERSHEY_SIMPLEX,
-                        0.5,
-                        (0, 255, 0),
-                        2,
+
+                if analysisMode == "basic" or analysisMode == "dwell":
+                    # Update dwell time analysis
+                    self.dwellTimeAnalysis.updateZones(currentPositions, humanTrackIDs)
+
+                if analysisMode == "integration":
+                    # Run the integrated analysis which combines congestion and dwell time
+                    frameData["highRiskZones"] = self.integration.update(
+                        currentPositions,
+                        humanTrackIDs,
+                        flow,
+                        floorCongestionZones,
+                        self.trackHistory,
                     )
 
-                    # # Show predicted trajectories when flow visualization is active
-                    # if self.showFlowVisualization and trackID in predictedPositions:
-                    #     # Get predicted position
-                    #     pred_x, pred_y = predictedPositions[trackID]
-                    #     cv2.circle(
-                    #         annotatedFrame, (pred_x, pred_y), 5, (0, 255, 255), -1
-                    #     )  # Yellow dot
-
-                    #     # Calculate and draw trajectory
-                    #     trajectory = self.opticalFlow.predictTrajectory(
-                    #         trackID, history, predictedPositions[trackID]
-                    #     )
-
-                    #     if len(trajectory) >= 2:
-                    #         # Draw predicted path on camera view
-                    #         points = np.array(trajectory, dtype=np.int32)
-                    #         cv2.polylines(
-                    #             annotatedFrame,
-                    #             [points],
-                    #             isClosed=False,
-                    #             color=(0, 255, 255),
-                    #             thickness=2,
-                    #         )
-
-                    #         # Add direction arrow
-                    #         last_point = trajectory[-2]
-                    #         end_point = trajectory[-1]
-                    #         cv2.arrowedLine(
-                    #             annotatedFrame,
-                    #             (int(last_point[0]), int(last_point[1])),
-                    #             (int(end_point[0]), int(end_point[1])),
-                    #             (0, 255, 255),
-                    #             3,
-                    #             tipLength=0.5,
-                    #         )
-
-                    #         # Draw on floor plan too
-                    #         floorTrajectory = transformPoints(
-                    #             np.array(trajectory), self.homographyMatrix
-                    #         )
-                    #         floorTrajectory = floorTrajectory.astype(np.int32)
-                    #         cv2.polylines(
-                    #             floorAnnotatedFrame,
-                    #             [floorTrajectory],
-                    #             isClosed=False,
-                    #             color=(0, 255, 255),
-                    #             thickness=2,
-                    #         )
-
-                    #         # Add arrow on floor plan
-                    #         if len(floorTrajectory) >= 2:
-                    #             floor_last = floorTrajectory[-2]
-                    #             floor_end = floorTrajectory[-1]
-                    #             cv2.arrowedLine(
-                    #                 floorAnnotatedFrame,
-                    #                 (int(floor_last[0]), int(floor_last[1])),
-                    #                 (int(floor_end[0]), int(floor_end[1])),
-                    #                 (0, 255, 255),
-                    #                 3,
-                    #                 tipLength=0.5,
-                    #             )
+                analytics = self.buildAnalytics(
+                    frameData, floorPositions, floorCongestionZones
+                )
+                frameData["analytics"] = analytics
 
-                    totalPeople += 1
+            self.publishAnalytics(analytics)
 
-                # Process different analysis modes
-                if self.analysisMode == "basic" or self.analysisMode == "congestion":
-                    # Run congestion detection
-                    self.congestionDetection.drawCongestionZones(
-                        annotatedFrame, floorAnnotatedFrame, transformPoints
-                    )
+        except Exception as e:
+            frameData["error"] = str(e)
 
-                    # Predict future congestion
-                    futureCongestion = self.congestionDetection.predictCongestionZones(
-                        currentPositions, flow
-                    )
+        return frameData
 
-                    # Draw predicted congestion
-                    self.congestionDetection.drawPredictedCongestion(
-                        annotatedFrame, futureCongestion
-                    )
+    def buildAnalytics(self, frameData, floorPositions, floorCongestionZones):
+        # Structured, JSON serialisable results of the analytics stage
+        # Must be called while holding the analytics lock
+        def toZone(zone):
+            center, radius, count = zone
+            return {
+                "center": [int(center[0]), int(center[1])],
+                "radius": int(radius),
+                "count": int(count),
+            }
 
-                if self.analysisMode == "basic" or self.analysisMode == "dwell":
-                    # Update and visualize dwell time analysis
-                    self.dwellTimeAnalysis.updateZones(currentPositions, human_trackIDs)
+        trackIDs = frameData["trackIDs"]
+        if trackIDs is None:
+            trackIDs = []
 
-                    # Draw dwell time zones on both camera and floor frame
-                    if self.showDwellTime:
-                        floorAnnotatedFrame = self.dwellTimeAnalysis.drawDwellTimes(
-                            floorAnnotatedFrame, currentPositions, human_trackIDs, True
-                        )
-                        annotatedFrame = self.dwellTimeAnalysis.drawDwellTimes(
-                            annotatedFrame, currentPositions, human_trackIDs, False
-                        )
+        # People predicted in every zone by the trajectories of the integration
+        predictedZoneCounts = self.integration.predictedZoneCounts
+        zoneStats = []
+        for zoneID, (zoneName, _, _) in enumerate(self.dwellTimeAnalysis.zones):
+            stats = self.dwellTimeAnalysis.zoneStats[zoneID]
+            zoneStats.append(
+                {
+                    "zoneID": zoneID,
+                    "zoneName": zoneName,
+                    "currentCount": int(stats["currentCount"]),
+                    "totalVisits": int(stats["totalVisits"]),
+                    "averageDwellTime": float(stats["averageDwellTime"]),
+                    "maxDwellTime": float(stats["maxDwellTime"]),
+                    "predictedCount": (
+                        int(predictedZoneCounts[zoneID])
+                        if zoneID < len(predictedZoneCounts)
+                        else 0
+                    ),
+                }
+            )
 
-                if self.analysisMode == "integration":
-                    # Run the integrated analysis which combines congestion and dwell time
-                    highRiskZones = self.integration.update(
-                        currentPositions, human_trackIDs, flow
-                    )
+        highRiskZones = []
+        for riskZone in frameData["highRiskZones"]:
+            highRiskZones.append(
+                {
+                    "zoneID": int(riskZone["zoneID"]),
+                    "zoneName": riskZone["zoneName"],
+                    "centroid": [int(value) for value in riskZone["centroid"]],
+                    "averageDwellTime": float(riskZone["averageDwellTime"]),
+                    "congestionCount": int(riskZone["congestionCount"]),
+                    "riskScore": float(riskZone["riskScore"]),
+                    "predictedCongestion": bool(riskZone["predictedCongestion"]),
+                }
+            )
 
-                    # Display integration visualization
-                    if self.showIntegration:
-                        # Draw analytics on both camera and floor views
-                        annotatedFrame, floorAnnotatedFrame = (
-                            self.integration.drawAnalytics(
-                                annotatedFrame, floorAnnotatedFrame
-                            )
-                        )
+        return {
+            "timestamp": self.clock(),
+            "analysisMode": frameData["analysisMode"],
+            "peopleCount": len(frameData["positions"]),
+            "people": [
+                {
+                    "trackID": int(trackID),
+                    "position": [int(position[0]), int(position[1])],
+                    "floorPosition": [float(floorPosition[0]), float(floorPosition[1])],
+                }
+                for trackID, position, floorPosition in zip(
+                    trackIDs, frameData["positions"], floorPositions
+                )
+            ],
+            "congestionZones": [
+                toZone(zone) for zone in self.congestionDetection.congestionZones
+            ],
+            "floorCongestionZones": [
+                toZone(zone) for zone in floorCongestionZones or []
+            ],
+            "predictedCongestion": [
+                toZone(zone) for zone in frameData["futureCongestion"]
+            ],
+            "zoneStats": zoneStats,
+            "highRiskZones": highRiskZones,
+        }
 
-            else:
+    def publishAnalytics(self, analytics):
+        with self.resultsLock:
+            self.latestAnalytics = analytics
+
+        # The summary only changes when the count, a zone or a statistic changes
+        self.snapshot.publish(
+            {
+                "peopleCount": analytics["peopleCount"],
+                "analysisMode": analytics["analysisMode"],
+                "congestionZones": analytics["congestionZones"],
+                "floorCongestionZones": analytics["floorCongestionZones"],
+                "predictedCongestion": analytics["predictedCongestion"],
+                "zoneStats": analytics["zoneStats"],
+                "highRiskZones": analytics["highRiskZones"],
+            }
+        )
+
+    def getSnapshot(self):
+        # Latest (sequence, etag, summary, body), None until the first frame was analysed
+        return self.snapshot.get()
+
+    def getAnalytics(self):
+        # Latest structured analytics, None until the first frame was analysed
+        with self.resultsLock:
+            return self.latestAnalytics
+
+    def isWatched(self):
+        # Rendering is only needed when somebody looks at the frames
+        return self.showWindow or self.broadcastHub.subscriberCount() > 0
+
+    def renderIfWatched(self, frameData):
+        # Render stage of the headless mode, returns None when nobody is watching
+        if not self.isWatched():
+            self.skippedRenders += 1
+            return None
+        self.renderedFrames += 1
+        return self.renderFrame(frameData)
+
+    def renderFrame(self, frameData):
+        # Render stage: draw the annotations on copies of the camera frame and floor plan
+        # Create copies of the frame for annotations
+        # and initialise the total people count
+        annotatedFrame = frameData["frame"].copy()
+        floorAnnotatedFrame = self.floorImage.copy()
+        totalPeople = 0
+
+        try:
+            if frameData["error"] is not None:
+                raise RuntimeError(frameData["error"])
+
+            if frameData["boxes"] is None:
                 cv2.putText(
                     annotatedFrame,
                     "No human detections available",
@@ -287,6 +520,35 @@ class CameraProcessor:
                     (0, 0, 255),
                     2,
                 )
+            else:
+                # Draw the history trails of all people on the floor plan at once
+                self.trailRenderer.draw(floorAnnotatedFrame, frameData["trails"])
+
+                for (x, y, w, h), trackID in zip(
+                    frameData["boxes"], frameData["trackIDs"]
+                ):
+                    # Draw bounding box and ID on the original frame
+                    cv2.rectangle(
+                        annotatedFrame,
+                        (int(x - w / 2), int(y - h / 2)),
+                        (int(x + w / 2), int(y + h / 2)),
+                        (0, 255, 0),
+                        2,
+                    )
+                    cv2.putText(
+                        annotatedFrame,
+                        f"ID: {int(trackID)}",
+                        (int(x - w / 2), int(y - h / 2) - 10),
+                        cv2.FONT_HERSHEY_SIMPLEX,
+                        0.5,
+                        (0, 255, 0),
+                        2,
+                    )
+                    totalPeople += 1
+
+                annotatedFrame, floorAnnotatedFrame = self.drawAnalysis(
+                    frameData, annotatedFrame, floorAnnotatedFrame
+                )
 
         except Exception as e:
             cv2.putText(
@@ -304,6 +566,84 @@ class CameraProcessor:
 
         return annotatedFrame, floorAnnotatedFrame
 
+    def drawAnalysis(self, frameData, annotatedFrame, floorAnnotatedFrame):
+        # Draw the overlays of the analysis mode the frame was analysed with
+        # The drawing functions read the shared analytics state, so they hold the lock
+        analysisMode = frameData["analysisMode"]
+        currentPositions = frameData["positions"]
+        humanTrackIDs = frameData["trackIDs"]
+
+        # Translucent overlays are collected on one layer per view and blended
+        # onto the frames in a single pass
+        cameraOverlay = self.cameraOverlay.begin(annotatedFrame.shape)
+        floorOverlay = self.floorOverlay.begin(floorAnnotatedFrame.shape)
+
+        with self.analyticsLock:
+            if self.congestionMode == "grid":
+                self.congestionDetection.drawDensityZones(
+                    floorAnnotatedFrame, floorOverlay
+                )
+
+            if analysisMode == "basic" or analysisMode == "congestion":
+                # Draw current congestion
+                self.congestionDetection.drawCongestionZones(
+                    annotatedFrame,
+                    floorAnnotatedFrame,
+                    transformPoints,
+                    cameraOverlay,
+                    floorOverlay,
+                )
+
+                # Draw predicted congestion
+                self.congestionDetection.drawPredictedCongestion(
+                    annotatedFrame, frameData["futureCongestion"], cameraOverlay
+                )
+
+            cameraOverlay.composite(annotatedFrame)
+            floorOverlay.composite(floorAnnotatedFrame)
+
+            if analysisMode == "basic" or analysisMode == "dwell":
+                # Draw dwell time zones on both camera and floor frame
+                if self.showDwellTime:
+                    floorAnnotatedFrame = self.dwellTimeAnalysis.drawDwellTimes(
+                        floorAnnotatedFrame, currentPositions, humanTrackIDs, True
+                    )
+                    annotatedFrame = self.dwellTimeAnalysis.drawDwellTimes(
+                        annotatedFrame, currentPositions, humanTrackIDs, False
+                    )
+
+            if analysisMode == "integration":
+                # Display integration visualization
+                if self.showIntegration:
+                    # Draw analytics on both camera and floor views
+                    annotatedFrame, floorAnnotatedFrame = (
+                        self.integration.drawAnalytics(
+                            annotatedFrame,
+                            floorAnnotatedFrame,
+                            cameraOverlay.begin(annotatedFrame.shape),
+                        )
+                    )
+                    cameraOverlay.composite(annotatedFrame)
+
+        return annotatedFrame, floorAnnotatedFrame
+
+    def processFrame(self, frame):
+        # Check if it's time to update the flow visualization based on the interval
+        currentTime = time_module.time()
+
+        # Start visualization if interval has passed
+        if (
+            currentTime - self.lastFlowVisualizationTime
+            >= self.flowVisualizationInterval
+        ):
+            self.showFlowVisualization = True
+            self.lastFlowVisualizationTime = currentTime
+
+        # Run the detection, analytics and render stages serially on this thread
+        # Returns None instead of the frames when nobody is watching
+        frameData = self.analyseFrame(self.detectFrame(frame))
+        return self.renderIfWatched(frameData)
+
     def addInfoOverlay(self, cameraFrame, floorFrame, totalPeople):
         # Add mode indicator to the camera frame
         cv2.putText(
@@ -347,6 +687,15 @@ class CameraProcessor:
         return self.analysisMode
 
     def run(self):
+        if self.processMode:
+            self.runProcesses()
+            return
+
+        if self.pipelineMode:
+            self.runPipeline()
+            return
+
+        self.showWindow = True
         while True:
             success, frame = self.cap.read()
             if not success:
@@ -368,33 +717,325 @@ class CameraProcessor:
 
         self.release()
 
-    def getFrame(self):
+    def startPipeline(self):
+        # Start the staged pipeline with bounded queues between the stages
+        # Detection and analytics block on a full queue to keep the tracks continuous,
+        # rendering only needs the newest result and drops stale ones instead
+        if self.pipeline is not None:
+            return self.pipeline
 
-        while True:
+        self.pipeline = FramePipeline(
+            self.cap.read,
+            [
+                ("detection", self.detectFrame, False),
+                ("analytics", self.analyseFrame, False),
+                ("render", self.renderIfWatched, True),
+            ],
+            self.storeDisplayFrames,
+            queueSize=self.pipelineQueueSize,
+        )
+        self.pipeline.start()
+        return self.pipeline
+
+    def stopPipeline(self):
+        if self.pipeline is not None:
+            self.pipeline.stop()
+            self.pipeline = None
+
+    def storeDisplayFrames(self, frames):
+        with self.displayLock:
+            self.displayFrames = frames
+        self.publishFrames(frames)
+
+    def getPipelineStats(self):
+        if self.pipeline is None:
+            return {}
+        return self.pipeline.getStats()
+
+    def getTrackMetrics(self):
+        # Memory and eviction metrics of the track history
+        return self.trackHistory.getMetrics()
+
+    def getCaptureStats(self):
+        # Decoded, dropped and reconnect counters of the capture, published by
+        # the capture process in process mode
+        if self.captureStats is not None:
+            stats = dict(zip(CAPTURE_STATS, self.captureStats[:]))
+            stats["connected"] = bool(stats["connected"])
+            for name in ("decoded", "dropped", "failedReads", "reconnects"):
+                stats[name] = int(stats[name])
+            return stats
+        if not hasattr(self.cap, "getStats"):
+            return {}
+        return self.cap.getStats()
+
+    def printPipelineStats(self):
+        stats = self.getPipelineStats()
+        for name, stageStats in stats.items():
+            print(
+                f"{name:>10}: queue={stageStats['queueDepth']} "
+                f"fps={stageStats['fps']:.1f} "
+                f"avg={stageStats['avgLatencyMs']:.1f}ms "
+                f"max={stageStats['maxLatencyMs']:.1f}ms "
+                f"dropped={stageStats['dropped']}"
+            )
+        print(f"Bottleneck stage: {self.pipeline.getBottleneck()}")
+        print(f"Track store: {self.getTrackMetrics()}")
+        print(f"Capture: {self.getCaptureStats()}")
+        print(
+            f"Rendered frames: {self.renderedFrames}, "
+            f"skipped without viewers: {self.skippedRenders}"
+        )
+
+    def runPipeline(self):
+        self.showWindow = True
+        self.startPipeline()
+
+        try:
+            while True:
+                with self.displayLock:
+                    frames = self.displayFrames
+
+                # Display the latest rendered frames from the main thread
+                if frames is not None:
+                    cv2.imshow("Camera View", frames[0])
+                    cv2.imshow("Floor Plan View", frames[1])
+
+                # Periodically report the stage counters
+                currentTime = time_module.time()
+                if currentTime - self.lastStatsTime >= self.statsInterval:
+                    self.printPipelineStats()
+                    self.lastStatsTime = currentTime
+
+                # Handle key presses
+                key = cv2.waitKey(1) & 0xFF
+                if key == ord("q"):
+                    break
+                elif key == ord("m"):
+                    self.togglingMode()
+                elif key == ord("s"):
+                    self.printPipelineStats()
+        finally:
+            self.release()
+
+    def startProcesses(self):
+        # Start the capture process and, if enabled, the render process
+        # The ring slots are sized for the frames of the source, the capture
+        # process opens its own ResilientCapture, so this one is released
+        if self.frameRing is not None:
+            return self.frameRing
+
+        width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        if width <= 0 or height <= 0:
             success, frame = self.cap.read()
             if not success:
-                print("Failed to read video stream in getFrame(). Retrying...")
+                raise Exception("Failed to read video stream - startProcesses()")
+            height, width = frame.shape[:2]
+        self.cap.release()
+
+        self.frameRing = SharedFrameRing((height, width, 3), slots=self.ringSlots)
+        self.captureStats = multiprocessing.Array("d", len(CAPTURE_STATS))
+        self.processes = [
+            multiprocessing.Process(
+                target=captureFrames,
+                args=(self.rtspUrl, self.frameRing, self.captureStats),
+                name="capture",
+                daemon=True,
+            )
+        ]
+        if self.renderProcess:
+            self.renderQueue = multiprocessing.Queue(maxsize=2)
+            self.commandQueue = multiprocessing.Queue()
+            self.processes.append(
+                multiprocessing.Process(
+                    target=renderFrames,
+                    args=(
+                        self.frameRing,
+                        self.renderQueue,
+                        self.commandQueue,
+                        self.floorImage,
+                    ),
+                    name="render",
+                    daemon=True,
+                )
+            )
+
+        self.processesRunning = True
+        for process in self.processes:
+            process.start()
+        return self.frameRing
+
+    def stopProcesses(self):
+        if self.frameRing is None:
+            return
+
+        self.processesRunning = False
+        self.frameRing.stop()
+        if self.renderQueue is not None:
+            try:
+                self.renderQueue.put(None, timeout=1.0)
+            except Exception:
+                pass
+        for process in self.processes:
+            process.join(2.0)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+        self.renderQueue = None
+        self.commandQueue = None
+        self.frameRing.close()
+        self.frameRing = None
+
+    def processRingFrame(self, slot):
+        # Detection and analytics of the frame in a ring slot held by this process
+        # Rendering happens before the slot is released, the renderers copy the frame
+        frameData = self.analyseFrame(self.detectFrame(self.frameRing.frame(slot)))
+
+        if self.renderQueue is not None:
+            # The render process releases the slot after copying the frame
+            self.frameRing.retain(slot)
+            item = {
+                "slot": slot,
+                "boxes": [] if frameData["boxes"] is None else frameData["boxes"],
+                "trackIDs": (
+                    [] if frameData["trackIDs"] is None else frameData["trackIDs"]
+                ),
+                "trails": frameData["trails"],
+                "analytics": frameData.get("analytics"),
+            }
+            try:
+                self.renderQueue.put_nowait(item)
+            except queue.Full:
+                self.frameRing.release(slot)
+
+        # MJPEG clients, or the window when there is no render process
+        return self.renderIfWatched(frameData)
+
+    def processLoop(self):
+        # Analytics loop of the multi-process mode, always takes the newest frame
+        lastSequence = 0
+        while self.processesRunning:
+            acquired = self.frameRing.acquireRead(lastSequence, timeout=1.0)
+            if acquired is None:
                 continue
+            slot, lastSequence, _ = acquired
+            try:
+                frames = self.processRingFrame(slot)
+            finally:
+                self.frameRing.release(slot)
+            if frames is not None:
+                self.storeDisplayFrames(frames)
 
-            annotatedFrame, _ = self.processFrame(frame)
-            ret, buffer = cv2.imencode(".jpg", annotatedFrame)
-            frame = buffer.tobytes()
-            yield (b"--frame\r\n" b"Content-Type: image/jpeg\r\n\r\n" + frame + b"\r\n")
+            # Key presses of the render process
+            while self.commandQueue is not None:
+                try:
+                    command = self.commandQueue.get_nowait()
+                except queue.Empty:
+                    break
+                if command == "quit":
+                    self.processesRunning = False
+                elif command == "mode":
+                    self.togglingMode()
 
-    def getAnnotatedFrame(self):
+    def runProcesses(self):
+        # Without a render process the frames are shown from this process
+        self.showWindow = not self.renderProcess
+        self.startProcesses()
+        processThread = threading.Thread(target=self.processLoop, daemon=True)
+        processThread.start()
 
-        while True:
+        try:
+            while self.processesRunning:
+                if self.renderProcess:
+                    processThread.join(0.5)
+                    continue
+
+                with self.displayLock:
+                    frames = self.displayFrames
+
+                # Display the latest rendered frames from the main thread
+                if frames is not None:
+                    cv2.imshow("Camera View", frames[0])
+                    cv2.imshow("Floor Plan View", frames[1])
+
+                key = cv2.waitKey(1) & 0xFF
+                if key == ord("q"):
+                    break
+                elif key == ord("m"):
+                    self.togglingMode()
+        finally:
+            self.processesRunning = False
+            processThread.join(2.0)
+            self.release()
+
+    def startBroadcast(self):
+        # Start the processing loop once, no matter how many clients are connected
+        # Cameras driven by a CameraManager are processed by the manager instead
+        if self.manager is not None:
+            self.manager.start()
+            return
+
+        with self.broadcastLock:
+            if self.pipelineMode:
+                self.startPipeline()
+                return
+
+            if self.broadcastThread is None:
+                self.broadcasting = True
+                target = self.broadcastLoop
+                if self.processMode:
+                    self.startProcesses()
+                    target = self.processLoop
+                self.broadcastThread = threading.Thread(target=target, daemon=True)
+                self.broadcastThread.start()
+
+    def stopBroadcast(self):
+        self.broadcasting = False
+        if self.broadcastThread is not None:
+            self.broadcastThread.join(2.0)
+            self.broadcastThread = None
+
+    def broadcastLoop(self):
+        while self.broadcasting:
             success, frame = self.cap.read()
             if not success:
-                print("Failed to read video stream in getAnnotatedFrame(). Retrying...")
+                print("Failed to read video stream in broadcastLoop(). Retrying...")
+                time_module.sleep(0.01)
                 continue
 
-            _, floorAnnotatedFrame = self.processFrame(frame)
-            ret, buffer = cv2.imencode(".jpg", floorAnnotatedFrame)
-            frame = buffer.tobytes()
-            yield (b"--frame\r\n" b"Content-Type: image/jpeg\r\n\r\n" + frame + b"\r\n")
+            frames = self.processFrame(frame)
+            if frames is not None:
+                self.storeDisplayFrames(frames)
+
+    def publishFrames(self, frames):
+        # Hand the raw views to the hub, each stream encodes a frame at most once
+        # and only when a client actually requests it
+        for channel, image in zip(("camera", "floor"), frames):
+            self.broadcastHub.publish(channel, image)
+
+    def startAnalytics(self):
+        # Run the analytics without any viewer, e.g. for the analytics API
+        self.startBroadcast()
+
+    def getEvents(self):
+        # Server-Sent Events of the integration analysis, analysed headless
+        self.startAnalytics()
+        return self.eventStream.subscribe()
+
+    def getFrame(self):
+        self.startBroadcast()
+        return self.broadcastHub.subscribe("camera")
+
+    def getAnnotatedFrame(self):
+        self.startBroadcast()
+        return self.broadcastHub.subscribe("floor")
 
     def release(self):
+        self.processesRunning = False
+        self.stopBroadcast()
+        self.stopPipeline()
+        self.stopProcesses()
         self.cap.release()
         cv2.destroyAllWindows()
 
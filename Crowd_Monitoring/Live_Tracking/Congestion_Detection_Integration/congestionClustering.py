@@ -0,0 +1,104 @@
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+
+class CongestionClustering:
+    def __init__(self, proximityThreshold=120, congestionThreshold=3, radiusPadding=20):
+        # proximityThreshold is the distance in pixels for two people to be neighbours
+        # congestionThreshold is the minimum number of people (including the person
+        # itself) within the proximity threshold for a person to start a congestion zone
+        # radiusPadding is added to the distance of the furthest person in a zone
+        self.proximityThreshold = proximityThreshold
+        self.congestionThreshold = congestionThreshold
+        self.radiusPadding = radiusPadding
+
+    def labelPoints(self, points):
+        # Density based clustering with the same semantics as DBSCAN, built on a KD-tree
+        # Returns one label per point, -1 for people that are not part of a cluster
+        count = len(points)
+        labels = np.full(count, -1, dtype=np.int64)
+        if count < self.congestionThreshold:
+            return labels
+
+        # All pairs of people within the proximity threshold
+        pairs = cKDTree(points).query_pairs(
+            self.proximityThreshold, output_type="ndarray"
+        )
+        if len(pairs) == 0:
+            return labels
+
+        # Core points have enough neighbours, counting the point itself
+        neighbours = np.bincount(pairs.ravel(), minlength=count) + 1
+        isCore = neighbours >= self.congestionThreshold
+        if not isCore.any():
+            return labels
+
+        # Clusters are the connected components of the core points
+        coreEdges = pairs[isCore[pairs[:, 0]] & isCore[pairs[:, 1]]]
+        graph = coo_matrix(
+            (
+                np.ones(len(coreEdges), dtype=np.int8),
+                (coreEdges[:, 0], coreEdges[:, 1]),
+            ),
+            shape=(count, count),
+        )
+        _, components = connected_components(graph, directed=False)
+        labels[isCore] = components[isCore]
+
+        # Border points join the cluster of a neighbouring core point
+        borderEdges = pairs[isCore[pairs[:, 0]] != isCore[pairs[:, 1]]]
+        if len(borderEdges):
+            coreSide = np.where(
+                isCore[borderEdges[:, 0]], borderEdges[:, 0], borderEdges[:, 1]
+            )
+            borderSide = np.where(
+                isCore[borderEdges[:, 0]], borderEdges[:, 1], borderEdges[:, 0]
+            )
+            labels[borderSide] = labels[coreSide]
+
+        # Renumber the clusters as 0..k-1
+        clustered = labels >= 0
+        _, labels[clustered] = np.unique(labels[clustered], return_inverse=True)
+        return labels
+
+    def findZones(self, positions):
+        # Return the congestion zones as a list of ((centerX, centerY), radius, count)
+        points = np.asarray(positions, dtype=np.float32).reshape(-1, 2)
+        labels = self.labelPoints(points)
+        clustered = labels >= 0
+        if not clustered.any():
+            return []
+
+        labels = labels[clustered]
+        points = points[clustered]
+        clusterCount = labels.max() + 1
+
+        # Centroids and sizes of all clusters at once
+        counts = np.bincount(labels, minlength=clusterCount)
+        centersX = np.bincount(labels, weights=points[:, 0], minlength=clusterCount)
+        centersY = np.bincount(labels, weights=points[:, 1], minlength=clusterCount)
+        centers = np.stack([centersX, centersY], axis=1) / counts[:, None]
+        centers = centers.astype(int)
+
+        # The radius is the distance from the centroid to the furthest member
+        distances = np.linalg.norm(points - centers[labels], axis=1)
+        maxDistances = np.zeros(clusterCount)
+        np.maximum.at(maxDistances, labels, distances)
+        radii = np.maximum(
+            maxDistances.astype(int) + self.radiusPadding, self.proximityThreshold
+        )
+
+        zones = []
+        for clusterID in range(clusterCount):
+            if counts[clusterID] < self.congestionThreshold:
+                continue
+            zones.append(
+                (
+                    (int(centers[clusterID, 0]), int(centers[clusterID, 1])),
+                    int(radii[clusterID]),
+                    int(counts[clusterID]),
+                )
+            )
+        return zones
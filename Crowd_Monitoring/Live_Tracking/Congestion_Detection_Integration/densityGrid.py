@@ -0,0 +1,194 @@
+import cv2
+import numpy as np
+from layerCompositor import OverlayLayer
+
+
+class DensityGrid:
+    def __init__(
+        self,
+        floorWidth=700,
+        floorHeight=1000,
+        cellSize=50,
+        smoothing=0.3,
+        highDensity=1.5,
+        lowDensity=0.75,
+        minPeople=3,
+    ):
+        # The floor plan is divided into square cells of cellSize floor pixels
+        # counts holds the number of tracked people currently in each cell
+        # smoothed is an exponential moving average of the counts (smoothing is its weight)
+        # a cell turns congested above highDensity and only clears below lowDensity,
+        # which stops zones from flickering on and off between frames
+        # minPeople is the minimum number of people for a group of cells to be a zone
+        self.cellSize = cellSize
+        self.columns = int(np.ceil(floorWidth / cellSize))
+        self.rows = int(np.ceil(floorHeight / cellSize))
+        self.smoothing = smoothing
+        self.highDensity = highDensity
+        self.lowDensity = lowDensity
+        self.minPeople = minPeople
+
+        self.counts = np.zeros(self.rows * self.columns, dtype=np.int32)
+        self.smoothed = np.zeros(self.rows * self.columns, dtype=np.float32)
+        self.congested = np.zeros(self.rows * self.columns, dtype=bool)
+
+        # trackCells maps a track ID to the cell it was counted in
+        self.trackCells = {}
+
+        # Zones are only recomputed when the set of congested cells changes
+        self.zones = []
+        self.labels = np.zeros((self.rows, self.columns), dtype=np.int32)
+        self.componentCount = 0
+        self.zonesChanged = True
+
+    def cellIndices(self, floorPositions):
+        # Flat cell index for every floor position, -1 for positions outside the floor
+        positions = np.asarray(floorPositions, dtype=np.float32).reshape(-1, 2)
+        columns = np.floor(positions[:, 0] / self.cellSize).astype(np.int64)
+        rows = np.floor(positions[:, 1] / self.cellSize).astype(np.int64)
+        inside = (
+            (columns >= 0) & (columns < self.columns) & (rows >= 0) & (rows < self.rows)
+        )
+        return np.where(inside, rows * self.columns + columns, -1)
+
+    def update(self, trackIDs, floorPositions):
+        # Update the grid with the floor positions of the currently tracked people
+        # Only the cells whose occupants changed are touched
+        trackIDs = [int(trackID) for trackID in trackIDs]
+        cells = self.cellIndices(floorPositions)[: len(trackIDs)]
+        trackIDs = trackIDs[: len(cells)]
+
+        previous = np.array(
+            [self.trackCells.get(trackID, -1) for trackID in trackIDs], dtype=np.int64
+        )
+        moved = previous != cells
+
+        # People who moved leave their previous cell and enter the new one
+        leaving = previous[moved & (previous >= 0)]
+        entering = cells[moved & (cells >= 0)]
+        np.subtract.at(self.counts, leaving, 1)
+        np.add.at(self.counts, entering, 1)
+        for index in np.flatnonzero(moved):
+            if cells[index] >= 0:
+                self.trackCells[trackIDs[index]] = int(cells[index])
+            else:
+                self.trackCells.pop(trackIDs[index], None)
+
+        # People who are no longer tracked leave the grid
+        departed = self.trackCells.keys() - set(trackIDs)
+        if departed:
+            departedCells = np.array(
+                [self.trackCells.pop(trackID) for trackID in departed], dtype=np.int64
+            )
+            np.subtract.at(self.counts, departedCells, 1)
+
+        self.updateDensity()
+        return self.getZones()
+
+    def removeTracks(self, trackIDs):
+        # Remove people from the grid, e.g. when their track was evicted
+        for trackID in trackIDs:
+            cell = self.trackCells.pop(int(trackID), None)
+            if cell is not None:
+                self.counts[cell] -= 1
+
+    def updateDensity(self):
+        # Only cells that are occupied or still decaying need to be smoothed
+        active = (self.counts > 0) | (self.smoothed > 1e-3)
+        self.smoothed[active] += self.smoothing * (
+            self.counts[active] - self.smoothed[active]
+        )
+        self.smoothed[~active] = 0
+
+        # Hysteresis between the high and low density thresholds
+        congested = np.where(
+            self.congested,
+            self.smoothed >= self.lowDensity,
+            self.smoothed >= self.highDensity,
+        )
+        if not np.array_equal(congested, self.congested):
+            self.congested = congested
+            self.zonesChanged = True
+
+    def getZones(self):
+        # Return the congestion zones on the floor plan as ((centerX, centerY), radius, count)
+        # Zones are the connected components of the congested cells
+        if self.zonesChanged:
+            mask = self.congested.reshape(self.rows, self.columns).astype(np.uint8)
+            componentCount, self.labels = cv2.connectedComponents(mask, connectivity=8)
+            self.componentCount = componentCount
+            self.zonesChanged = False
+
+        if self.componentCount <= 1:
+            self.zones = []
+            return self.zones
+
+        # Counts and density weighted centroids of all components at once
+        labels = self.labels.ravel()
+        rows, columns = np.divmod(np.arange(labels.size), self.columns)
+        centerX = (columns + 0.5) * self.cellSize
+        centerY = (rows + 0.5) * self.cellSize
+        weights = self.smoothed + 1e-6
+        people = np.bincount(labels, weights=self.counts, minlength=self.componentCount)
+        totalWeight = np.bincount(
+            labels, weights=weights, minlength=self.componentCount
+        )
+        zoneX = np.bincount(
+            labels, weights=centerX * weights, minlength=self.componentCount
+        )
+        zoneY = np.bincount(
+            labels, weights=centerY * weights, minlength=self.componentCount
+        )
+        cells = np.bincount(labels, minlength=self.componentCount)
+
+        self.zones = []
+        for label in range(1, self.componentCount):
+            if people[label] < self.minPeople:
+                continue
+            center = (
+                int(zoneX[label] / totalWeight[label]),
+                int(zoneY[label] / totalWeight[label]),
+            )
+            # Radius of a circle with the same area as the component
+            radius = (
+                int(self.cellSize * np.sqrt(cells[label] / np.pi)) + self.cellSize // 2
+            )
+            self.zones.append((center, radius, int(people[label])))
+
+        return self.zones
+
+    def drawDensity(self, floorFrame, color=(0, 0, 255), alpha=0.4, overlay=None):
+        # Draw the congested cells and the zone outlines on the floor plan
+        # The cells are drawn on an overlay layer that is blended in one pass,
+        # either by the caller or at the end of this function
+        if not self.congested.any():
+            return floorFrame
+
+        composite = overlay is None
+        if composite:
+            overlay = OverlayLayer(floorFrame.shape)
+
+        for cell in np.flatnonzero(self.congested):
+            row, column = divmod(int(cell), self.columns)
+            overlay.rectangle(
+                (column * self.cellSize, row * self.cellSize),
+                ((column + 1) * self.cellSize, (row + 1) * self.cellSize),
+                color,
+                -1,
+                alpha=alpha,
+            )
+
+        for center, radius, count in self.zones:
+            overlay.circle(center, radius, color, 2)
+            overlay.putText(
+                f"CONGESTION ZONE: {count}",
+                (center[0] - 70, center[1]),
+                cv2.FONT_HERSHEY_SIMPLEX,
+                0.6,
+                (255, 255, 255),
+                2,
+            )
+
+        if composite:
+            overlay.composite(floorFrame)
+        return floorFrame
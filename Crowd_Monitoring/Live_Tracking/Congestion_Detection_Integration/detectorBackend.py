@@ -0,0 +1,221 @@
+import json
+import os
+import shutil
+import cv2
+import numpy as np
+from ultralytics import YOLO
+
+# torch runs the PyTorch weights, the other backends run a model exported once
+# from them with ONNX Runtime or OpenVINO, optionally quantised to INT8
+BACKENDS = ("torch", "onnx", "onnx-int8", "openvino", "openvino-int8")
+
+
+def letterbox(frame, imgsz):
+    # Resize keeping the aspect ratio and pad to a square imgsz input, as the
+    # detector does, returns a (1, 3, imgsz, imgsz) float32 RGB tensor in [0, 1]
+    height, width = frame.shape[:2]
+    scale = imgsz / max(height, width)
+    resized = cv2.resize(
+        frame,
+        (max(int(round(width * scale)), 1), max(int(round(height * scale)), 1)),
+        interpolation=cv2.INTER_LINEAR,
+    )
+    padded = np.full((imgsz, imgsz, 3), 114, dtype=np.uint8)
+    top = (imgsz - resized.shape[0]) // 2
+    left = (imgsz - resized.shape[1]) // 2
+    padded[top : top + resized.shape[0], left : left + resized.shape[1]] = resized
+    tensor = padded[:, :, ::-1].transpose(2, 0, 1)[np.newaxis]
+    return np.ascontiguousarray(tensor, dtype=np.float32) / 255.0
+
+
+def readCalibrationFrames(source, count=100, imgsz=640, startFrame=0):
+    # Evenly spaced frames of a recorded clip from startFrame on as calibration
+    # inputs, e.g. to keep the frames a benchmark is scored on out of calibration
+    cap = cv2.VideoCapture(source)
+    total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    if startFrame:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, startFrame)
+        total -= startFrame
+    step = max(total // count, 1) if total > 0 else 1
+    frames = []
+    index = 0
+    while len(frames) < count:
+        success, frame = cap.read()
+        if not success:
+            break
+        if index % step == 0:
+            frames.append(letterbox(frame, imgsz))
+        index += 1
+    cap.release()
+    if not frames:
+        raise ValueError(
+            f"No calibration frames could be read from {source} after frame "
+            f"{startFrame}, use a longer or a separate calibration clip"
+        )
+    return frames
+
+
+def quantizeOnnx(
+    onnxPath, outputPath, calibrationSource=None, imgsz=640, calibrationStart=0
+):
+    # INT8 quantisation of an exported ONNX model with ONNX Runtime
+    # With a recorded clip the activations are calibrated on its frames (static
+    # QDQ quantisation, fastest on CPU), otherwise only the weights are quantised
+    try:
+        from onnxruntime import InferenceSession
+        from onnxruntime.quantization import (
+            CalibrationDataReader,
+            QuantFormat,
+            QuantType,
+            quantize_dynamic,
+            quantize_static,
+        )
+    except ImportError as e:
+        raise ImportError("INT8 quantisation requires onnxruntime") from e
+
+    if calibrationSource is None:
+        quantize_dynamic(onnxPath, outputPath, weight_type=QuantType.QUInt8)
+        return outputPath
+
+    inputName = (
+        InferenceSession(onnxPath, providers=["CPUExecutionProvider"])
+        .get_inputs()[0]
+        .name
+    )
+    frames = readCalibrationFrames(
+        calibrationSource, imgsz=imgsz, startFrame=calibrationStart
+    )
+
+    class FrameReader(CalibrationDataReader):
+        def __init__(self):
+            self.frames = iter(frames)
+
+        def get_next(self):
+            frame = next(self.frames, None)
+            return None if frame is None else {inputName: frame}
+
+    quantize_static(
+        onnxPath,
+        outputPath,
+        FrameReader(),
+        quant_format=QuantFormat.QDQ,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        per_channel=True,
+    )
+    return outputPath
+
+
+def exportedModelPath(modelPath, backend):
+    # Where the export of a backend is cached, next to the PyTorch weights
+    stem = os.path.splitext(modelPath)[0]
+    return {
+        "onnx": f"{stem}.onnx",
+        "onnx-int8": f"{stem}_int8.onnx",
+        "openvino": f"{stem}_openvino_model",
+        "openvino-int8": f"{stem}_int8_openvino_model",
+    }[backend]
+
+
+def calibrationKey(
+    backend, imgsz, calibrationSource, calibrationStart, calibrationData
+):
+    # What an INT8 export was calibrated on, a cached export calibrated on
+    # anything else is exported again, None for the backends without calibration
+    if backend == "onnx-int8":
+        source = calibrationSource
+        if isinstance(source, str) and os.path.isfile(source):
+            # The clip is identified by its path, size and modification time
+            source = [
+                os.path.abspath(source),
+                os.path.getsize(source),
+                os.path.getmtime(source),
+            ]
+        return {"imgsz": imgsz, "source": source, "startFrame": calibrationStart}
+    if backend == "openvino-int8":
+        return {"imgsz": imgsz, "data": calibrationData}
+    return None
+
+
+def readCalibrationKey(path):
+    try:
+        with open(f"{path}.calibration.json") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def writeCalibrationKey(path, key):
+    with open(f"{path}.calibration.json", "w") as file:
+        json.dump(key, file)
+
+
+def exportModel(
+    modelPath="yolov8n.pt",
+    backend="onnx",
+    imgsz=640,
+    calibrationSource=None,
+    calibrationData="coco8.yaml",
+    calibrationStart=0,
+    force=False,
+):
+    # Export the PyTorch model for a backend once, later calls reuse the export
+    # The exports take dynamic input sizes and batches, so the region of interest
+    # sizes and the batches of the CameraManager keep working
+    # calibrationSource is a recorded clip used to calibrate ONNX INT8, from its
+    # frame calibrationStart on
+    # calibrationData is the dataset YAML used to calibrate OpenVINO INT8
+    # INT8 exports are only reused if they were calibrated on the same data,
+    # force exports the backend again in any case
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown detector backend {backend}, choose from {BACKENDS}")
+    if backend == "torch":
+        return modelPath
+
+    path = exportedModelPath(modelPath, backend)
+    key = calibrationKey(
+        backend, imgsz, calibrationSource, calibrationStart, calibrationData
+    )
+    if os.path.exists(path) and not force:
+        if key is None or readCalibrationKey(path) == json.loads(json.dumps(key)):
+            return path
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+    if backend in ("onnx", "onnx-int8"):
+        onnxPath = exportedModelPath(modelPath, "onnx")
+        if not os.path.exists(onnxPath):
+            onnxPath = YOLO(modelPath).export(
+                format="onnx", imgsz=imgsz, dynamic=True, simplify=True
+            )
+        if backend == "onnx":
+            return onnxPath
+        quantizeOnnx(onnxPath, path, calibrationSource, imgsz, calibrationStart)
+        writeCalibrationKey(path, key)
+        return path
+
+    exported = YOLO(modelPath).export(
+        format="openvino",
+        imgsz=imgsz,
+        dynamic=True,
+        int8=backend == "openvino-int8",
+        data=calibrationData,
+    )
+    # Older ultralytics versions write the INT8 export to the FP32 directory
+    if os.path.abspath(exported) != os.path.abspath(path):
+        os.replace(exported, path)
+    if key is not None:
+        writeCalibrationKey(path, key)
+    return path
+
+
+def loadDetector(modelPath="yolov8n.pt", backend="torch", imgsz=640, **exportOptions):
+    # Detector for the given backend, exported on first use
+    # The result is an ultralytics YOLO model for every backend, so track() keeps
+    # feeding the same ByteTrack association and predict() returns the same boxes
+    path = exportModel(modelPath, backend, imgsz, **exportOptions)
+    if backend == "torch":
+        return YOLO(path)
+    return YOLO(path, task="detect")
@@ -0,0 +1,239 @@
+import argparse
+import json
+import os
+import time
+import cv2
+import numpy as np
+from detectorBackend import BACKENDS, loadDetector
+
+
+def readFrames(videoPath, count, step=1):
+    # Every step-th frame of a recorded clip, up to count frames
+    cap = cv2.VideoCapture(videoPath)
+    frames = []
+    index = 0
+    while len(frames) < count:
+        success, frame = cap.read()
+        if not success:
+            break
+        if index % step == 0:
+            frames.append(frame)
+        index += 1
+    cap.release()
+    if not frames:
+        raise ValueError(f"No frames could be read from {videoPath}")
+    return frames
+
+
+def detectPeople(model, frame, imgsz, confidence):
+    # (x1, y1, x2, y2) boxes of the people detected in a frame
+    result = model.predict(
+        frame, imgsz=imgsz, conf=confidence, classes=[0], verbose=False
+    )[0]
+    return result.boxes.xyxy.cpu().numpy().reshape(-1, 4)
+
+
+def boxIoU(boxes, references):
+    # IoU matrix between two sets of (x1, y1, x2, y2) boxes
+    x1 = np.maximum(boxes[:, None, 0], references[None, :, 0])
+    y1 = np.maximum(boxes[:, None, 1], references[None, :, 1])
+    x2 = np.minimum(boxes[:, None, 2], references[None, :, 2])
+    y2 = np.minimum(boxes[:, None, 3], references[None, :, 3])
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    referenceAreas = (references[:, 2] - references[:, 0]) * (
+        references[:, 3] - references[:, 1]
+    )
+    union = areas[:, None] + referenceAreas[None, :] - intersection
+    return intersection / np.maximum(union, 1e-9)
+
+
+def matchBoxes(boxes, references, threshold=0.5):
+    # Greedy one to one matching by IoU, returns the IoU of every match
+    if not len(boxes) or not len(references):
+        return np.empty(0)
+    iou = boxIoU(boxes, references)
+    matches = []
+    for flatIndex in np.argsort(iou, axis=None)[::-1]:
+        row, column = np.unravel_index(flatIndex, iou.shape)
+        if iou[row, column] < threshold:
+            break
+        if np.isnan(iou[row, column]):
+            continue
+        matches.append(iou[row, column])
+        iou[row, :] = np.nan
+        iou[:, column] = np.nan
+    return np.asarray(matches)
+
+
+def benchmarkBackend(model, frames, imgsz, confidence, warmup):
+    # Detections of every frame and the latency of every inference in seconds
+    for frame in frames[:warmup]:
+        detectPeople(model, frame, imgsz, confidence)
+
+    detections = []
+    latencies = []
+    for frame in frames:
+        startTime = time.perf_counter()
+        detections.append(detectPeople(model, frame, imgsz, confidence))
+        latencies.append(time.perf_counter() - startTime)
+    return detections, np.asarray(latencies)
+
+
+def compareDetections(detections, references, threshold=0.5):
+    # Agreement with the reference detections, e.g. of the PyTorch model
+    matched = 0
+    ious = []
+    countErrors = []
+    for boxes, referenceBoxes in zip(detections, references):
+        matches = matchBoxes(boxes, referenceBoxes, threshold)
+        matched += len(matches)
+        ious.extend(matches)
+        countErrors.append(abs(len(boxes) - len(referenceBoxes)))
+
+    detected = sum(len(boxes) for boxes in detections)
+    referenced = sum(len(boxes) for boxes in references)
+    precision = matched / detected if detected else 1.0
+    recall = matched / referenced if referenced else 1.0
+    return {
+        "precision": precision,
+        "recall": recall,
+        "f1": (
+            2 * precision * recall / (precision + recall) if precision + recall else 0.0
+        ),
+        "meanIoU": float(np.mean(ious)) if ious else 0.0,
+        "meanCountError": float(np.mean(countErrors)),
+    }
+
+
+def runBenchmark(
+    videoPath,
+    backends=BACKENDS,
+    modelPath="yolov8n.pt",
+    frameCount=200,
+    step=1,
+    imgsz=640,
+    confidence=0.25,
+    warmup=5,
+    calibrationSource=None,
+    forceExport=False,
+):
+    # FPS of every backend on a recorded clip and its accuracy against the first
+    # backend, the PyTorch model by default
+    # ONNX INT8 is calibrated on calibrationSource, or on the part of the clip
+    # after the scored frames, never on the frames its accuracy is scored on
+    # forceExport exports every backend again instead of reusing cached exports
+    frames = readFrames(videoPath, frameCount, step)
+    report = {"video": videoPath, "frames": len(frames), "imgsz": imgsz, "backends": {}}
+
+    references = None
+    for backend in backends:
+        options = {"force": forceExport}
+        if backend == "onnx-int8":
+            # Calibrate on another clip or hold the scored frames out
+            options["calibrationSource"] = calibrationSource or videoPath
+            options["calibrationStart"] = 0
+            if os.path.abspath(options["calibrationSource"]) == os.path.abspath(
+                videoPath
+            ):
+                options["calibrationStart"] = len(frames) * step
+        try:
+            model = loadDetector(modelPath, backend, imgsz, **options)
+        except Exception as e:
+            print(f"{backend}: not available ({e})")
+            report["backends"][backend] = {"error": str(e)}
+            continue
+
+        detections, latencies = benchmarkBackend(
+            model, frames, imgsz, confidence, warmup
+        )
+        result = {
+            "fps": len(latencies) / latencies.sum(),
+            "meanMs": float(latencies.mean() * 1000),
+            "p50Ms": float(np.percentile(latencies, 50) * 1000),
+            "p90Ms": float(np.percentile(latencies, 90) * 1000),
+            "meanPeople": float(np.mean([len(boxes) for boxes in detections])),
+        }
+        if backend == "onnx-int8":
+            result["calibration"] = {
+                "source": options["calibrationSource"],
+                "startFrame": options["calibrationStart"],
+            }
+        if references is None:
+            references = detections
+            result["reference"] = True
+        else:
+            result.update(compareDetections(detections, references))
+        report["backends"][backend] = result
+
+    return report
+
+
+def printReport(report):
+    print(f"{report['frames']} frames of {report['video']} at imgsz {report['imgsz']}")
+    for backend, result in report["backends"].items():
+        if "error" in result:
+            print(f"{backend:>14}: {result['error']}")
+            continue
+        line = (
+            f"{backend:>14}: {result['fps']:6.1f} fps "
+            f"mean={result['meanMs']:.1f}ms p90={result['p90Ms']:.1f}ms "
+            f"people={result['meanPeople']:.1f}"
+        )
+        if result.get("reference"):
+            line += " (reference)"
+        else:
+            line += (
+                f" precision={result['precision']:.3f} recall={result['recall']:.3f} "
+                f"f1={result['f1']:.3f} IoU={result['meanIoU']:.3f} "
+                f"countError={result['meanCountError']:.2f}"
+            )
+        print(line)
+
+
+if __name__ == "__main__":
+    # Usage: python detectorBenchmark.py match.mp4 --backends torch onnx onnx-int8
+    parser = argparse.ArgumentParser(
+        description="Compare the FPS and accuracy of the detector backends"
+    )
+    parser.add_argument("video", help="recorded clip")
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        default=list(BACKENDS),
+        choices=BACKENDS,
+        help="backends to compare, the first one is the accuracy reference",
+    )
+    parser.add_argument("--model", default="yolov8n.pt", help="PyTorch weights")
+    parser.add_argument("--frames", type=int, default=200, help="frames to detect")
+    parser.add_argument("--step", type=int, default=1, help="use every n-th frame")
+    parser.add_argument("--imgsz", type=int, default=640, help="inference size")
+    parser.add_argument("--conf", type=float, default=0.25, help="confidence")
+    parser.add_argument(
+        "--calibration",
+        help="clip to calibrate ONNX INT8 with, by default the part of the video "
+        "after the scored frames",
+    )
+    parser.add_argument(
+        "--force-export",
+        action="store_true",
+        help="export the backends again instead of reusing cached exports",
+    )
+    parser.add_argument("--report", help="write the report as JSON")
+    args = parser.parse_args()
+
+    report = runBenchmark(
+        args.video,
+        backends=args.backends,
+        modelPath=args.model,
+        frameCount=args.frames,
+        step=args.step,
+        imgsz=args.imgsz,
+        confidence=args.conf,
+        calibrationSource=args.calibration,
+        forceExport=args.force_export,
+    )
+    printReport(report)
+    if args.report:
+        with open(args.report, "w") as file:
+            json.dump(report, file, indent=2)
@@ -2,10 +2,16 @@ import cv2
 import numpy as np
 import time
 from collections import defaultdict
+from layerCompositor import LayerCache
 
 
 class DwellTimeAnalysis:
-    def __init__(self, homographyMatrix, floorWidth=700, floorHeight=1000):
+    def __init__(
+        self, homographyMatrix, floorWidth=700, floorHeight=1000, clock=time.time
+    ):
+        # clock returns the current time in seconds, e.g. the video time of a
+        # replay instead of the wall clock
+        self.clock = clock
         self.homographyMatrix = homographyMatrix
         self.floorWidth = floorWidth
         self.floorHeight = floorHeight
@@ -19,8 +25,17 @@ class DwellTimeAnalysis:
                 "maxDwellTime": 0,
             }
         )
+        # trackZones maps the track ID of every person inside a zone to the set of
+        # zone IDs they are in, more than one where zones overlap
+        self.trackZones = {}
+        # Zone membership is looked up in a bitmask raster of the floor plan,
+        # rebuilt whenever self.zones is replaced
+        self.zoneBits = None
+        self.rasterZones = None
+        # Pre-rendered zone and stats board layers, re-rendered when the zones change
+        self.layerCache = LayerCache()
         self.defineDefaultZones()
-        self.lastUpdateTime = time.time()
+        self.lastUpdateTime = self.clock()
         self.updateInterval = 1.0  # Update stats once per second
 
     def defineDefaultZones(self):
@@ -68,6 +83,79 @@ class DwellTimeAnalysis:
             ),
         ]
 
+    def buildZoneRaster(self):
+        # Rasterise all zone polygons once into a bitmask image, bit zoneID % 8 of
+        # byte zoneID // 8 of a floor plan pixel is set when the pixel lies in the
+        # zone, so a pixel in overlapping zones or on a shared border belongs to
+        # all of them, like a point polygon test per zone
+        zoneCount = len(self.zones)
+        self.zoneBits = np.zeros(
+            (self.floorHeight + 1, self.floorWidth + 1, max(-(-zoneCount // 8), 1)),
+            dtype=np.uint8,
+        )
+        mask = np.zeros(self.zoneBits.shape[:2], dtype=np.uint8)
+        border = np.zeros_like(mask)
+        for zoneID, (_, zonePoly, _) in enumerate(self.zones):
+            zonePoly = np.int32(zonePoly)
+            mask[:] = 0
+            cv2.fillPoly(mask, [zonePoly], 1)
+
+            # fillPoly also covers some pixels just outside slanted edges, the
+            # pixels along the border are decided by the exact polygon test
+            border[:] = 0
+            cv2.polylines(border, [zonePoly], True, 1, 3)
+            for y, x in zip(*np.nonzero(border)):
+                mask[y, x] = (
+                    cv2.pointPolygonTest(zonePoly, (int(x), int(y)), False) >= 0
+                )
+            self.zoneBits[:, :, zoneID // 8] |= mask << (zoneID % 8)
+        self.rasterZones = self.zones
+
+        # Zone IDs changed meaning, so the statistics start over
+        self.currentCounts = np.zeros(zoneCount, dtype=np.int64)
+        self.totalVisits = np.zeros(zoneCount, dtype=np.int64)
+        self.visitors = np.zeros(zoneCount, dtype=np.int64)
+        self.completedDwellTime = np.zeros(zoneCount, dtype=np.float64)
+        self.maxDwellTimes = np.zeros(zoneCount, dtype=np.float64)
+        self.personZoneData.clear()
+        self.zoneStats.clear()
+        self.trackZones = {}
+
+    def getZoneMembership(self, floorPositions):
+        # (N, zones) boolean matrix of the zones every floor position lies in,
+        # all False outside all zones and outside the floor
+        if self.rasterZones is not self.zones:
+            self.buildZoneRaster()
+
+        positions = np.asarray(floorPositions, dtype=np.float64).reshape(-1, 2)
+        with np.errstate(invalid="ignore"):
+            x = np.nan_to_num(positions[:, 0], nan=-1).astype(np.int64)
+            y = np.nan_to_num(positions[:, 1], nan=-1).astype(np.int64)
+        height, width = self.zoneBits.shape[:2]
+        inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+
+        bits = np.zeros((len(positions), self.zoneBits.shape[2]), dtype=np.uint8)
+        bits[inside] = self.zoneBits[y[inside], x[inside]]
+        membership = np.unpackbits(bits, axis=1, bitorder="little")
+        return membership[:, : len(self.zones)].astype(bool)
+
+    def zoneVisits(self):
+        # (trackID, zoneID) pair of every ongoing visit
+        return [
+            (trackID, zoneID)
+            for trackID, zoneIDs in self.trackZones.items()
+            for zoneID in zoneIDs
+        ]
+
+    def trackMembership(self, trackIDs):
+        # (N, zones) boolean matrix of the zones the given tracks are inside
+        membership = np.zeros((len(trackIDs), len(self.zones)), dtype=bool)
+        for row, trackID in enumerate(trackIDs):
+            zoneIDs = self.trackZones.get(trackID)
+            if zoneIDs:
+                membership[row, list(zoneIDs)] = True
+        return membership
+
     def isPointInZone(self, point, zonePolygon):
         # Make sure point is a single x,y tuple, not an array
         if isinstance(point, np.ndarray) and point.ndim > 1:
@@ -84,91 +172,149 @@ class DwellTimeAnalysis:
 
     def updateZones(self, currentPositions, trackIDs):
 
-        currentTime = time.time()
+        currentTime = self.clock()
+        if self.rasterZones is not self.zones:
+            self.buildZoneRaster()
 
         # Transform camera positions to floor plan coordinates
-        if currentPositions:
+        if len(currentPositions):
             floorPositions = self.transformPointsToFloor(np.array(currentPositions))
         else:
-            floorPositions = []
-
-        # Update person zone data
-        for idx, trackID in enumerate(trackIDs):
-            if idx >= len(floorPositions):
-                continue
-
-            personPos = tuple(map(int, floorPositions[idx]))
-
-            # Check each zone for this person
-            for zoneID, (zoneName, zonePoly, _) in enumerate(self.zones):
-                # If we haven't seen this person in this zone before, initialize their data
-                if zoneID not in self.personZoneData[trackID]:
-                    self.personZoneData[trackID][zoneID] = {
-                        "enterTime": None,
-                        "exitTime": None,
-                        "inZone": False,
-                        "totalDwellTime": 0,
-                    }
-
-                isInZone = self.isPointInZone(personPos, zonePoly)
-                zoneData = self.personZoneData[trackID][zoneID]
-
-                # Person just entered the zone
-                if isInZone and not zoneData["inZone"]:
-                    zoneData["enterTime"] = currentTime
-                    zoneData["inZone"] = True
-                    self.zoneStats[zoneID]["currentCount"] += 1
-                    self.zoneStats[zoneID]["totalVisits"] += 1
-
-                # Person just exited the zone
-                elif not isInZone and zoneData["inZone"]:
-                    zoneData["exitTime"] = currentTime
-                    zoneData["inZone"] = False
-                    self.zoneStats[zoneID]["currentCount"] -= 1
-
-                    # Calculate dwell time for this visit
-                    if zoneData["enterTime"] is not None:
-                        dwellTime = zoneData["exitTime"] - zoneData["enterTime"]
-                        zoneData["totalDwellTime"] += dwellTime
-
-                        # Update zone statistics
-                        self.zoneStats[zoneID]["maxDwellTime"] = max(
-                            self.zoneStats[zoneID]["maxDwellTime"], dwellTime
-                        )
+            floorPositions = np.empty((0, 2), dtype=np.float32)
+
+        # Zones of every person in one raster lookup
+        trackIDs = [int(trackID) for trackID in trackIDs][: len(floorPositions)]
+        if not trackIDs:
+            # Nobody is in view, so every ongoing visit ends
+            trackIDs = list(self.trackZones)
+            floorPositions = np.full((len(trackIDs), 2), -1, dtype=np.float32)
+        membership = self.getZoneMembership(floorPositions[: len(trackIDs)])
+        previous = self.trackMembership(trackIDs)
+
+        # Only people who entered or left zones need any bookkeeping
+        leavingRows, leavingZones = np.nonzero(previous & ~membership)
+        enteringRows, enteringZones = np.nonzero(membership & ~previous)
+        if len(leavingRows) or len(enteringRows):
+            self.exitZones(
+                [trackIDs[row] for row in leavingRows], leavingZones, currentTime
+            )
+            self.enterZones(
+                [trackIDs[row] for row in enteringRows], enteringZones, currentTime
+            )
+            self.syncZoneStats()
 
         # Update average dwell times periodically
         if currentTime - self.lastUpdateTime >= self.updateInterval:
             self.updateZoneStats()
             self.lastUpdateTime = currentTime
 
+    def exitZones(self, trackIDs, zoneIDs, currentTime):
+        # Close the visits of the people leaving the given zones (-1 means no zone)
+        leaving = np.flatnonzero(zoneIDs >= 0)
+        if len(leaving) == 0:
+            return
+
+        zoneIDs = zoneIDs[leaving]
+        dwellTimes = np.zeros(len(leaving), dtype=np.float64)
+        for index, position in enumerate(leaving):
+            trackID = trackIDs[position]
+            zoneData = self.personZoneData[trackID][int(zoneIDs[index])]
+            zoneData["exitTime"] = currentTime
+            zoneData["inZone"] = False
+            dwellTimes[index] = currentTime - zoneData["enterTime"]
+            zoneData["totalDwellTime"] += dwellTimes[index]
+            trackZones = self.trackZones.get(trackID)
+            if trackZones is not None:
+                trackZones.discard(int(zoneIDs[index]))
+                if not trackZones:
+                    del self.trackZones[trackID]
+
+        np.subtract.at(self.currentCounts, zoneIDs, 1)
+        np.add.at(self.completedDwellTime, zoneIDs, dwellTimes)
+        np.maximum.at(self.maxDwellTimes, zoneIDs, dwellTimes)
+
+    def enterZones(self, trackIDs, zoneIDs, currentTime):
+        # Open visits for the people entering the given zones (-1 means no zone)
+        entering = np.flatnonzero(zoneIDs >= 0)
+        if len(entering) == 0:
+            return
+
+        zoneIDs = zoneIDs[entering]
+        firstVisits = np.zeros(len(entering), dtype=bool)
+        for index, position in enumerate(entering):
+            trackID = trackIDs[position]
+            zoneID = int(zoneIDs[index])
+
+            # Person data is only created for the zones a person actually visits
+            zoneData = self.personZoneData[trackID].get(zoneID)
+            if zoneData is None:
+                zoneData = {
+                    "enterTime": None,
+                    "exitTime": None,
+                    "inZone": False,
+                    "totalDwellTime": 0,
+                }
+                self.personZoneData[trackID][zoneID] = zoneData
+                firstVisits[index] = True
+
+            zoneData["enterTime"] = currentTime
+            zoneData["inZone"] = True
+            self.trackZones.setdefault(trackID, set()).add(zoneID)
+
+        np.add.at(self.currentCounts, zoneIDs, 1)
+        np.add.at(self.totalVisits, zoneIDs, 1)
+        np.add.at(self.visitors, zoneIDs[firstVisits], 1)
+
+    def syncZoneStats(self):
+        # Copy the statistics arrays into the zoneStats dictionaries
+        for zoneID in range(len(self.zones)):
+            stats = self.zoneStats[zoneID]
+            stats["currentCount"] = int(self.currentCounts[zoneID])
+            stats["totalVisits"] = int(self.totalVisits[zoneID])
+            stats["maxDwellTime"] = float(self.maxDwellTimes[zoneID])
+
+    def removeTracks(self, trackIDs):
+        # Drop the state of people whose tracks were evicted
+        # People still inside a zone are treated as leaving it now
+        if self.rasterZones is not self.zones:
+            self.buildZoneRaster()
+
+        trackIDs = [int(trackID) for trackID in trackIDs]
+        rows, zoneIDs = np.nonzero(self.trackMembership(trackIDs))
+        if len(rows):
+            self.exitZones([trackIDs[row] for row in rows], zoneIDs, self.clock())
+            self.syncZoneStats()
+
+        for trackID in trackIDs:
+            self.personZoneData.pop(trackID, None)
+
     def updateZoneStats(self):
+        # Average dwell time per visitor, including the ongoing visits
+        # Completed visits are accumulated as people leave, so only the people
+        # currently inside a zone are visited here
+        if self.rasterZones is not self.zones:
+            self.buildZoneRaster()
+
+        totalDwellTime = self.completedDwellTime.copy()
+        if self.trackZones:
+            currentTime = self.clock()
+            visits = self.zoneVisits()
+            zoneIDs = np.array([zoneID for _, zoneID in visits], dtype=np.int64)
+            enterTimes = np.fromiter(
+                (
+                    self.personZoneData[trackID][zoneID]["enterTime"]
+                    for trackID, zoneID in visits
+                ),
+                dtype=np.float64,
+            )
+            totalDwellTime += np.bincount(
+                zoneIDs, weights=currentTime - enterTimes, minlength=len(self.zones)
+            )
 
-        for zoneID in range(len(self.zones)):
-            totalDwellTime = 0
-            visitCount = 0
-
-            # Calculate total dwell time across all people who have visited this zone
-            for trackID, zones in self.personZoneData.items():
-                if zoneID in zones:
-                    zoneData = zones[zoneID]
-
-                    # Add completed visit times
-                    totalDwellTime += zoneData["totalDwellTime"]
-
-                    # For people currently in the zone, add their current dwell time
-                    if zoneData["inZone"] and zoneData["enterTime"] is not None:
-                        currentDwell = time.time() - zoneData["enterTime"]
-                        totalDwellTime += currentDwell
-
-                    # Count this as a visit if they've entered the zone
-                    if zoneData["enterTime"] is not None:
-                        visitCount += 1
-
-            # Update average dwell time
-            if visitCount > 0:
-                self.zoneStats[zoneID]["averageDwellTime"] = (
-                    totalDwellTime / visitCount
-                )
+        for zoneID in np.flatnonzero(self.visitors):
+            self.zoneStats[int(zoneID)]["averageDwellTime"] = float(
+                totalDwellTime[zoneID] / self.visitors[zoneID]
+            )
 
     def transformPointsToFloor(self, cameraPoints):
 
@@ -196,42 +342,69 @@ class DwellTimeAnalysis:
     def getCurrentDwellTimes(self, currentTime=None):
 
         if currentTime is None:
-            currentTime = time.time()
+            currentTime = self.clock()
 
         dwellTimes = defaultdict(dict)
 
-        for trackID, zones in self.personZoneData.items():
-            for zoneID, zoneData in zones.items():
-                if zoneData["inZone"] and zoneData["enterTime"] is not None:
-                    dwellTimes[trackID][zoneID] = currentTime - zoneData["enterTime"]
+        for trackID, zoneID in self.zoneVisits():
+            zoneData = self.personZoneData[trackID][zoneID]
+            dwellTimes[trackID][zoneID] = currentTime - zoneData["enterTime"]
 
         return dwellTimes
 
-    def drawZones(self, floorPlanImage):
-
-        for zoneName, zonePoly, color in self.zones:
-            # Create a copy of the image for overlay
-            overlay = floorPlanImage.copy()
+    def getZoneDwellTimes(self, currentTime=None):
+        # Mean and maximum dwell time of the people currently inside every zone
+        if currentTime is None:
+            currentTime = self.clock()
+        if self.rasterZones is not self.zones:
+            self.buildZoneRaster()
+
+        zoneCount = len(self.zones)
+        meanDwell = np.zeros(zoneCount, dtype=np.float64)
+        maxDwell = np.zeros(zoneCount, dtype=np.float64)
+        if not self.trackZones:
+            return meanDwell, maxDwell
+
+        visits = self.zoneVisits()
+        zoneIDs = np.array([zoneID for _, zoneID in visits], dtype=np.int64)
+        dwellTimes = currentTime - np.fromiter(
+            (
+                self.personZoneData[trackID][zoneID]["enterTime"]
+                for trackID, zoneID in visits
+            ),
+            dtype=np.float64,
+        )
+        counts = np.bincount(zoneIDs, minlength=zoneCount)
+        totals = np.bincount(zoneIDs, weights=dwellTimes, minlength=zoneCount)
+        np.divide(totals, counts, out=meanDwell, where=counts > 0)
+        np.maximum.at(maxDwell, zoneIDs, dwellTimes)
+        return meanDwell, maxDwell
+
+    def getZoneKey(self):
+        # Identifies the zone configuration the cached layers were rendered for
+        return tuple(
+            (zoneName, np.asarray(zonePoly).tobytes(), tuple(color))
+            for zoneName, zonePoly, color in self.zones
+        )
 
-            # Fill the zone polygon with semi-transparent color
-            alpha = 0.3  # Transparency factor
-            cv2.fillPoly(overlay, [zonePoly], color)
+    def renderZones(self, layer):
 
-            # Apply the overlay with transparency
-            cv2.addWeighted(
-                overlay, alpha, floorPlanImage, 1 - alpha, 0, floorPlanImage
-            )
+        # Fill the zone polygons with semi-transparent colors first,
+        # so the borders and names of neighbouring zones stay on top
+        alpha = 0.3  # Transparency factor
+        for zoneName, zonePoly, color in self.zones:
+            layer.fillPoly([zonePoly], color, alpha=alpha)
 
+        for zoneName, zonePoly, color in self.zones:
             # Draw the zone polygon border
-            cv2.polylines(floorPlanImage, [zonePoly], True, color, 2)
+            layer.polylines([zonePoly], True, color, 2)
 
             # Calculate zone centroid for text placement
             centroidX = int(np.mean(zonePoly[:, 0]))
             centroidY = int(np.mean(zonePoly[:, 1]))
 
             # Draw zone name
-            cv2.putText(
-                floorPlanImage,
+            layer.putText(
                 zoneName,
                 (centroidX - 40, centroidY),
                 cv2.FONT_HERSHEY_SIMPLEX,
@@ -240,31 +413,26 @@ class DwellTimeAnalysis:
                 2,
             )
 
-        return floorPlanImage
+    def drawZones(self, floorPlanImage):
+        # The zones are rendered once into a cached layer and blended in one pass
+        layer = self.layerCache.get(
+            "zones", self.getZoneKey(), floorPlanImage.shape, self.renderZones
+        )
+        layer.composite(floorPlanImage)
 
-    def drawDwellTimes(
-        self, image, currentPositions=None, trackIDs=None, isFloorPlan=True
-    ):
-        # If this is floor plan, draw the zones
-        if isFloorPlan:
-            image = self.drawZones(image)
+        return floorPlanImage
 
-        # Draw statistics board in the top-right corner
-        boardWidth = 300
-        boardHeight = len(self.zones) * 30 + 120  # Height based on number of zones
-        boardX = image.shape[1] - boardWidth - 10  # 10px padding from right edge
-        boardY = 10  # 10px padding from top
+    def renderStatsBoard(self, layer, boardX, boardY, boardWidth, boardHeight):
+        # Static part of the statistics board: background, title, swatches and names
 
         # Create semi-transparent board background
-        cv2.rectangle(
-            image,
+        layer.rectangle(
             (boardX, boardY),
             (boardX + boardWidth, boardY + boardHeight),
             (50, 50, 50),
             -1,
         )  # Dark gray background
-        cv2.rectangle(
-            image,
+        layer.rectangle(
             (boardX, boardY),
             (boardX + boardWidth, boardY + boardHeight),
             (200, 200, 200),
@@ -272,8 +440,7 @@ class DwellTimeAnalysis:
         )  # Light gray border
 
         # Add title to stats board
-        cv2.putText(
-            image,
+        layer.putText(
             "Zone Statistics",
             (boardX + 10, boardY + 25),
             cv2.FONT_HERSHEY_SIMPLEX,
@@ -282,19 +449,15 @@ class DwellTimeAnalysis:
             2,
         )
 
-        # Draw zone statistics in the board
         statsY = boardY + 55  # Start below title
-        for zoneID, (zoneName, _, color) in enumerate(self.zones):
-            stats = self.zoneStats[zoneID]
-
+        for zoneName, _, color in self.zones:
             # Draw color swatch for this zone
-            cv2.rectangle(
-                image, (boardX + 10, statsY - 15), (boardX + 30, statsY), color, -1
+            layer.rectangle(
+                (boardX + 10, statsY - 15), (boardX + 30, statsY), color, -1
             )
 
             # Zone name
-            cv2.putText(
-                image,
+            layer.putText(
                 f"{zoneName}",
                 (boardX + 40, statsY),
                 cv2.FONT_HERSHEY_SIMPLEX,
@@ -303,6 +466,37 @@ class DwellTimeAnalysis:
                 1,
             )
 
+            statsY += 55  # Move to next zone stats position
+
+    def drawDwellTimes(
+        self, image, currentPositions=None, trackIDs=None, isFloorPlan=True
+    ):
+        # If this is floor plan, draw the zones
+        if isFloorPlan:
+            image = self.drawZones(image)
+
+        # Draw statistics board in the top-right corner
+        boardWidth = 300
+        boardHeight = len(self.zones) * 30 + 120  # Height based on number of zones
+        boardX = image.shape[1] - boardWidth - 10  # 10px padding from right edge
+        boardY = 10  # 10px padding from top
+
+        # The board background, title and zone names come from a cached layer
+        board = self.layerCache.get(
+            "statsBoard",
+            (self.getZoneKey(), boardX, boardY),
+            image.shape,
+            lambda layer: self.renderStatsBoard(
+                layer, boardX, boardY, boardWidth, boardHeight
+            ),
+        )
+        board.composite(image)
+
+        # Draw the zone statistics in the board
+        statsY = boardY + 55  # Start below title
+        for zoneID in range(len(self.zones)):
+            stats = self.zoneStats[zoneID]
+
             # Current count, average dwell time and max dwell time
             cv2.putText(
                 image,
@@ -320,9 +514,7 @@ class DwellTimeAnalysis:
         if currentPositions and trackIDs:
             # For floor plan, transform camera points to floor coordinates
             if isFloorPlan:
-                positionsToUse = self.transformPointsToFloor(
-                    np.array(currentPositions)
-                )
+                positionsToUse = self.transformPointsToFloor(np.array(currentPositions))
             else:
                 # For camera view, use original camera coordinates
                 positionsToUse = np.array(currentPositions)
@@ -336,33 +528,36 @@ class DwellTimeAnalysis:
 
                 personPos = tuple(map(int, positionsToUse[idx]))
 
-                # Check if this person is in any zone and display their dwell time
-                for zoneID, (zoneName, zonePoly, color) in enumerate(self.zones):
-                    if (
-                        trackID in currentDwellTimes
-                        and zoneID in currentDwellTimes[trackID]
-                    ):
-                        dwellTime = currentDwellTimes[trackID][zoneID]
-
-                        # Draw dwell time near the person's position
-                        cv2.putText(
-                            image,
-                            f"{int(dwellTime)}s",
-                            (personPos[0] + 10, personPos[1]),
-                            cv2.FONT_HERSHEY_SIMPLEX,
-                            0.4,
-                            color,
-                            1,
-                        )
-
-                        # Draw circle around person colored by dwell time (redder = longer)
-                        maxDwell = 60  # Consider 60 seconds as maximum intensity
-                        intensity = min(dwellTime / maxDwell, 1.0)
-                        dwellColour = (
-                            0,
-                            int(255 * (1 - intensity)),
-                            int(255 * intensity),
-                        )
-                        cv2.circle(image, personPos, 10, dwellColour, -1)
+                # Display the dwell time of this person in each of their zones,
+                # one label per zone stacked below each other
+                zoneIDs = sorted(self.trackZones.get(int(trackID), ()))
+                if not zoneIDs:
+                    continue
+                dwellTimes = currentDwellTimes[int(trackID)]
+                for line, zoneID in enumerate(zoneIDs):
+                    color = self.zones[zoneID][2]
+
+                    # Draw dwell time near the person's position
+                    cv2.putText(
+                        image,
+                        f"{int(dwellTimes[zoneID])}s",
+                        (personPos[0] + 10, personPos[1] + 12 * line),
+                        cv2.FONT_HERSHEY_SIMPLEX,
+                        0.4,
+                        color,
+                        1,
+                    )
+
+                # Draw circle around person colored by their longest dwell time
+                # (redder = longer)
+                maxDwell = 60  # Consider 60 seconds as maximum intensity
+                dwellTime = max(dwellTimes[zoneID] for zoneID in zoneIDs)
+                intensity = min(dwellTime / maxDwell, 1.0)
+                dwellColour = (
+                    0,
+                    int(255 * (1 - intensity)),
+                    int(255 * intensity),
+                )
+                cv2.circle(image, personPos, 10, dwellColour, -1)
 
         return image
@@ -0,0 +1,112 @@
+import json
+import threading
+import time
+
+
+def diffState(previous, current):
+    # Compact delta between two published states, None when nothing changed
+    # The states map peopleCount to a number, zoneCounts and highRiskZones to
+    # dictionaries keyed by zone ID and predictedCongestion to a list of zones
+    delta = {}
+    if current["peopleCount"] != previous["peopleCount"]:
+        delta["peopleCount"] = current["peopleCount"]
+
+    zoneCounts = {
+        zoneID: count
+        for zoneID, count in current["zoneCounts"].items()
+        if previous["zoneCounts"].get(zoneID) != count
+    }
+    if zoneCounts:
+        delta["zoneCounts"] = zoneCounts
+
+    previousRisk, currentRisk = previous["highRiskZones"], current["highRiskZones"]
+    changed = {
+        zoneID: zone
+        for zoneID, zone in currentRisk.items()
+        if previousRisk.get(zoneID) != zone
+    }
+    if changed:
+        delta["highRiskZones"] = changed
+    cleared = [zoneID for zoneID in previousRisk if zoneID not in currentRisk]
+    if cleared:
+        delta["clearedHighRiskZones"] = cleared
+
+    if current["predictedCongestion"] != previous["predictedCongestion"]:
+        delta["predictedCongestion"] = current["predictedCongestion"]
+
+    return delta or None
+
+
+class EventStream:
+    def __init__(self, minInterval=0.2, keepAlive=15.0):
+        # Pushes the analytics state to Server-Sent Events clients
+        # A new client first receives the full state, then only deltas
+        # Every client sends at most one message per minInterval seconds, states
+        # published in between are coalesced, so slow clients always jump to the
+        # newest state instead of building a backlog
+        # keepAlive is how often a comment is sent while nothing changes, so
+        # proxies do not close an idle connection
+        self.minInterval = minInterval
+        self.keepAlive = keepAlive
+
+        # The latest state and its sequence number, guarded by the condition
+        self.condition = threading.Condition()
+        self.state = None
+        self.sequence = 0
+        self.subscribers = 0
+
+    def publish(self, state):
+        # The state must not be modified by the caller after it was published
+        with self.condition:
+            self.state = state
+            self.sequence += 1
+            self.condition.notify_all()
+
+    def waitForState(self, lastSequence):
+        # Return (sequence, state) for the newest state after lastSequence,
+        # (lastSequence, None) when nothing was published before the keep alive
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.sequence > lastSequence, timeout=self.keepAlive
+            )
+            if self.sequence <= lastSequence:
+                return lastSequence, None
+            return self.sequence, self.state
+
+    def formatEvent(self, event, sequence, data):
+        data = dict(data, seq=sequence, timestamp=time.time())
+        return (
+            f"event: {event}\nid: {sequence}\n"
+            f"data: {json.dumps(data, separators=(',', ':'))}\n\n"
+        )
+
+    def subscribe(self):
+        # Generator for a text/event-stream response
+        with self.condition:
+            self.subscribers += 1
+
+        try:
+            lastSequence, lastState = 0, None
+            while True:
+                sequence, state = self.waitForState(lastSequence)
+                if state is None:
+                    yield ": keep-alive\n\n"
+                    continue
+
+                if lastState is None:
+                    yield self.formatEvent("state", sequence, state)
+                else:
+                    delta = diffState(lastState, state)
+                    if delta is not None:
+                        yield self.formatEvent("delta", sequence, delta)
+                lastSequence, lastState = sequence, state
+
+                # Coalesce the states published while this client waits
+                time.sleep(self.minInterval)
+        finally:
+            with self.condition:
+                self.subscribers -= 1
+
+    def subscriberCount(self):
+        with self.condition:
+            return self.subscribers
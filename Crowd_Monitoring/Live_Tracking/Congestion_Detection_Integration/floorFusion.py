@@ -0,0 +1,336 @@
+import threading
+import time
+import cv2
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+from densityGrid import DensityGrid
+
+
+class FloorFusion:
+    def __init__(
+        self,
+        venueWidth=2000,
+        venueHeight=2000,
+        gateDistance=40,
+        maxTimeDifference=0.2,
+        maxAge=1.0,
+        trackTTL=10.0,
+        cellSize=50,
+    ):
+        # Merges the floor plan positions of several cameras into one venue map
+        # gateDistance is the venue distance within which observations of two
+        # cameras can belong to the same person
+        # maxTimeDifference is the largest difference in seconds between the frames
+        # of two observations that are associated
+        # maxAge is the age in seconds after which the data of a camera is ignored
+        # trackTTL is how long a camera track keeps its global ID after it was last seen
+        self.venueWidth = venueWidth
+        self.venueHeight = venueHeight
+        self.gateDistance = gateDistance
+        self.maxTimeDifference = maxTimeDifference
+        self.maxAge = maxAge
+        self.trackTTL = trackTTL
+
+        # cameras maps a camera name to its floor to venue transform and processor
+        # observations maps a camera name to its latest (timestamp, trackIDs, positions)
+        # globalIDs maps (camera, trackID) to [globalID, lastSeen]
+        self.cameras = {}
+        self.observations = {}
+        self.globalIDs = {}
+        self.nextGlobalID = 1
+        self.lastExpiry = 0.0
+
+        # One occupancy and congestion grid for the whole venue
+        self.densityGrid = DensityGrid(venueWidth, venueHeight, cellSize)
+
+        self.lock = threading.Lock()
+        self.latestFusion = None
+        self.running = False
+        self.thread = None
+
+    def addCamera(self, name, floorToVenue=None, processor=None):
+        # floorToVenue is the 3x3 homography from the floor plan of this camera to
+        # the venue map, identity when the camera already uses venue coordinates
+        # processor is an optional CameraProcessor whose analytics are collected
+        if floorToVenue is None:
+            floorToVenue = np.eye(3)
+        with self.lock:
+            self.cameras[name] = {
+                "floorToVenue": np.asarray(floorToVenue, dtype=np.float64),
+                "processor": processor,
+            }
+
+    def update(self, cameraName, trackIDs, floorPositions, timestamp=None):
+        # Store the latest floor positions of the people seen by one camera
+        if timestamp is None:
+            timestamp = time.time()
+
+        positions = np.asarray(floorPositions, dtype=np.float32).reshape(-1, 1, 2)
+        with self.lock:
+            floorToVenue = self.cameras[cameraName]["floorToVenue"]
+            if len(positions):
+                positions = cv2.perspectiveTransform(positions, floorToVenue)
+            self.observations[cameraName] = (
+                timestamp,
+                np.asarray(trackIDs, dtype=np.int64).reshape(-1),
+                positions.reshape(-1, 2),
+            )
+
+    def collect(self):
+        # Pull the latest analytics of the registered CameraProcessors
+        for name, camera in list(self.cameras.items()):
+            processor = camera["processor"]
+            if processor is None:
+                continue
+            analytics = processor.getAnalytics()
+            if analytics is None:
+                continue
+            people = analytics["people"]
+            self.update(
+                name,
+                [person["trackID"] for person in people],
+                [person["floorPosition"] for person in people],
+                analytics["timestamp"],
+            )
+
+    def gatherObservations(self, now):
+        # Observations of all cameras whose data is recent enough, as flat arrays
+        names, cameraIndices, trackIDs, positions, timestamps = [], [], [], [], []
+        for name, (timestamp, cameraTrackIDs, cameraPositions) in sorted(
+            self.observations.items()
+        ):
+            if now - timestamp > self.maxAge or len(cameraTrackIDs) == 0:
+                continue
+            names.append(name)
+            cameraIndices.append(np.full(len(cameraTrackIDs), len(names) - 1))
+            trackIDs.append(cameraTrackIDs)
+            positions.append(cameraPositions)
+            timestamps.append(np.full(len(cameraTrackIDs), timestamp))
+
+        if not names:
+            return names, None, None, None, None
+        return (
+            names,
+            np.concatenate(cameraIndices),
+            np.concatenate(trackIDs),
+            np.concatenate(positions),
+            np.concatenate(timestamps),
+        )
+
+    def associate(self, cameraIndices, positions, timestamps):
+        # Group the observations of the same person seen by overlapping cameras
+        # Two observations are linked when they come from different cameras, lie
+        # within the gate distance, are close enough in time and each is the nearest
+        # observation of its camera to the other one
+        # Returns one group label per observation
+        count = len(positions)
+        cameraCount = int(cameraIndices.max()) + 1
+        if cameraCount == 1 or count == 1:
+            return np.arange(count)
+
+        # Nearest neighbours of every observation within the gate, sorted by distance
+        # Few people fit within the gate, so a couple of neighbours per camera suffice
+        k = min(count, cameraCount * 2)
+        distances, neighbours = cKDTree(positions).query(
+            positions, k=k, distance_upper_bound=self.gateDistance
+        )
+        rows = np.repeat(np.arange(count), k)
+        neighbours = neighbours.ravel()
+        valid = neighbours < count
+        rows, neighbours = rows[valid], neighbours[valid]
+
+        # Keep only the nearest observation of every other camera
+        otherCamera = cameraIndices[neighbours] != cameraIndices[rows]
+        inTime = (
+            np.abs(timestamps[neighbours] - timestamps[rows]) <= self.maxTimeDifference
+        )
+        keep = otherCamera & inTime
+        rows, neighbours = rows[keep], neighbours[keep]
+        _, first = np.unique(
+            rows * cameraCount + cameraIndices[neighbours], return_index=True
+        )
+        rows, neighbours = rows[first], neighbours[first]
+
+        # Both observations must choose each other
+        keys = rows * count + neighbours
+        mutual = np.isin(neighbours * count + rows, keys)
+        rows, neighbours = rows[mutual], neighbours[mutual]
+
+        graph = coo_matrix(
+            (np.ones(len(rows), dtype=np.int8), (rows, neighbours)),
+            shape=(count, count),
+        )
+        _, labels = connected_components(graph, directed=False)
+        return labels
+
+    def assignGlobalIDs(self, names, cameraIndices, trackIDs, labels, now):
+        # A group keeps the oldest global ID of its camera tracks, so a person keeps
+        # their ID while walking from one camera view into the next
+        keys = [
+            (names[camera], int(trackID))
+            for camera, trackID in zip(cameraIndices, trackIDs)
+        ]
+        groupCount = int(labels.max()) + 1 if len(labels) else 0
+        groupIDs = np.zeros(groupCount, dtype=np.int64)
+
+        for key, label in zip(keys, labels):
+            entry = self.globalIDs.get(key)
+            if entry is not None and (
+                groupIDs[label] == 0 or entry[0] < groupIDs[label]
+            ):
+                groupIDs[label] = entry[0]
+
+        for label in np.flatnonzero(groupIDs == 0):
+            groupIDs[label] = self.nextGlobalID
+            self.nextGlobalID += 1
+
+        for key, label in zip(keys, labels):
+            self.globalIDs[key] = [int(groupIDs[label]), now]
+
+        return groupIDs
+
+    def expireTracks(self, now):
+        # Forget the camera tracks that were not seen for trackTTL seconds
+        if now - self.lastExpiry < 1.0:
+            return
+        self.lastExpiry = now
+        for key in [
+            key
+            for key, (_, lastSeen) in self.globalIDs.items()
+            if now - lastSeen > self.trackTTL
+        ]:
+            del self.globalIDs[key]
+
+    def fuse(self, now=None):
+        # Build the venue wide occupancy from the latest observations of all cameras
+        if now is None:
+            now = time.time()
+
+        with self.lock:
+            names, cameraIndices, trackIDs, positions, timestamps = (
+                self.gatherObservations(now)
+            )
+
+            people = []
+            if names:
+                labels = self.associate(cameraIndices, positions, timestamps)
+                groupIDs = self.assignGlobalIDs(
+                    names, cameraIndices, trackIDs, labels, now
+                )
+
+                # The position of a person is the mean of their observations
+                groupCount = len(groupIDs)
+                counts = np.bincount(labels, minlength=groupCount)
+                centers = (
+                    np.stack(
+                        [
+                            np.bincount(
+                                labels, weights=positions[:, 0], minlength=groupCount
+                            ),
+                            np.bincount(
+                                labels, weights=positions[:, 1], minlength=groupCount
+                            ),
+                        ],
+                        axis=1,
+                    )
+                    / counts[:, np.newaxis]
+                )
+
+                groupCameras = [[] for _ in range(groupCount)]
+                for camera, label in zip(cameraIndices, labels):
+                    groupCameras[label].append(names[camera])
+
+                for label in range(groupCount):
+                    people.append(
+                        {
+                            "globalID": int(groupIDs[label]),
+                            "position": [
+                                float(centers[label, 0]),
+                                float(centers[label, 1]),
+                            ],
+                            "cameras": groupCameras[label],
+                        }
+                    )
+                zones = self.densityGrid.update(groupIDs, centers)
+            else:
+                zones = self.densityGrid.update([], np.empty((0, 2)))
+
+            self.expireTracks(now)
+
+            fusion = {
+                "timestamp": now,
+                "occupancy": len(people),
+                "observations": 0 if not names else len(trackIDs),
+                "people": people,
+                "congestionZones": [
+                    {
+                        "center": [int(center[0]), int(center[1])],
+                        "radius": int(radius),
+                        "count": int(count),
+                    }
+                    for center, radius, count in zones
+                ],
+                "cameras": {
+                    name: {
+                        "people": len(self.observations[name][1]),
+                        "age": now - self.observations[name][0],
+                    }
+                    for name in self.observations
+                },
+            }
+            self.latestFusion = fusion
+        return fusion
+
+    def getFusion(self):
+        with self.lock:
+            return self.latestFusion
+
+    def start(self, interval=0.1):
+        # Collect the camera analytics and fuse them on a background thread
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(
+            target=self.fusionLoop, args=(interval,), daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(2.0)
+            self.thread = None
+
+    def fusionLoop(self, interval):
+        while self.running:
+            startTime = time.time()
+            self.collect()
+            self.fuse()
+            time.sleep(max(interval - (time.time() - startTime), 0))
+
+    def drawVenue(self, venueImage=None):
+        # Venue map with the congested cells and every fused person
+        if venueImage is None:
+            venueImage = np.full(
+                (self.venueHeight, self.venueWidth, 3), 255, dtype=np.uint8
+            )
+        self.densityGrid.drawDensity(venueImage)
+
+        fusion = self.getFusion()
+        for person in fusion["people"] if fusion else []:
+            center = tuple(int(value) for value in person["position"])
+            # People seen by several cameras are drawn in a different color
+            color = (255, 0, 0) if len(person["cameras"]) > 1 else (0, 128, 0)
+            cv2.circle(venueImage, center, 6, color, -1)
+            cv2.putText(
+                venueImage,
+                str(person["globalID"]),
+                (center[0] + 8, center[1]),
+                cv2.FONT_HERSHEY_SIMPLEX,
+                0.4,
+                color,
+                1,
+            )
+        return venueImage
@@ -1,19 +1,9 @@
 import cv2
 import numpy as np
 
-def floorReplica(canvasHeight, canvasWidth, tilesX, tilesY, rtspUrl):
-    # Create a VideoCapture object
-    cap = cv2.VideoCapture(rtspUrl)
-
-    # Check if camera opened successfully
-    success, frame = cap.read()
-    if not success:
-        cap.release()
-        cap = cv2.VideoCapture(rtspUrl)
-        success, frame = cap.read()
-        if not success:
-            raise Exception("Failed to read video stream - floorReplica.py")
-    
+def floorReplica(canvasHeight, canvasWidth, tilesX, tilesY):
+    # The floor plan only depends on the canvas and tile sizes, the video stream
+    # is not opened here
     tileHeight = canvasHeight // tilesY
     tileWidth = canvasWidth // tilesX
 
@@ -0,0 +1,180 @@
+import queue
+import threading
+import time
+
+
+class StageStats:
+    def __init__(self, name):
+        # Counters for a single pipeline stage
+        # latency values are stored in seconds and reported in milliseconds
+        self.name = name
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.totalLatency = 0.0
+        self.maxLatency = 0.0
+        self.lastLatency = 0.0
+        self.startTime = time.time()
+        self.lock = threading.Lock()
+
+    def record(self, latency):
+        with self.lock:
+            self.processed += 1
+            self.totalLatency += latency
+            self.lastLatency = latency
+            self.maxLatency = max(self.maxLatency, latency)
+
+    def recordDrop(self):
+        with self.lock:
+            self.dropped += 1
+
+    def recordError(self):
+        with self.lock:
+            self.errors += 1
+
+    def snapshot(self, queueDepth=0):
+        with self.lock:
+            elapsed = max(time.time() - self.startTime, 1e-6)
+            averageLatency = self.totalLatency / self.processed if self.processed else 0
+            return {
+                "queueDepth": queueDepth,
+                "processed": self.processed,
+                "dropped": self.dropped,
+                "errors": self.errors,
+                "fps": self.processed / elapsed,
+                "avgLatencyMs": averageLatency * 1000,
+                "maxLatencyMs": self.maxLatency * 1000,
+                "lastLatencyMs": self.lastLatency * 1000,
+            }
+
+
+class FramePipeline:
+    def __init__(self, source, stages, sink, queueSize=2):
+        # source is a callable returning (success, frame) like cv2.VideoCapture.read
+        # stages is an ordered list of (name, function, dropWhenFull) tuples, each stage
+        # receives the output of the previous one and runs on its own worker thread
+        # dropWhenFull stages discard their oldest queued input instead of blocking the
+        # upstream stage, which suits stateless stages such as rendering
+        # sink is called with the output of the last stage
+        self.source = source
+        self.stages = stages
+        self.sink = sink
+        self.queues = [queue.Queue(maxsize=queueSize) for _ in stages]
+        self.stats = {"capture": StageStats("capture")}
+        for name, _, _ in stages:
+            self.stats[name] = StageStats(name)
+
+        self.running = False
+        self.threads = []
+
+    def start(self):
+        if self.running:
+            return
+
+        self.running = True
+        self.threads = [
+            threading.Thread(target=self.captureWorker, name="capture", daemon=True)
+        ]
+        for index, (name, _, _) in enumerate(self.stages):
+            self.threads.append(
+                threading.Thread(
+                    target=self.stageWorker, args=(index,), name=name, daemon=True
+                )
+            )
+
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self, timeout=2.0):
+        self.running = False
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def captureWorker(self):
+        stats = self.stats["capture"]
+
+        while self.running:
+            startTime = time.perf_counter()
+            success, frame = self.source()
+            if not success:
+                stats.recordError()
+                time.sleep(0.01)
+                continue
+
+            stats.record(time.perf_counter() - startTime)
+
+            # The camera cannot be paused, so the capture stage always keeps the
+            # newest frame and drops the oldest one if detection falls behind
+            self.putLatest(self.queues[0], frame, self.stats[self.stages[0][0]])
+
+    def stageWorker(self, index):
+        name, function, _ = self.stages[index]
+        stats = self.stats[name]
+        inputQueue = self.queues[index]
+
+        while self.running:
+            try:
+                item = inputQueue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            startTime = time.perf_counter()
+            try:
+                result = function(item)
+            except Exception as e:
+                print(f"Pipeline stage '{name}' failed: {e}")
+                stats.recordError()
+                continue
+            stats.record(time.perf_counter() - startTime)
+
+            # A stage returning None ends the processing of this item
+            if result is None:
+                continue
+
+            if index + 1 == len(self.stages):
+                self.sink(result)
+                continue
+
+            nextName, _, dropWhenFull = self.stages[index + 1]
+            if dropWhenFull:
+                self.putLatest(self.queues[index + 1], result, self.stats[nextName])
+            else:
+                self.putBlocking(self.queues[index + 1], result)
+
+    def putLatest(self, targetQueue, item, stats):
+        # Insert the item, discarding the oldest queued item when the queue is full
+        while True:
+            try:
+                targetQueue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    targetQueue.get_nowait()
+                    stats.recordDrop()
+                except queue.Empty:
+                    pass
+
+    def putBlocking(self, targetQueue, item):
+        # Apply backpressure to the upstream stage but keep checking for shutdown
+        while self.running:
+            try:
+                targetQueue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def getStats(self):
+        # Queue depth is reported against the stage that consumes the queue
+        stats = {"capture": self.stats["capture"].snapshot()}
+        for index, (name, _, _) in enumerate(self.stages):
+            stats[name] = self.stats[name].snapshot(self.queues[index].qsize())
+        return stats
+
+    def getBottleneck(self):
+        # The stage with the highest average latency limits the pipeline throughput
+        stats = self.getStats()
+        stageNames = [name for name, _, _ in self.stages]
+        if not stageNames:
+            return None
+        return max(stageNames, key=lambda name: stats[name]["avgLatencyMs"])
@@ -0,0 +1,153 @@
+import queue
+import time
+import cv2
+from trailRenderer import TrailRenderer
+from resilientCapture import ResilientCapture
+
+# Capture counters published by the capture process, see ResilientCapture.getStats
+CAPTURE_STATS = (
+    "connected",
+    "decoded",
+    "dropped",
+    "failedReads",
+    "reconnects",
+    "decodeFps",
+    "avgDecodeMs",
+    "maxDecodeMs",
+)
+
+
+def captureFrames(source, ring, stats=None):
+    # Capture process: copy the frames of the source into the slots of the shared
+    # frame ring until the ring is stopped
+    # The source is read through a ResilientCapture, which keeps only the newest
+    # frame, reads video files at their own frame rate like a live camera and
+    # reopens a lost stream with an exponential backoff
+    # stats is an optional shared array the capture counters are published in,
+    # in the order of CAPTURE_STATS
+    cap = ResilientCapture(source)
+    lastPublished = 0.0
+
+    try:
+        while not ring.isStopped():
+            success, frame = cap.read(timeout=0.5)
+            if stats is not None and time.monotonic() - lastPublished >= 1.0:
+                captureStats = cap.getStats()
+                stats[:] = [float(captureStats[name]) for name in CAPTURE_STATS]
+                lastPublished = time.monotonic()
+            if not success:
+                if not cap.isOpened():
+                    break
+                continue
+
+            slot = ring.acquireWrite()
+            if slot is None:
+                # Every slot is held by a reader, skip the frame to stay live
+                continue
+            view = ring.frame(slot)
+            if frame.shape != view.shape:
+                print(f"Frame size changed to {frame.shape}, expected {view.shape}")
+                ring.abortWrite(slot)
+                continue
+            view[...] = frame
+            ring.commitWrite(slot, time.time())
+    finally:
+        cap.release()
+
+
+def drawRenderItem(frame, floorFrame, item):
+    # Draw the boxes, trails, congestion and high-risk zones of an analysed frame
+    # item holds the boxes, trackIDs, trails and JSON analytics of the frame
+    analytics = item["analytics"]
+    for (x, y, w, h), trackID in zip(item["boxes"], item["trackIDs"]):
+        cv2.rectangle(
+            frame,
+            (int(x - w / 2), int(y - h / 2)),
+            (int(x + w / 2), int(y + h / 2)),
+            (0, 255, 0),
+            2,
+        )
+        cv2.putText(
+            frame,
+            f"ID: {int(trackID)}",
+            (int(x - w / 2), int(y - h / 2) - 10),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.5,
+            (0, 255, 0),
+            2,
+        )
+    TrailRenderer.draw(floorFrame, item["trails"])
+
+    if analytics is None:
+        return
+    for zone in analytics["congestionZones"]:
+        cv2.circle(frame, tuple(zone["center"]), zone["radius"], (0, 0, 255), 2)
+    for zone in analytics["predictedCongestion"]:
+        cv2.circle(frame, tuple(zone["center"]), zone["radius"], (0, 165, 255), 2)
+    for zone in analytics["floorCongestionZones"]:
+        cv2.circle(floorFrame, tuple(zone["center"]), zone["radius"], (0, 0, 255), 2)
+    for riskZone in analytics["highRiskZones"]:
+        centroid = tuple(riskZone["centroid"])
+        cv2.circle(floorFrame, centroid, 25, (0, 0, 255), -1)
+        cv2.putText(
+            floorFrame,
+            f"{riskZone['zoneName']}: {riskZone['riskScore']:.2f}",
+            (centroid[0] - 70, centroid[1] + 45),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.5,
+            (0, 0, 255),
+            2,
+        )
+
+    cv2.putText(
+        frame,
+        f"Mode: {analytics['analysisMode'].capitalize()}",
+        (20, 30),
+        cv2.FONT_HERSHEY_SIMPLEX,
+        0.7,
+        (255, 255, 255),
+        2,
+    )
+    cv2.putText(
+        frame,
+        f"People: {analytics['peopleCount']}",
+        (20, 60),
+        cv2.FONT_HERSHEY_SIMPLEX,
+        0.7,
+        (255, 255, 255),
+        2,
+    )
+
+
+def renderFrames(ring, renderQueue, commandQueue, floorImage):
+    # Render process: draw the analysed frames and show them in windows
+    # The analytics process holds every slot it puts on renderQueue, this process
+    # releases it, stale items are skipped so the display never lags behind
+    # Key presses are sent back on commandQueue ("quit" or "mode")
+    while True:
+        item = renderQueue.get()
+        while item is not None:
+            try:
+                newer = renderQueue.get_nowait()
+            except queue.Empty:
+                break
+            ring.release(item["slot"])
+            item = newer
+        if item is None:
+            break
+
+        # Copy the frame out of the slot so the capture process can reuse it
+        frame = ring.frame(item["slot"]).copy()
+        ring.release(item["slot"])
+        floorFrame = floorImage.copy()
+        drawRenderItem(frame, floorFrame, item)
+
+        cv2.imshow("Camera View", frame)
+        cv2.imshow("Floor Plan View", floorFrame)
+        key = cv2.waitKey(1) & 0xFF
+        if key == ord("q"):
+            commandQueue.put("quit")
+        elif key == ord("m"):
+            commandQueue.put("mode")
+
+    cv2.destroyAllWindows()
@@ -0,0 +1,186 @@
+import cv2
+import numpy as np
+
+
+class OverlayLayer:
+    def __init__(self, shape=None):
+        # canvas holds the colours of everything drawn on the layer and alpha holds
+        # their opacity (0-255), the last shape drawn on a pixel wins
+        # dirty is the bounding box (x0, y0, x1, y1) of everything drawn so far,
+        # so clearing and compositing only touch that part of the frame
+        # origin is the position of the layer in the frame once it was trimmed
+        # levels holds the distinct opacities drawn, each is blended with one addWeighted
+        self.canvas = None
+        self.alpha = None
+        self.dirty = None
+        self.origin = (0, 0)
+        self.levels = set()
+        if shape is not None:
+            self.begin(shape)
+
+    def begin(self, shape):
+        # Start a new frame, the buffers are only reallocated when the size changes
+        height, width = shape[:2]
+        if (
+            self.origin != (0, 0)
+            or self.canvas is None
+            or self.canvas.shape[:2] != (height, width)
+        ):
+            self.canvas = np.zeros((height, width, 3), dtype=np.uint8)
+            self.alpha = np.zeros((height, width), dtype=np.uint8)
+            self.origin = (0, 0)
+        elif self.dirty is not None:
+            x0, y0, x1, y1 = self.dirty
+            self.canvas[y0:y1, x0:x1] = 0
+            self.alpha[y0:y1, x0:x1] = 0
+        self.dirty = None
+        self.levels = set()
+        return self
+
+    def markDirty(self, x0, y0, x1, y1):
+        height, width = self.alpha.shape
+        x0, y0 = max(int(x0), 0), max(int(y0), 0)
+        x1, y1 = min(int(x1) + 1, width), min(int(y1) + 1, height)
+        if x0 >= x1 or y0 >= y1:
+            return
+        if self.dirty is None:
+            self.dirty = (x0, y0, x1, y1)
+        else:
+            dx0, dy0, dx1, dy1 = self.dirty
+            self.dirty = (min(dx0, x0), min(dy0, y0), max(dx1, x1), max(dy1, y1))
+
+    def opacity(self, alpha):
+        level = int(round(min(max(alpha, 0.0), 1.0) * 255))
+        self.levels.add(level)
+        return level
+
+    def circle(self, center, radius, color, thickness=1, alpha=1.0):
+        cv2.circle(self.canvas, center, radius, color, thickness)
+        cv2.circle(self.alpha, center, radius, self.opacity(alpha), thickness)
+        margin = radius + max(thickness, 0)
+        self.markDirty(
+            center[0] - margin,
+            center[1] - margin,
+            center[0] + margin,
+            center[1] + margin,
+        )
+
+    def rectangle(self, pt1, pt2, color, thickness=1, alpha=1.0):
+        cv2.rectangle(self.canvas, pt1, pt2, color, thickness)
+        cv2.rectangle(self.alpha, pt1, pt2, self.opacity(alpha), thickness)
+        margin = max(thickness, 0)
+        self.markDirty(
+            min(pt1[0], pt2[0]) - margin,
+            min(pt1[1], pt2[1]) - margin,
+            max(pt1[0], pt2[0]) + margin,
+            max(pt1[1], pt2[1]) + margin,
+        )
+
+    def fillPoly(self, polygons, color, alpha=1.0):
+        polygons = [np.int32(polygon).reshape(-1, 2) for polygon in polygons]
+        cv2.fillPoly(self.canvas, polygons, color)
+        cv2.fillPoly(self.alpha, polygons, self.opacity(alpha))
+        for polygon in polygons:
+            self.markDirty(*polygon.min(axis=0), *polygon.max(axis=0))
+
+    def polylines(self, polygons, isClosed, color, thickness=1, alpha=1.0):
+        polygons = [np.int32(polygon).reshape(-1, 2) for polygon in polygons]
+        cv2.polylines(self.canvas, polygons, isClosed, color, thickness)
+        cv2.polylines(self.alpha, polygons, isClosed, self.opacity(alpha), thickness)
+        for polygon in polygons:
+            low = polygon.min(axis=0) - thickness
+            high = polygon.max(axis=0) + thickness
+            self.markDirty(*low, *high)
+
+    def putText(self, text, origin, fontFace, fontScale, color, thickness=1, alpha=1.0):
+        # The text is rasterised into a small mask first and thresholded, so every
+        # text pixel gets exactly the requested opacity even when OpenCV
+        # anti-aliases the glyphs
+        (textWidth, textHeight), baseline = cv2.getTextSize(
+            text, fontFace, fontScale, thickness
+        )
+        height, width = self.alpha.shape
+        x0 = max(origin[0] - thickness, 0)
+        y0 = max(origin[1] - textHeight - thickness, 0)
+        x1 = min(origin[0] + textWidth + thickness + 1, width)
+        y1 = min(origin[1] + baseline + thickness + 1, height)
+        if x0 >= x1 or y0 >= y1:
+            return
+
+        textMask = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+        cv2.putText(
+            textMask,
+            text,
+            (origin[0] - x0, origin[1] - y0),
+            fontFace,
+            fontScale,
+            255,
+            thickness,
+        )
+        textMask = cv2.compare(textMask, 128, cv2.CMP_GE)
+        self.canvas[y0:y1, x0:x1][textMask > 0] = color
+        self.alpha[y0:y1, x0:x1][textMask > 0] = self.opacity(alpha)
+        self.markDirty(x0, y0, x1 - 1, y1 - 1)
+
+    def trim(self):
+        # Keep only the drawn part of the layer, used for static layers that are
+        # rendered once and composited every frame
+        if self.dirty is None:
+            return self
+        x0, y0, x1, y1 = self.dirty
+        self.canvas = self.canvas[y0:y1, x0:x1].copy()
+        self.alpha = self.alpha[y0:y1, x0:x1].copy()
+        self.origin = (self.origin[0] + x0, self.origin[1] + y0)
+        self.dirty = (0, 0, x1 - x0, y1 - y0)
+        return self
+
+    def composite(self, image):
+        # Blend everything drawn on the layer onto the image at once,
+        # restricted to the dirty bounding box
+        if self.dirty is None:
+            return image
+
+        x0, y0, x1, y1 = self.dirty
+        originX, originY = self.origin
+        region = image[originY + y0 : originY + y1, originX + x0 : originX + x1]
+        canvas = self.canvas[y0:y1, x0:x1]
+        alpha = self.alpha[y0:y1, x0:x1]
+
+        # Pixels sharing an opacity are blended together, opaque ones are copied
+        for level in self.levels:
+            if level == 0:
+                continue
+            mask = cv2.compare(alpha, level, cv2.CMP_EQ)
+            if level == 255:
+                cv2.copyTo(canvas, mask, region)
+            else:
+                weight = level / 255
+                blended = cv2.addWeighted(canvas, weight, region, 1 - weight, 0)
+                cv2.copyTo(blended, mask, region)
+        return image
+
+
+class LayerCache:
+    def __init__(self):
+        # Pre-rendered static layers by name, each kept until its key changes
+        self.layers = {}
+
+    def get(self, name, key, shape, render):
+        # Return the cached layer, rendering it with render(layer) when the
+        # key (e.g. the zone configuration) or the frame size changed
+        # Layers are cached per frame size, so the same layer can be drawn on
+        # frames of different sizes without re-rendering every time
+        cached = self.layers.get((name, shape[:2]))
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        layer = OverlayLayer(shape)
+        render(layer)
+        layer.trim()
+        self.layers[(name, shape[:2])] = (key, layer)
+        return layer
+
+    def invalidate(self, name=None):
+        for layerName, size in list(self.layers):
+            if name is None or layerName == name:
+                del self.layers[(layerName, size)]
@@ -2,88 +2,221 @@ import cv2
 import numpy as np
 
 
+class FlowField:
+    def __init__(self, frameShape, dense=None, scale=1.0, points=None, vectors=None):
+        # frameShape is the (height, width) of the full resolution camera frame
+        # dense is a Farneback flow array computed at the given scale of the frame
+        # points and vectors are the sparse Lucas-Kanade samples in frame coordinates
+        self.frameShape = frameShape[:2]
+        self.dense = dense
+        self.scale = scale
+        self.points = np.empty((0, 2), np.float32) if points is None else points
+        self.vectors = np.empty((0, 2), np.float32) if vectors is None else vectors
+
+        # Sparse samples further away than this radius (in pixels) are ignored
+        self.searchRadius = 40
+
+    @property
+    def shape(self):
+        # Same layout as a dense flow array, so flow.shape[0] and flow.shape[1] keep working
+        return (self.frameShape[0], self.frameShape[1], 2)
+
+    def sample(self, points):
+        # Return the (dx, dy) flow vectors at the given (x, y) frame coordinates
+        # together with a mask of the points that have a valid flow vector
+        points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+        vectors = np.zeros_like(points)
+        height, width = self.frameShape
+        valid = (
+            (points[:, 0] >= 0)
+            & (points[:, 0] < width)
+            & (points[:, 1] >= 0)
+            & (points[:, 1] < height)
+        )
+
+        if len(points) == 0:
+            return vectors, valid
+
+        if self.dense is not None:
+            # Rescale the coordinates to the flow resolution and the vectors back to frame pixels
+            xs = np.clip(
+                (points[:, 0] * self.scale).astype(int), 0, self.dense.shape[1] - 1
+            )
+            ys = np.clip(
+                (points[:, 1] * self.scale).astype(int), 0, self.dense.shape[0] - 1
+            )
+            vectors[valid] = self.dense[ys[valid], xs[valid]] / self.scale
+            return vectors, valid
+
+        if len(self.points) == 0:
+            return vectors, np.zeros(len(points), dtype=bool)
+
+        # Use the nearest sparse sample for each query point
+        distances = np.sum((points[:, None, :] - self.points[None, :, :]) ** 2, axis=2)
+        nearest = np.argmin(distances, axis=1)
+        valid &= distances[np.arange(len(points)), nearest] <= self.searchRadius**2
+        vectors[valid] = self.vectors[nearest[valid]]
+        return vectors, valid
+
+    def __getitem__(self, index):
+        # Allow flow[y, x] lookups like on a dense flow array
+        y, x = index
+        vectors, _ = self.sample([(x, y)])
+        return vectors[0]
+
+
 class OpticalFlow:
-    def __init__(self, predictionStep=10, predictionScale=5):
+    def __init__(
+        self, predictionStep=10, predictionScale=5, mode="dense", downscale=0.25
+    ):
         # previousFrame and currentFrame to store the previous and current frames for optical flow calculation
         # predictionSteps and predictionScale to control the prediction steps and scale
+        # mode selects how the flow is calculated:
+        #   "dense" - Farneback over the full resolution frame
+        #   "downscaled" - Farneback over the frame resized by the downscale factor
+        #   "sparse" - pyramidal Lucas-Kanade at the tracked positions only
         self.previousFrame = None
         self.currentFrame = None
         self.predictionSteps = predictionStep
         self.predictionScale = predictionScale
+        self.mode = mode
+        self.downscale = downscale
+        self.lkParams = dict(
+            winSize=(21, 21),
+            maxLevel=3,
+            criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 30, 0.01),
+        )
+
+    def setMode(self, mode, downscale=None):
+        # The previous frame is stored at the resolution of the mode, so start over
+        if mode not in ("dense", "downscaled", "sparse"):
+            raise ValueError(f"Unknown optical flow mode: {mode}")
+        self.mode = mode
+        if downscale is not None:
+            self.downscale = downscale
+        self.previousFrame = None
 
-    def calculateFlow(self, frame):
-        # Function to calculate the optical flow using Farneback method
+    def calculateFlow(self, frame, points=None):
+        # Function to calculate the optical flow for the selected mode
+        # points are the (x, y) positions tracked in the previous frame, only used in sparse mode
         # Convert the frame to grayscale
         currentGray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if self.mode == "downscaled":
+            currentGray = cv2.resize(
+                currentGray,
+                None,
+                fx=self.downscale,
+                fy=self.downscale,
+                interpolation=cv2.INTER_AREA,
+            )
+
         if self.previousFrame is None:
             self.previousFrame = currentGray
-            return frame
-
-        # Calculate the optical flow using Farneback method
+            return None
+
+        if self.mode == "sparse":
+            flow = self.calculateSparseFlow(self.previousFrame, currentGray, points)
+            flow.frameShape = frame.shape[:2]
+        else:
+            # Calculate the optical flow using Farneback method
+            dense = cv2.calcOpticalFlowFarneback(
+                self.previousFrame, currentGray, None, 0.5, 3, 15, 3, 5, 1.2, 0
+            )
+            scale = self.downscale if self.mode == "downscaled" else 1.0
+            flow = FlowField(frame.shape, dense=dense, scale=scale)
 
-        flow = cv2.calcOpticalFlowFarneback(
-            self.previousFrame, currentGray, None, 0.5, 3, 15, 3, 5, 1.2, 0
-        )
         self.previousFrame = currentGray
         return flow
 
+    def calculateSparseFlow(self, previousGray, currentGray, points):
+        # Track the given points from the previous to the current frame with Lucas-Kanade
+        if points is None or len(points) == 0:
+            return FlowField(currentGray.shape)
+
+        previousPoints = np.asarray(points, dtype=np.float32).reshape(-1, 1, 2)
+        currentPoints, status, _ = cv2.calcOpticalFlowPyrLK(
+            previousGray, currentGray, previousPoints, None, **self.lkParams
+        )
+        tracked = status.reshape(-1) == 1
+
+        # Samples are stored at the new positions, which is where the current
+        # detections will look them up
+        currentPoints = currentPoints.reshape(-1, 2)[tracked]
+        vectors = currentPoints - previousPoints.reshape(-1, 2)[tracked]
+        return FlowField(currentGray.shape, points=currentPoints, vectors=vectors)
+
     def predictPosition(self, trackHistories, flow):
         # Function to predict the next position of each trackID based on the optical flow
         # Initialize a dictionary to store the predicted positions
         predictedPositions = {}
+        if flow is None:
+            return predictedPositions
 
-        # Iterate through each trackID and its corresponding points
-        # if the length of points is less than 2, skip the prediction
+        # Collect the last point of every track with at least 2 points
+        trackIDs = []
+        lastPoints = []
         for trackID, points in trackHistories.items():
             if len(points) < 2:
                 continue
+            trackIDs.append(trackID)
+            lastPoints.append((int(points[-1][0]), int(points[-1][1])))
 
-            # Get the last point of the track history
-            # and use it to predict the next position
-            lastPoint = points[-1]
-            x, y = int(lastPoint[0]), int(lastPoint[1])
+        if not trackIDs:
+            return predictedPositions
 
-            # Check if the point is within the bounds of the flow array
-            # get the flow vector at the last point
-            # and predict the next position
-            # then store the predicted position in the dictionary
-            if 0 <= x < flow.shape[1] and 0 <= y < flow.shape[0]:
-                dy, dx = flow[y, x]
-                predictedX = x + int(dx * self.predictionScale)
-                predictedY = y + int(dy * self.predictionScale)
+        # Sample the flow vectors at all last points at once
+        # and predict the next positions of the points inside the flow field
+        lastPoints = np.array(lastPoints, dtype=np.int32)
+        vectors, valid = flow.sample(lastPoints)
+        predicted = lastPoints + (vectors * self.predictionScale).astype(np.int32)
 
-                predictedPositions[trackID] = (predictedX, predictedY)
+        for index in np.flatnonzero(valid):
+            predictedPositions[trackIDs[index]] = (
+                int(predicted[index, 0]),
+                int(predicted[index, 1]),
+            )
 
         return predictedPositions
 
+    def trackVelocities(self, trackHistories):
+        # Last position and per frame velocity of every track with at least 2 points,
+        # the velocity is the step between its last two points
+        # Returns the trackIDs and (N, 2) position and velocity arrays
+        trackIDs = []
+        lastPoints = []
+        for trackID, points in trackHistories.items():
+            if len(points) < 2:
+                continue
+            trackIDs.append(trackID)
+            lastPoints.append((points[-2], points[-1]))
+
+        if not trackIDs:
+            return trackIDs, np.empty((0, 2), np.float32), np.empty((0, 2), np.float32)
+        lastPoints = np.asarray(lastPoints, dtype=np.float32).reshape(-1, 2, 2)
+        return trackIDs, lastPoints[:, 1], lastPoints[:, 1] - lastPoints[:, 0]
+
+    def predictTrajectories(self, positions, velocities, steps=None):
+        # Trajectories of N points moving at constant velocity as an (N, steps + 1, 2)
+        # array starting at the positions, every step moves predictionScale frames
+        # velocities are per frame displacements, e.g. the flow sampled at the
+        # positions or the velocities of trackVelocities
+        steps = self.predictionSteps if steps is None else steps
+        positions = np.asarray(positions, dtype=np.float32).reshape(-1, 2)
+        velocities = np.asarray(velocities, dtype=np.float32).reshape(-1, 2)
+        offsets = np.arange(steps + 1, dtype=np.float32) * self.predictionScale
+        return positions[:, None, :] + velocities[:, None, :] * offsets[None, :, None]
+
     def predictTrajectory(self, trackID, points, predictedPosition):
         # Function to predict the trajectory of a trackID based on the predicted position
         # Check if the length of points is less than 2 and return an empty list
         if len(points) < 2:
             return []
 
-        # Initialize the trajectory with the last point of the track history
-        currentPosition = points[-1]
-        trajectory = [currentPosition]
-
-        # Predict the next position
-        nextPosition = predictedPosition
-        trajectory.append(nextPosition)
-
-        # Iterate through the prediction steps
-        # and calculate the next positions based on the flow
-        for _ in range(self.predictionSteps - 1):
-            if len(trajectory) >= 2:
-
-                # Calculate the velocity vector based on the last two points
-                # and update the next position
-                dx = nextPosition[0] - currentPosition[0]
-                dy = nextPosition[1] - currentPosition[1]
-                nextPosition = (int(nextPosition[0] + dx), int(nextPosition[1] + dy))
-                trajectory.append(nextPosition)
-
-                # Update the current position to the last point in the trajectory
-                currentPosition = trajectory[-2]
-
-        return trajectory
-
+        # Continue the step from the last point to the predicted position
+        # for the prediction steps
+        currentPosition = np.asarray(points[-1], dtype=np.float32)
+        velocity = (
+            np.asarray(predictedPosition, dtype=np.float32) - currentPosition
+        ) / self.predictionScale
+        trajectory = np.rint(self.predictTrajectories(currentPosition, velocity)[0])
+        return [(int(x), int(y)) for x, y in trajectory]
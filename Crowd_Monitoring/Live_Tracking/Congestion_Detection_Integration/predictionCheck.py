@@ -0,0 +1,148 @@
+import argparse
+import sys
+import cv2
+import numpy as np
+from congestionDetection import CongestionDetection
+from dwellTime import DwellTimeAnalysis
+from Integration import Integration
+from opticalFlow import OpticalFlow
+
+# Randomised check of the vectorised trajectory prediction and zone lookups
+# against the per-track and per-zone loops they replaced
+
+
+def referenceTrajectory(points, predictedPosition, predictionSteps):
+    # The per-track loop of OpticalFlow.predictTrajectory before it was vectorised
+    if len(points) < 2:
+        return []
+    currentPosition = points[-1]
+    trajectory = [currentPosition]
+    nextPosition = predictedPosition
+    trajectory.append(nextPosition)
+    for _ in range(predictionSteps - 1):
+        dx = nextPosition[0] - currentPosition[0]
+        dy = nextPosition[1] - currentPosition[1]
+        nextPosition = (int(nextPosition[0] + dx), int(nextPosition[1] + dy))
+        trajectory.append(nextPosition)
+        currentPosition = trajectory[-2]
+    return trajectory
+
+
+def referenceZoneHits(integration, cameraPoints):
+    # One homography transform and one polygon test per point and zone
+    zones = integration.dwellTimeAnalysis.zones
+    hits = np.zeros((len(cameraPoints), len(zones)), dtype=bool)
+    for index, point in enumerate(cameraPoints):
+        floorPoint = cv2.perspectiveTransform(
+            np.array([[point]], dtype=np.float64), integration.homographyMatrix
+        )[0][0]
+        for zoneID, (_, zonePoly, _) in enumerate(zones):
+            hits[index, zoneID] = integration.isPointInPolygon(zonePoly, floorPoint)
+    return hits
+
+
+def referenceZoneCongestion(integration, floorCongestionCenters):
+    # The per-zone loop of the integration analysis, whether every zone is congested
+    congested = []
+    for _, zonePoly, _ in integration.dwellTimeAnalysis.zones:
+        zoneCentroid = (int(np.mean(zonePoly[:, 0])), int(np.mean(zonePoly[:, 1])))
+        zoneHasCongestion = False
+        for floorCentre, radius, _ in floorCongestionCenters:
+            distance = np.sqrt(
+                (zoneCentroid[0] - floorCentre[0]) ** 2
+                + (zoneCentroid[1] - floorCentre[1]) ** 2
+            )
+            if integration.isPointInPolygon(zonePoly, floorCentre) or distance < radius:
+                zoneHasCongestion = True
+        congested.append(zoneHasCongestion)
+    return congested
+
+
+def randomIntegration(rng, overlapping):
+    # Integration of a random camera homography, optionally with overlapping zones
+    source = np.float32([[100, 100], [1200, 120], [1250, 700], [50, 680]])
+    source += rng.uniform(-40, 40, source.shape).astype(np.float32)
+    destination = np.float32([[0, 0], [700, 0], [700, 1000], [0, 1000]])
+    homographyMatrix = cv2.getPerspectiveTransform(source, destination)
+
+    dwellTimeAnalysis = DwellTimeAnalysis(homographyMatrix)
+    if overlapping:
+        dwellTimeAnalysis.zones = [
+            ("North", np.array([[0, 0], [400, 0], [400, 600], [0, 600]]), (0, 0, 255)),
+            (
+                "East",
+                np.array([[300, 200], [700, 200], [700, 900], [300, 900]]),
+                (0, 255, 0),
+            ),
+            ("South", np.array([[100, 500], [500, 450], [350, 1000]]), (255, 0, 0)),
+        ]
+    opticalFlow = OpticalFlow(predictionStep=5, predictionScale=3)
+    integration = Integration(
+        CongestionDetection(homographyMatrix),
+        dwellTimeAnalysis,
+        opticalFlow=opticalFlow,
+    )
+    return integration, opticalFlow
+
+
+def runCheck(trials=200, seed=0):
+    # Number of mismatches between the vectorised code and the reference loops
+    rng = np.random.default_rng(seed)
+    mismatches = {"trajectories": 0, "zoneHits": 0, "zoneCongestion": 0}
+
+    for trial in range(trials):
+        integration, opticalFlow = randomIntegration(rng, overlapping=trial % 2 == 1)
+
+        # Trajectories of random tracks, one at a time as before and in one batch
+        tracks = {
+            trackID: [tuple(point) for point in rng.integers(0, 1280, (3, 2))]
+            for trackID in range(int(rng.integers(1, 30)))
+        }
+        predicted = {
+            trackID: tuple(points[-1] + rng.integers(-30, 31, 2))
+            for trackID, points in tracks.items()
+        }
+        for trackID, points in tracks.items():
+            if opticalFlow.predictTrajectory(
+                trackID, points, predicted[trackID]
+            ) != referenceTrajectory(
+                points, predicted[trackID], opticalFlow.predictionSteps
+            ):
+                mismatches["trajectories"] += 1
+
+        # Zones hit by every point of the batched trajectories
+        _, positions, velocities = opticalFlow.trackVelocities(tracks)
+        trajectories = opticalFlow.predictTrajectories(positions, velocities)
+        _, membership = integration.predictZoneHits(trajectories)
+        expected = referenceZoneHits(integration, trajectories.reshape(-1, 2))
+        mismatches["zoneHits"] += int(
+            np.count_nonzero(membership.reshape(expected.shape) != expected)
+        )
+
+        # Congestion centres matched against the zones
+        centres = [
+            (tuple(int(value) for value in rng.integers(0, 700, 2)), radius, count)
+            for radius, count in zip(rng.integers(10, 200, 5), rng.integers(1, 10, 5))
+        ]
+        integration.integrationAnalysis([], [], None, None, centres)
+        if list(integration.zoneCongestion) != referenceZoneCongestion(
+            integration, centres
+        ):
+            mismatches["zoneCongestion"] += 1
+
+    return mismatches
+
+
+if __name__ == "__main__":
+    # Usage: python predictionCheck.py --trials 200
+    parser = argparse.ArgumentParser(
+        description="Compare the vectorised prediction with the reference loops"
+    )
+    parser.add_argument("--trials", type=int, default=200, help="random scenes")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    mismatches = runCheck(args.trials, args.seed)
+    for name, count in mismatches.items():
+        print(f"{name:>15}: {count} mismatches")
+    sys.exit(1 if any(mismatches.values()) else 0)
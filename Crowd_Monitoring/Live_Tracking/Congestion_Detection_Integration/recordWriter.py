@@ -0,0 +1,168 @@
+import threading
+from collections import deque
+from pymongo.errors import BulkWriteError
+
+# Error code of a duplicate _id, returned when a batch is retried after it was
+# partly written before a connection failure
+DUPLICATE_KEY = 11000
+
+
+class RecordWriter:
+    def __init__(
+        self,
+        collection,
+        batchSize=100,
+        flushInterval=2.0,
+        maxBuffer=10000,
+        maxRetryDelay=30.0,
+        setup=None,
+    ):
+        # Writes records to a MongoDB collection on a background thread
+        # add() only appends to an in-memory buffer, so the video loop never waits
+        # for the database, the buffer is written with insert_many as soon as it
+        # holds batchSize records or flushInterval seconds have passed
+        # maxBuffer bounds the memory used during an outage, the oldest records are
+        # dropped first when it is full
+        # Failed writes are retried with an exponential backoff up to maxRetryDelay
+        # setup is called on the writer thread before the first write, e.g. to
+        # create the indexes, and repeated until it succeeds
+        self.collection = collection
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.maxRetryDelay = maxRetryDelay
+        self.setup = setup
+        self.setupDone = setup is None
+
+        self.buffer = deque(maxlen=maxBuffer)
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+        self.retryDelay = 0.0
+
+        # Metrics
+        self.written = 0
+        self.dropped = 0
+        self.failedWrites = 0
+        self.lastError = None
+
+        self.start()
+
+    def add(self, record):
+        with self.condition:
+            if len(self.buffer) == self.buffer.maxlen:
+                self.dropped += 1
+            self.buffer.append(record)
+            if len(self.buffer) >= self.batchSize:
+                self.condition.notify()
+
+    def start(self):
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+            self.thread = threading.Thread(target=self.writerLoop, daemon=True)
+            self.thread.start()
+
+    def close(self, timeout=5.0):
+        # Stop the writer thread after a last attempt to write the buffer
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def writerLoop(self):
+        while True:
+            with self.condition:
+                if self.retryDelay:
+                    # The last write failed, wait for the retry delay
+                    self.condition.wait_for(
+                        lambda: not self.running, timeout=self.retryDelay
+                    )
+                else:
+                    # Wait for a full batch or the flush interval
+                    self.condition.wait_for(
+                        lambda: not self.running or len(self.buffer) >= self.batchSize,
+                        timeout=self.flushInterval,
+                    )
+                running = self.running
+
+            self.flush()
+            if not running:
+                return
+
+    def flush(self):
+        # Write everything that is buffered, in batches of batchSize records
+        if not self.setupDone:
+            try:
+                self.setup()
+                self.setupDone = True
+            except Exception as e:
+                self.lastError = str(e)
+
+        while True:
+            with self.condition:
+                batch = [
+                    self.buffer.popleft()
+                    for _ in range(min(self.batchSize, len(self.buffer)))
+                ]
+            if not batch:
+                self.retryDelay = 0.0
+                return
+
+            failed = self.write(batch)
+            if failed:
+                self.requeue(failed)
+                # Back off while the database is unreachable
+                self.retryDelay = min(
+                    max(self.retryDelay * 2, self.flushInterval), self.maxRetryDelay
+                )
+                return
+
+    def write(self, batch):
+        # Returns the records that have to be written again
+        try:
+            self.collection.insert_many(batch, ordered=False)
+            self.written += len(batch)
+            return []
+        except BulkWriteError as e:
+            # Records that are already stored are not written again
+            errors = e.details.get("writeErrors", [])
+            failed = [
+                batch[error["index"]]
+                for error in errors
+                if error.get("code") != DUPLICATE_KEY
+            ]
+            self.written += len(batch) - len(errors)
+            self.failedWrites += 1
+            self.lastError = str(e)
+            return failed
+        except Exception as e:
+            # insert_many assigns the _id of every record before sending it, so
+            # records written before the failure are skipped on the retry
+            self.failedWrites += 1
+            self.lastError = str(e)
+            return batch
+
+    def requeue(self, records):
+        # Put failed records back in front of the newer ones, the oldest are
+        # dropped when they no longer fit into the buffer
+        with self.condition:
+            records = list(records) + list(self.buffer)
+            overflow = max(len(records) - self.buffer.maxlen, 0)
+            self.dropped += overflow
+            self.buffer.clear()
+            self.buffer.extend(records[overflow:])
+
+    def getStats(self):
+        with self.condition:
+            buffered = len(self.buffer)
+        return {
+            "buffered": buffered,
+            "written": self.written,
+            "dropped": self.dropped,
+            "failedWrites": self.failedWrites,
+            "retryDelay": self.retryDelay,
+            "lastError": self.lastError,
+        }
@@ -0,0 +1,91 @@
+import numpy as np
+
+
+class RegionOfInterest:
+    def __init__(
+        self, polygon=None, margin=0.1, headroom=0.3, imgsz=None, baseImgsz=1280
+    ):
+        # The part of the camera view the detector runs on, everything else (sky,
+        # roof, advertising boards) is cropped away before the inference
+        # polygon is the floor area in camera pixels, usually the homography source
+        # points, None covers the whole frame
+        # margin widens the crop by this fraction of the polygon size on every side
+        # headroom extends the crop upwards by this fraction of the polygon height,
+        # so people standing at the far edge of the floor are not cut off at the head
+        # imgsz is the inference size of the crop, None keeps the pixel density
+        # that baseImgsz gives on the full frame, so the detector cost shrinks with
+        # the cropped area
+        self.polygon = (
+            None if polygon is None else np.asarray(polygon, np.float32).reshape(-1, 2)
+        )
+        self.margin = margin
+        self.headroom = headroom
+        self.imgsz = imgsz
+        self.baseImgsz = baseImgsz
+
+        # The crop rectangle and inference size are computed once per frame size
+        self.frameShape = None
+        self.rect = None
+        self.cropImgsz = baseImgsz
+
+    def resolve(self, frameShape):
+        # Crop rectangle (x0, y0, x1, y1) and inference size for frames of this shape
+        frameShape = tuple(frameShape[:2])
+        if frameShape == self.frameShape:
+            return self.rect, self.cropImgsz
+
+        height, width = frameShape
+        # A polygon that does not fit into the frame was calibrated for another
+        # resolution, the whole frame is detected then
+        if (
+            self.polygon is None
+            or (self.polygon < 0).any()
+            or (self.polygon[:, 0] > width).any()
+            or (self.polygon[:, 1] > height).any()
+        ):
+            x0, y0, x1, y1 = 0, 0, width, height
+        else:
+            low = self.polygon.min(axis=0)
+            high = self.polygon.max(axis=0)
+            size = high - low
+            x0 = int(np.floor(low[0] - size[0] * self.margin))
+            x1 = int(np.ceil(high[0] + size[0] * self.margin))
+            y0 = int(np.floor(low[1] - size[1] * (self.margin + self.headroom)))
+            y1 = int(np.ceil(high[1] + size[1] * self.margin))
+            x0, y0 = max(x0, 0), max(y0, 0)
+            x1, y1 = min(x1, width), min(y1, height)
+
+        if self.imgsz is not None:
+            cropImgsz = self.imgsz
+        else:
+            # Same pixel density as baseImgsz on the full frame, rounded up to the
+            # stride of the detector
+            scale = self.baseImgsz / max(height, width)
+            cropImgsz = int(np.ceil(max(x1 - x0, y1 - y0) * scale / 32) * 32)
+            cropImgsz = min(max(cropImgsz, 32), self.baseImgsz)
+
+        self.frameShape = frameShape
+        self.rect = (x0, y0, x1, y1)
+        self.cropImgsz = cropImgsz
+        return self.rect, self.cropImgsz
+
+    def crop(self, frame):
+        # The cropped view of the frame (no copy) and its inference size
+        (x0, y0, x1, y1), cropImgsz = self.resolve(frame.shape)
+        return frame[y0:y1, x0:x1], cropImgsz
+
+    def mapBoxes(self, boxes):
+        # Map (x, y, w, h) centre boxes from crop to full frame coordinates
+        boxes = np.array(boxes, dtype=np.float32).reshape(-1, 4)
+        if self.rect is not None:
+            boxes[:, 0] += self.rect[0]
+            boxes[:, 1] += self.rect[1]
+        return boxes
+
+    def croppedFraction(self):
+        # Fraction of the frame area the detector no longer has to process
+        if self.rect is None:
+            return 0.0
+        x0, y0, x1, y1 = self.rect
+        height, width = self.frameShape
+        return 1.0 - (x1 - x0) * (y1 - y0) / (width * height)
@@ -0,0 +1,375 @@
+import argparse
+import hashlib
+import json
+import os
+import resource
+import time
+import cv2
+import numpy as np
+from cameraProcessing import CameraProcessor
+from resilientCapture import ResilientCapture
+
+
+class RecordedDetections:
+    def __init__(self, boxes=None, trackIDs=None, offsets=None):
+        # Tracked people of every frame of a video, stored flat in NumPy arrays
+        # boxes are (x, y, w, h) centre boxes, the detections of frame i are
+        # boxes[offsets[i]:offsets[i + 1]] with their trackIDs
+        self.boxes = [] if boxes is None else [np.asarray(boxes, dtype=np.float32)]
+        self.trackIDs = [] if trackIDs is None else [np.asarray(trackIDs, dtype=int)]
+        self.offsets = [0] if offsets is None else list(offsets)
+        self.flatBoxes = None
+        self.flatTrackIDs = None
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as archive:
+            return cls(archive["boxes"], archive["trackIDs"], archive["offsets"])
+
+    def save(self, path):
+        boxes, trackIDs = self.flatten()
+        np.savez_compressed(
+            path,
+            boxes=boxes,
+            trackIDs=trackIDs,
+            offsets=np.asarray(self.offsets, dtype=np.int64),
+        )
+
+    def flatten(self):
+        if self.flatBoxes is None:
+            if self.boxes:
+                self.flatBoxes = np.concatenate(self.boxes).reshape(-1, 4)
+                self.flatTrackIDs = np.concatenate(self.trackIDs)
+            else:
+                self.flatBoxes = np.empty((0, 4), dtype=np.float32)
+                self.flatTrackIDs = np.empty(0, dtype=int)
+        return self.flatBoxes, self.flatTrackIDs
+
+    def append(self, boxes, trackIDs):
+        # Add the detections of the next frame, None when nobody was tracked
+        if boxes is None:
+            boxes, trackIDs = np.empty((0, 4), dtype=np.float32), []
+        self.boxes.append(np.asarray(boxes, dtype=np.float32).reshape(-1, 4))
+        self.trackIDs.append(np.asarray(trackIDs, dtype=int).reshape(-1))
+        self.offsets.append(self.offsets[-1] + len(self.boxes[-1]))
+        self.flatBoxes = None
+
+    def get(self, index):
+        # Boxes and track IDs of a frame, None after the last recorded frame
+        if index >= len(self):
+            return None
+        boxes, trackIDs = self.flatten()
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return boxes[start:end], trackIDs[start:end]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+def currentMemory():
+    # Resident memory of this process in bytes
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # ru_maxrss is the peak in kilobytes on Linux and in bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def latencySummary(latencies):
+    # Latency percentiles in milliseconds
+    if not latencies:
+        return {"count": 0}
+    values = np.asarray(latencies) * 1000
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {
+        "count": len(values),
+        "meanMs": float(values.mean()),
+        "p50Ms": float(p50),
+        "p90Ms": float(p90),
+        "p99Ms": float(p99),
+        "maxMs": float(values.max()),
+    }
+
+
+class ReplayBenchmark:
+    def __init__(
+        self,
+        videoPath,
+        detectionsPath=None,
+        realTime=False,
+        maxFrames=None,
+        warmupFrames=10,
+        render=False,
+        recordPath=None,
+        analyticsPath=None,
+        homographyPoints=None,
+        **processorOptions,
+    ):
+        # Replays a recorded video through the CameraProcessor stages and measures them
+        # detectionsPath replays cached detections instead of running the detector,
+        # so the congestion, dwell time and flow code is benchmarked on its own
+        # realTime paces the replay at the frame rate of the video, otherwise the
+        # frames are processed as fast as possible
+        # warmupFrames are processed but not included in the latency statistics
+        # render also runs the render stage
+        # recordPath saves the detections of this run for later replays
+        # analyticsPath writes the structured analytics of every frame as JSON lines
+        # The analytics run on the video time of the frame being replayed instead of
+        # the wall clock, so the track TTL, dwell times and integration interval give
+        # the same results at any replay speed
+        self.videoPath = videoPath
+        self.realTime = realTime
+        self.maxFrames = maxFrames
+        self.warmupFrames = warmupFrames
+        self.render = render
+        self.recordPath = recordPath
+        self.analyticsPath = analyticsPath
+
+        self.detections = None
+        if detectionsPath is not None:
+            self.detections = RecordedDetections.load(detectionsPath)
+        self.recorder = RecordedDetections() if recordPath is not None else None
+        self.replayTime = 0.0
+
+        if not os.path.isfile(videoPath):
+            raise FileNotFoundError(f"Cannot open video: {videoPath}")
+
+        # With cached detections the recorded detections take the place of the
+        # model, so no detector is loaded
+        # Every frame of the video is read once, the pacing is done by run()
+        self.processor = CameraProcessor(
+            source=videoPath,
+            model=self.detections,
+            homographyPoints=homographyPoints,
+            capture=ResilientCapture(videoPath, realTime=False, loop=False),
+            clock=self.replayClock,
+            **processorOptions,
+        )
+
+        self.latencies = {"capture": [], "detection": [], "analytics": []}
+        if render:
+            self.latencies["render"] = []
+
+    def replayClock(self):
+        # Video time in seconds of the frame being replayed
+        return self.replayTime
+
+    def run(self):
+        processor = self.processor
+        fps = processor.cap.get(cv2.CAP_PROP_FPS) or 30.0
+        analyticsFile = open(self.analyticsPath, "w") if self.analyticsPath else None
+
+        # The digest covers the analytics that only depend on the input frames,
+        # the detections and the replay clock, so two runs of the same code on the
+        # same input must match
+        digest = hashlib.sha256()
+        peopleCounts = []
+        congestedFrames = 0
+        highRiskFrames = 0
+        errors = 0
+        memorySamples = [currentMemory()]
+
+        index = 0
+        startTime = time.perf_counter()
+        try:
+            while self.maxFrames is None or index < self.maxFrames:
+                if self.realTime:
+                    delay = startTime + index / fps - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+
+                self.replayTime = index / fps
+                t0 = time.perf_counter()
+                success, frame = processor.cap.read()
+                if not success:
+                    break
+                t1 = time.perf_counter()
+
+                if self.detections is not None:
+                    recorded = self.detections.get(index)
+                    if recorded is None:
+                        break
+                    frameData = processor.applyDetections(frame, *recorded)
+                else:
+                    frameData = processor.detectFrame(frame)
+                t2 = time.perf_counter()
+
+                frameData = processor.analyseFrame(frameData)
+                t3 = time.perf_counter()
+
+                if self.render:
+                    processor.renderFrame(frameData)
+                t4 = time.perf_counter()
+
+                if index >= self.warmupFrames:
+                    self.latencies["capture"].append(t1 - t0)
+                    self.latencies["detection"].append(t2 - t1)
+                    self.latencies["analytics"].append(t3 - t2)
+                    if self.render:
+                        self.latencies["render"].append(t4 - t3)
+
+                if self.recorder is not None:
+                    self.recorder.append(frameData["boxes"], frameData["trackIDs"])
+
+                if frameData["error"] is not None:
+                    errors += 1
+                analytics = frameData.get("analytics")
+                if analytics is not None:
+                    peopleCounts.append(analytics["peopleCount"])
+                    congestedFrames += bool(
+                        analytics["congestionZones"]
+                        or analytics["floorCongestionZones"]
+                    )
+                    highRiskFrames += bool(analytics["highRiskZones"])
+                    digest.update(
+                        json.dumps(
+                            [
+                                analytics["people"],
+                                analytics["congestionZones"],
+                                analytics["floorCongestionZones"],
+                                analytics["predictedCongestion"],
+                                analytics["zoneStats"],
+                                analytics["highRiskZones"],
+                            ],
+                            sort_keys=True,
+                        ).encode()
+                    )
+                    if analyticsFile is not None:
+                        analyticsFile.write(json.dumps(analytics) + "\n")
+
+                index += 1
+                if index % 30 == 0:
+                    memorySamples.append(currentMemory())
+        finally:
+            if analyticsFile is not None:
+                analyticsFile.close()
+
+        elapsed = time.perf_counter() - startTime
+        memorySamples.append(currentMemory())
+
+        if self.recorder is not None:
+            self.recorder.save(self.recordPath)
+
+        return {
+            "video": self.videoPath,
+            "detector": "recorded" if self.detections is not None else "model",
+            "pace": "realTime" if self.realTime else "maxSpeed",
+            "frames": index,
+            "errors": errors,
+            "elapsedSeconds": elapsed,
+            "fps": index / elapsed if elapsed > 0 else 0.0,
+            "stages": {
+                name: latencySummary(values) for name, values in self.latencies.items()
+            },
+            "memory": {
+                "startMB": memorySamples[0] / 2**20,
+                "endMB": memorySamples[-1] / 2**20,
+                "peakMB": max(memorySamples) / 2**20,
+                "growthMB": (memorySamples[-1] - memorySamples[0]) / 2**20,
+            },
+            "analytics": {
+                "meanPeopleCount": (
+                    float(np.mean(peopleCounts)) if peopleCounts else 0.0
+                ),
+                "maxPeopleCount": int(max(peopleCounts, default=0)),
+                "congestedFrames": congestedFrames,
+                "highRiskFrames": highRiskFrames,
+                "zoneStats": (processor.getAnalytics() or {}).get("zoneStats", []),
+                "digest": digest.hexdigest(),
+            },
+            "tracks": processor.getTrackMetrics(),
+            "capture": processor.getCaptureStats(),
+        }
+
+    def release(self):
+        self.processor.cap.release()
+
+
+def printReport(report):
+    print(
+        f"{report['frames']} frames in {report['elapsedSeconds']:.1f}s "
+        f"({report['fps']:.1f} fps, {report['pace']}, detector: {report['detector']}, "
+        f"errors: {report['errors']})"
+    )
+    for name, stats in report["stages"].items():
+        if not stats["count"]:
+            continue
+        print(
+            f"{name:>10}: mean={stats['meanMs']:.2f}ms p50={stats['p50Ms']:.2f}ms "
+            f"p90={stats['p90Ms']:.2f}ms p99={stats['p99Ms']:.2f}ms "
+            f"max={stats['maxMs']:.2f}ms"
+        )
+    memory = report["memory"]
+    print(
+        f"    memory: start={memory['startMB']:.1f}MB end={memory['endMB']:.1f}MB "
+        f"peak={memory['peakMB']:.1f}MB growth={memory['growthMB']:+.1f}MB"
+    )
+    analytics = report["analytics"]
+    print(
+        f" analytics: people mean={analytics['meanPeopleCount']:.1f} "
+        f"max={analytics['maxPeopleCount']} "
+        f"congested frames={analytics['congestedFrames']} "
+        f"high risk frames={analytics['highRiskFrames']} "
+        f"digest={analytics['digest'][:16]}"
+    )
+
+
+if __name__ == "__main__":
+    # Usage: python replayBenchmark.py match.mp4 --record match.npz
+    #        python replayBenchmark.py match.mp4 --detections match.npz --report run.json
+    parser = argparse.ArgumentParser(
+        description="Replay a recorded video through the crowd analytics pipeline"
+    )
+    parser.add_argument("video", help="recorded video file")
+    parser.add_argument(
+        "--detections", help="replay cached detections (.npz) instead of the detector"
+    )
+    parser.add_argument("--record", help="save the detections of this run (.npz)")
+    parser.add_argument(
+        "--realtime", action="store_true", help="pace the replay at the video fps"
+    )
+    parser.add_argument("--frames", type=int, help="stop after this many frames")
+    parser.add_argument("--warmup", type=int, default=10, help="untimed first frames")
+    parser.add_argument("--render", action="store_true", help="also time rendering")
+    parser.add_argument(
+        "--mode",
+        default="integration",
+        choices=["basic", "congestion", "dwell", "integration"],
+        help="analysis mode",
+    )
+    parser.add_argument(
+        "--homography",
+        help='JSON file with the {"source": [...], "destination": [...]} points',
+    )
+    parser.add_argument("--analytics", help="write the analytics as JSON lines")
+    parser.add_argument("--report", help="write the report as JSON")
+    args = parser.parse_args()
+
+    homographyPoints = None
+    if args.homography:
+        with open(args.homography) as file:
+            points = json.load(file)
+        homographyPoints = (points["source"], points["destination"])
+
+    benchmark = ReplayBenchmark(
+        args.video,
+        detectionsPath=args.detections,
+        realTime=args.realtime,
+        maxFrames=args.frames,
+        warmupFrames=args.warmup,
+        render=args.render,
+        recordPath=args.record,
+        analyticsPath=args.analytics,
+        homographyPoints=homographyPoints,
+    )
+    benchmark.processor.analysisMode = args.mode
+    try:
+        report = benchmark.run()
+    finally:
+        benchmark.release()
+
+    printReport(report)
+    if args.report:
+        with open(args.report, "w") as file:
+            json.dump(report, file, indent=2)
@@ -0,0 +1,221 @@
+import os
+import threading
+import time
+import cv2
+
+
+class ResilientCapture:
+    def __init__(
+        self,
+        source=0,
+        realTime=True,
+        loop=True,
+        reconnectDelay=0.5,
+        maxReconnectDelay=30.0,
+        readTimeout=5.0,
+        apiPreference=cv2.CAP_ANY,
+    ):
+        # Drop-in replacement for cv2.VideoCapture reading a camera, stream or file
+        # on a dedicated grab thread
+        # realTime only keeps the newest decoded frame, frames the consumer is too
+        # slow for are dropped instead of piling up in the decoder buffer, files are
+        # decoded at their native frame rate like a live camera
+        # Without realTime every frame of a file is handed over as fast as the
+        # consumer takes it, e.g. for replays, streams are always read in real time
+        # loop starts a file over at its end, otherwise read() fails from then on
+        # A lost stream is reopened with an exponential backoff from reconnectDelay
+        # up to maxReconnectDelay seconds
+        # readTimeout is how long read() waits for a frame before it fails
+        # apiPreference selects the OpenCV backend, e.g. cv2.CAP_FFMPEG or
+        # cv2.CAP_GSTREAMER, the default lets OpenCV choose
+        self.source = source
+        self.isFile = isinstance(source, str) and os.path.isfile(source)
+        self.realTime = realTime or not self.isFile
+        self.loop = loop
+        self.reconnectDelay = reconnectDelay
+        self.maxReconnectDelay = maxReconnectDelay
+        self.readTimeout = readTimeout
+        self.apiPreference = apiPreference
+
+        # The newest frame and its sequence number, guarded by the condition
+        # readSequence is the sequence of the last frame returned by read()
+        self.condition = threading.Condition()
+        self.frame = None
+        self.sequence = 0
+        self.readSequence = 0
+        self.ended = False
+        self.stopEvent = threading.Event()
+
+        # Counters
+        self.decodedFrames = 0
+        self.droppedFrames = 0
+        self.failedReads = 0
+        self.reconnects = 0
+        self.totalDecodeTime = 0.0
+        self.maxDecodeTime = 0.0
+        self.connected = False
+        self.startTime = time.time()
+
+        # Properties of the opened source, read once per connection
+        self.properties = {}
+
+        # The first connection is opened right away, so the frame size and rate are
+        # known after construction, the grab thread retries if it failed
+        self.cap = self.open()
+        self.thread = threading.Thread(
+            target=self.grabLoop, name="capture", daemon=True
+        )
+        self.thread.start()
+
+    def open(self):
+        cap = cv2.VideoCapture(self.source, self.apiPreference)
+        if not cap.isOpened():
+            cap.release()
+            self.connected = False
+            return None
+
+        # Keep the backend buffer small, so a stream never lags behind real time
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        self.properties = {
+            prop: cap.get(prop)
+            for prop in (
+                cv2.CAP_PROP_FPS,
+                cv2.CAP_PROP_FRAME_WIDTH,
+                cv2.CAP_PROP_FRAME_HEIGHT,
+                cv2.CAP_PROP_FRAME_COUNT,
+            )
+        }
+        self.connected = True
+        return cap
+
+    def framePeriod(self):
+        fps = self.properties.get(cv2.CAP_PROP_FPS, 0)
+        return 1.0 / fps if fps and 0 < fps <= 240 else 1.0 / 30
+
+    def grabLoop(self):
+        delay = self.reconnectDelay
+        nextFrameTime = time.perf_counter()
+        cap, self.cap = self.cap, None
+        rewound = False
+
+        try:
+            while not self.stopEvent.is_set():
+                if cap is None:
+                    cap = self.open()
+                    if cap is None:
+                        # Wait before the next attempt, release() ends the wait
+                        print(f"Failed to open video stream, retrying in {delay:.1f}s")
+                        self.stopEvent.wait(delay)
+                        delay = min(delay * 2, self.maxReconnectDelay)
+                        continue
+                    self.reconnects += 1
+                    delay = self.reconnectDelay
+                    nextFrameTime = time.perf_counter()
+
+                startTime = time.perf_counter()
+                success, frame = cap.read()
+                decodeTime = time.perf_counter() - startTime
+
+                if not success:
+                    self.failedReads += 1
+                    if self.isFile and self.loop and not rewound:
+                        # Start the file over, a file failing right at its start
+                        # is reopened like a stream
+                        cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                        rewound = True
+                        continue
+                    cap.release()
+                    cap = None
+                    self.connected = False
+                    if self.isFile and not self.loop:
+                        break
+                    continue
+                rewound = False
+
+                self.decodedFrames += 1
+                self.totalDecodeTime += decodeTime
+                self.maxDecodeTime = max(self.maxDecodeTime, decodeTime)
+                self.publish(frame)
+
+                if self.isFile and self.realTime:
+                    # Decode the file at its native frame rate
+                    framePeriod = self.framePeriod()
+                    nextFrameTime = max(
+                        nextFrameTime + framePeriod,
+                        time.perf_counter() - framePeriod,
+                    )
+                    self.stopEvent.wait(max(nextFrameTime - time.perf_counter(), 0))
+        finally:
+            if cap is not None:
+                cap.release()
+            self.connected = False
+            with self.condition:
+                self.ended = True
+                self.condition.notify_all()
+
+    def publish(self, frame):
+        with self.condition:
+            if self.realTime:
+                # The previous frame was never read
+                if self.sequence > self.readSequence:
+                    self.droppedFrames += 1
+            else:
+                # Hand over every frame, wait until the previous one was read
+                self.condition.wait_for(
+                    lambda: self.sequence == self.readSequence
+                    or self.stopEvent.is_set()
+                )
+            self.frame = frame
+            self.sequence += 1
+            self.condition.notify_all()
+
+    def read(self, timeout=None):
+        # Return (success, frame) with the newest frame that was not read yet,
+        # waiting up to timeout seconds (readTimeout by default) for it
+        # Fails without waiting once the capture was released or a file ended
+        timeout = self.readTimeout if timeout is None else timeout
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.sequence > self.readSequence or self.ended, timeout
+            )
+            if self.sequence <= self.readSequence:
+                return False, None
+            self.readSequence = self.sequence
+            frame, self.frame = self.frame, None
+            self.condition.notify_all()
+            return True, frame
+
+    def get(self, prop):
+        # Frame size, rate and count of the current connection, like VideoCapture.get
+        return self.properties.get(prop, 0.0)
+
+    def isOpened(self):
+        # True while frames are or may become available
+        return not self.ended
+
+    def isConnected(self):
+        return self.connected
+
+    def getStats(self):
+        elapsed = max(time.time() - self.startTime, 1e-6)
+        return {
+            "connected": self.connected,
+            "decoded": self.decodedFrames,
+            "dropped": self.droppedFrames,
+            "failedReads": self.failedReads,
+            "reconnects": self.reconnects,
+            "decodeFps": self.decodedFrames / elapsed,
+            "avgDecodeMs": (
+                self.totalDecodeTime / self.decodedFrames * 1000
+                if self.decodedFrames
+                else 0.0
+            ),
+            "maxDecodeMs": self.maxDecodeTime * 1000,
+        }
+
+    def release(self):
+        self.stopEvent.set()
+        with self.condition:
+            self.condition.notify_all()
+        if self.thread is not threading.current_thread():
+            self.thread.join(2.0)
@@ -0,0 +1,259 @@
+import json
+import threading
+import numpy as np
+
+# Fields of every rollup bucket
+SAMPLES = 0
+COUNT_SUM = 1
+COUNT_MAX = 2
+DWELL_SUM = 3
+DWELL_MAX = 4
+CONGESTED_SECONDS = 5
+FIELD_COUNT = 6
+
+
+class RollupLevel:
+    def __init__(self, resolution, capacity):
+        # Ring buffer of capacity buckets of resolution seconds for every zone
+        # of one camera, buckets holds the bucket number (timestamp // resolution)
+        # stored in every slot, so stale slots are recognised and reset on reuse
+        self.resolution = resolution
+        self.capacity = capacity
+        self.buckets = np.full(capacity, -1, dtype=np.int64)
+        self.latestBucket = -1
+        self.data = np.zeros((0, capacity, FIELD_COUNT), dtype=np.float64)
+
+    def ensureZones(self, zoneCount):
+        if zoneCount > len(self.data):
+            grown = np.zeros((zoneCount, self.capacity, FIELD_COUNT), dtype=np.float64)
+            grown[: len(self.data)] = self.data
+            self.data = grown
+
+    def add(self, rows, timestamp, counts, meanDwell, maxDwell, congestedSeconds):
+        # Aggregate one sample of the given zone rows into the current bucket
+        bucket = int(timestamp // self.resolution)
+        slot = bucket % self.capacity
+        if self.buckets[slot] != bucket:
+            self.data[:, slot] = 0
+            self.buckets[slot] = bucket
+            self.latestBucket = max(self.latestBucket, bucket)
+
+        data = self.data[rows, slot]
+        data[:, SAMPLES] += 1
+        data[:, COUNT_SUM] += counts
+        data[:, COUNT_MAX] = np.maximum(data[:, COUNT_MAX], counts)
+        data[:, DWELL_SUM] += meanDwell
+        data[:, DWELL_MAX] = np.maximum(data[:, DWELL_MAX], maxDwell)
+        data[:, CONGESTED_SECONDS] += congestedSeconds
+        self.data[rows, slot] = data
+
+    def oldestBucket(self):
+        # Oldest bucket number that can still be stored
+        return max(self.latestBucket - self.capacity + 1, 0)
+
+    def select(self, start, end):
+        # Bucket numbers and slots of the stored buckets overlapping [start, end)
+        # Only buckets up to the latest one can be stored, so the range never spans
+        # more than capacity buckets however far the end lies in the future
+        first = max(int(start // self.resolution), self.oldestBucket())
+        last = min(int(np.ceil(end / self.resolution)), self.latestBucket + 1)
+        if last <= first:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        buckets = np.arange(first, last, dtype=np.int64)
+        slots = buckets % self.capacity
+        stored = self.buckets[slots] == buckets
+        return buckets[stored], slots[stored]
+
+
+class RollupStore:
+    def __init__(self, levels=((1, 3600), (60, 7 * 24 * 60), (900, 240 * 96))):
+        # Per camera and zone aggregates of the crowd analytics at several
+        # resolutions, every sample is downsampled into all levels on ingest
+        # levels are (resolution in seconds, number of buckets kept), by default
+        # 1 second buckets for an hour, 1 minute buckets for a week and
+        # 15 minute buckets for 240 days, i.e. a whole season
+        # Every bucket holds the number of samples, the sum and maximum of the
+        # zone count and of the mean dwell time, the maximum dwell time and the
+        # number of seconds the zone was congested
+        self.levelSettings = tuple(levels)
+        self.lock = threading.Lock()
+
+        # cameras maps a camera name to its levels, zone names and last sample time
+        self.cameras = {}
+
+        # Gaps longer than this between two samples do not count as congestion
+        self.maxSampleGap = 1.0
+
+    def getCamera(self, camera):
+        if camera not in self.cameras:
+            self.cameras[camera] = {
+                "levels": [
+                    RollupLevel(resolution, capacity)
+                    for resolution, capacity in self.levelSettings
+                ],
+                "zones": {},
+                "lastTimestamp": None,
+            }
+        return self.cameras[camera]
+
+    def zoneRows(self, cameraData, zones):
+        rows = []
+        for zone in zones:
+            row = cameraData["zones"].get(zone)
+            if row is None:
+                row = len(cameraData["zones"])
+                cameraData["zones"][zone] = row
+            rows.append(row)
+        for level in cameraData["levels"]:
+            level.ensureZones(len(cameraData["zones"]))
+        return np.array(rows, dtype=np.int64)
+
+    def add(
+        self,
+        camera,
+        timestamp,
+        zones,
+        counts,
+        meanDwell=None,
+        maxDwell=None,
+        congested=None,
+    ):
+        # Add one sample of every zone of a camera
+        # zones are the zone names, the other arguments hold one value per zone
+        zoneCount = len(zones)
+        counts = np.asarray(counts, dtype=np.float64)
+        meanDwell = np.zeros(zoneCount) if meanDwell is None else meanDwell
+        maxDwell = np.zeros(zoneCount) if maxDwell is None else maxDwell
+        congested = np.zeros(zoneCount, dtype=bool) if congested is None else congested
+
+        with self.lock:
+            cameraData = self.getCamera(camera)
+            rows = self.zoneRows(cameraData, zones)
+
+            # Congestion lasts from this sample until the next one
+            lastTimestamp = cameraData["lastTimestamp"]
+            elapsed = 0.0 if lastTimestamp is None else timestamp - lastTimestamp
+            elapsed = min(max(elapsed, 0.0), self.maxSampleGap)
+            cameraData["lastTimestamp"] = timestamp
+            congestedSeconds = np.asarray(congested, dtype=np.float64) * elapsed
+
+            for level in cameraData["levels"]:
+                level.add(
+                    rows, timestamp, counts, meanDwell, maxDwell, congestedSeconds
+                )
+
+    def chooseLevel(self, levels, start, resolution=None):
+        # The finest level that still holds the start of the range, or the level
+        # with the requested resolution
+        if resolution is not None:
+            for level in levels:
+                if level.resolution == resolution:
+                    return level
+            raise ValueError(f"No rollup level with a resolution of {resolution}s")
+        for level in levels:
+            if start >= level.oldestBucket() * level.resolution:
+                return level
+        return levels[-1]
+
+    def seriesKeys(self, camera=None, zone=None):
+        for cameraName, cameraData in self.cameras.items():
+            if camera is not None and cameraName != camera:
+                continue
+            for zoneName, row in cameraData["zones"].items():
+                if zone is not None and zoneName != zone:
+                    continue
+                yield cameraName, cameraData, zoneName, row
+
+    def query(self, start, end, camera=None, zone=None, resolution=None):
+        # Aggregates of every camera and zone over [start, end), e.g. the peak
+        # occupancy of every gate during a match
+        # Buckets overlapping the range are included completely
+        results = []
+        with self.lock:
+            for cameraName, cameraData, zoneName, row in self.seriesKeys(camera, zone):
+                level = self.chooseLevel(cameraData["levels"], start, resolution)
+                _, slots = level.select(start, end)
+                data = level.data[row, slots]
+                samples = data[:, SAMPLES].sum()
+                results.append(
+                    {
+                        "camera": cameraName,
+                        "zone": zoneName,
+                        "resolution": level.resolution,
+                        "samples": int(samples),
+                        "peakCount": (
+                            float(data[:, COUNT_MAX].max()) if len(data) else 0.0
+                        ),
+                        "meanCount": (
+                            float(data[:, COUNT_SUM].sum() / samples)
+                            if samples
+                            else 0.0
+                        ),
+                        "meanDwellTime": (
+                            float(data[:, DWELL_SUM].sum() / samples)
+                            if samples
+                            else 0.0
+                        ),
+                        "maxDwellTime": (
+                            float(data[:, DWELL_MAX].max()) if len(data) else 0.0
+                        ),
+                        "congestionSeconds": float(data[:, CONGESTED_SECONDS].sum()),
+                    }
+                )
+        return results
+
+    def timeline(self, camera, zone, start, end, resolution=None):
+        # Per bucket aggregates of one camera zone over [start, end), for charts
+        with self.lock:
+            cameraData = self.cameras.get(camera)
+            if cameraData is None or zone not in cameraData["zones"]:
+                return None
+            level = self.chooseLevel(cameraData["levels"], start, resolution)
+            buckets, slots = level.select(start, end)
+            data = level.data[cameraData["zones"][zone], slots]
+
+        samples = np.maximum(data[:, SAMPLES], 1)
+        return {
+            "camera": camera,
+            "zone": zone,
+            "resolution": level.resolution,
+            "timestamps": (buckets * level.resolution).tolist(),
+            "meanCount": (data[:, COUNT_SUM] / samples).tolist(),
+            "peakCount": data[:, COUNT_MAX].tolist(),
+            "meanDwellTime": (data[:, DWELL_SUM] / samples).tolist(),
+            "maxDwellTime": data[:, DWELL_MAX].tolist(),
+            "congestionSeconds": data[:, CONGESTED_SECONDS].tolist(),
+        }
+
+    def save(self, path):
+        # Store all rollups in one compressed NumPy archive
+        arrays = {}
+        cameras = {}
+        with self.lock:
+            for index, (cameraName, cameraData) in enumerate(self.cameras.items()):
+                cameras[cameraName] = {
+                    "index": index,
+                    "zones": cameraData["zones"],
+                    "lastTimestamp": cameraData["lastTimestamp"],
+                }
+                for levelIndex, level in enumerate(cameraData["levels"]):
+                    arrays[f"buckets_{index}_{levelIndex}"] = level.buckets
+                    arrays[f"data_{index}_{levelIndex}"] = level.data
+        metadata = {"levels": self.levelSettings, "cameras": cameras}
+        np.savez_compressed(path, metadata=json.dumps(metadata), **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as archive:
+            metadata = json.loads(str(archive["metadata"]))
+            store = cls([tuple(level) for level in metadata["levels"]])
+            for cameraName, cameraInfo in metadata["cameras"].items():
+                cameraData = store.getCamera(cameraName)
+                cameraData["zones"] = cameraInfo["zones"]
+                cameraData["lastTimestamp"] = cameraInfo["lastTimestamp"]
+                index = cameraInfo["index"]
+                for levelIndex, level in enumerate(cameraData["levels"]):
+                    level.buckets = archive[f"buckets_{index}_{levelIndex}"]
+                    level.data = archive[f"data_{index}_{levelIndex}"]
+                    level.latestBucket = int(level.buckets.max())
+        return store
@@ -0,0 +1,210 @@
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+
+# Slot states
+FREE = 0
+WRITING = 1
+READY = 2
+
+# Header fields of every slot
+STATE = 0
+READERS = 1
+SEQUENCE = 2
+TIMESTAMP = 3
+READS = 4
+SLOT_FIELDS = 5
+
+# Fields of the ring header
+LATEST_SEQUENCE = 0
+CLOSED = 1
+WRITTEN = 2
+DROPPED = 3
+BUSY = 4
+RING_FIELDS = 5
+
+# Frames start on a cache line boundary
+ALIGNMENT = 64
+
+
+class SharedFrameRing:
+    def __init__(self, shape, slots=4, dtype=np.uint8, name=None, condition=None):
+        # Ring of fixed size frame slots in shared memory, so frames are passed
+        # between processes as NumPy views instead of pickled copies
+        # One writer fills free slots, readers take the newest ready slot and hold
+        # it until they release it, a slot is only rewritten when nobody reads it
+        # The slot states, reader counts and sequence numbers live in the shared
+        # header and are only changed while holding the condition, the frames
+        # themselves are written and read without the lock
+        # Without a name a new ring is created, with a name an existing ring is
+        # attached, which is what happens when the ring is passed to a process
+        self.shape = tuple(shape)
+        self.slots = slots
+        self.dtype = np.dtype(dtype)
+        self.owner = name is None
+        self.condition = multiprocessing.Condition() if condition is None else condition
+
+        self.frameBytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.slotBytes = -(-self.frameBytes // ALIGNMENT) * ALIGNMENT
+        headerBytes = (RING_FIELDS + slots * SLOT_FIELDS) * 8
+        self.frameOffset = -(-headerBytes // ALIGNMENT) * ALIGNMENT
+        size = self.frameOffset + slots * self.slotBytes
+
+        if self.owner:
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            # Child processes share the resource tracker of the creating process,
+            # so attaching does not make them unlink the memory when they exit
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.name = self.memory.name
+
+        buffer = self.memory.buf
+        self.ring = np.ndarray((RING_FIELDS,), dtype=np.int64, buffer=buffer)
+        self.header = np.ndarray(
+            (slots, SLOT_FIELDS), dtype=np.int64, buffer=buffer, offset=RING_FIELDS * 8
+        )
+        self.frames = [
+            np.ndarray(
+                self.shape,
+                dtype=self.dtype,
+                buffer=buffer,
+                offset=self.frameOffset + slot * self.slotBytes,
+            )
+            for slot in range(slots)
+        ]
+        if self.owner:
+            self.ring[:] = 0
+            self.header[:] = 0
+
+    def __getstate__(self):
+        # Only the name and layout are pickled, the receiving process attaches
+        return {
+            "shape": self.shape,
+            "slots": self.slots,
+            "dtype": self.dtype.str,
+            "name": self.name,
+            "condition": self.condition,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def frame(self, slot):
+        # NumPy view of the frame stored in a slot
+        return self.frames[slot]
+
+    def acquireWrite(self):
+        # Reserve a slot for the next frame, None when every slot is being read
+        # A free slot is preferred, otherwise the oldest frame nobody holds is
+        # replaced, which drops it if it was never read
+        with self.condition:
+            if self.ring[CLOSED]:
+                return None
+            header = self.header
+            candidates = np.flatnonzero(
+                (header[:, STATE] != WRITING) & (header[:, READERS] == 0)
+            )
+            if not len(candidates):
+                self.ring[BUSY] += 1
+                return None
+
+            free = candidates[header[candidates, STATE] == FREE]
+            if len(free):
+                slot = int(free[0])
+            else:
+                slot = int(candidates[np.argmin(header[candidates, SEQUENCE])])
+                if header[slot, READS] == 0:
+                    self.ring[DROPPED] += 1
+            header[slot, STATE] = WRITING
+            return slot
+
+    def commitWrite(self, slot, timestamp=0.0):
+        # Publish the frame written into the slot and wake up the readers
+        # timestamp is stored in microseconds
+        with self.condition:
+            self.ring[LATEST_SEQUENCE] += 1
+            self.ring[WRITTEN] += 1
+            self.header[slot] = (
+                READY,
+                0,
+                self.ring[LATEST_SEQUENCE],
+                int(timestamp * 1e6),
+                0,
+            )
+            self.condition.notify_all()
+            return int(self.ring[LATEST_SEQUENCE])
+
+    def abortWrite(self, slot):
+        with self.condition:
+            self.header[slot, STATE] = FREE
+
+    def newestReady(self, lastSequence):
+        header = self.header
+        ready = np.flatnonzero(
+            (header[:, STATE] == READY) & (header[:, SEQUENCE] > lastSequence)
+        )
+        if not len(ready):
+            return None
+        return int(ready[np.argmax(header[ready, SEQUENCE])])
+
+    def acquireRead(self, lastSequence=0, timeout=None):
+        # Wait for the newest frame after lastSequence and hold its slot
+        # Returns (slot, sequence, timestamp), None on a timeout or after close
+        # Frames older than the newest one are skipped
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.ring[CLOSED] or self.newestReady(lastSequence) is not None,
+                timeout,
+            )
+            if self.ring[CLOSED]:
+                return None
+            slot = self.newestReady(lastSequence)
+            if slot is None:
+                return None
+            self.header[slot, READERS] += 1
+            self.header[slot, READS] += 1
+            return (
+                slot,
+                int(self.header[slot, SEQUENCE]),
+                self.header[slot, TIMESTAMP] / 1e6,
+            )
+
+    def retain(self, slot):
+        # Hold a slot that is already held, e.g. before handing it to another process
+        with self.condition:
+            self.header[slot, READERS] += 1
+
+    def release(self, slot):
+        # Release a slot held by acquireRead or retain
+        with self.condition:
+            if self.header[slot, READERS] > 0:
+                self.header[slot, READERS] -= 1
+
+    def stop(self):
+        # Wake up every waiting reader, no more frames are written or read
+        with self.condition:
+            self.ring[CLOSED] = 1
+            self.condition.notify_all()
+
+    def isStopped(self):
+        return bool(self.ring[CLOSED])
+
+    def getStats(self):
+        with self.condition:
+            return {
+                "slots": self.slots,
+                "slotMB": self.slotBytes / 2**20,
+                "written": int(self.ring[WRITTEN]),
+                "dropped": int(self.ring[DROPPED]),
+                "busy": int(self.ring[BUSY]),
+                "held": int(np.count_nonzero(self.header[:, READERS])),
+            }
+
+    def close(self):
+        # Detach from the shared memory, the creating process also frees it
+        # Views returned by frame() must not be used afterwards
+        self.ring = self.header = None
+        self.frames = []
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
@@ -0,0 +1,33 @@
+import json
+import threading
+import time
+
+
+class StateSnapshot:
+    def __init__(self):
+        # Latest published state, served to the API without touching the database
+        # latest is a (sequence, etag, state, body) tuple that is replaced as a whole,
+        # so readers always see a consistent snapshot without taking the lock
+        # The sequence only increases when the content changes, so clients polling
+        # with If-None-Match get a 304 until something actually changed
+        # The ETag includes the start time of the process, so tags from before a
+        # restart never match
+        self.lock = threading.Lock()
+        self.latest = None
+        self.sequence = 0
+        self.instance = format(int(time.time() * 1000), "x")
+
+    def publish(self, state):
+        # Publish a JSON serialisable state, returns its sequence number
+        body = json.dumps(state, sort_keys=True, separators=(",", ":"))
+        with self.lock:
+            if self.latest is not None and self.latest[3] == body:
+                return self.sequence
+            self.sequence += 1
+            etag = f"{self.instance}-{self.sequence}"
+            self.latest = (self.sequence, etag, state, body)
+            return self.sequence
+
+    def get(self):
+        # The latest (sequence, etag, state, body), None before the first publish
+        return self.latest
@@ -0,0 +1,49 @@
+import cv2
+import numpy as np
+from utils import transformPoints
+from trackStore import TrackStore
+
+
+class TrailRenderer:
+    def __init__(self, homographyMatrix, capacity=50, maxTracks=1000, ttl=10.0):
+        # floorTrails caches the floor plan coordinates of every track history,
+        # so each camera point is transformed with the homography only once
+        self.homographyMatrix = homographyMatrix
+        self.floorTrails = TrackStore(
+            capacity=capacity, maxTracks=maxTracks, ttl=ttl, dtype=np.float32
+        )
+
+    def update(self, trackIDs, cameraPoints, timestamp=None):
+        # Transform the newly appended camera points of all tracks in one batch
+        # and append them to the cached floor trails, returns the floor points
+        if len(trackIDs) == 0:
+            return np.empty((0, 2), dtype=np.float32)
+
+        floorPoints = transformPoints(
+            np.asarray(cameraPoints, dtype=np.float64).reshape(-1, 2),
+            self.homographyMatrix,
+        )
+        for trackID, floorPoint in zip(trackIDs, floorPoints):
+            self.floorTrails.append(int(trackID), floorPoint, timestamp)
+        return floorPoints
+
+    def removeTracks(self, trackIDs):
+        self.floorTrails.remove([int(trackID) for trackID in trackIDs])
+
+    def getTrails(self, trackIDs):
+        # Floor plan trails of the given tracks as int32 arrays, ready for cv2.polylines
+        trails = []
+        for trackID in trackIDs:
+            trail = self.floorTrails.get(int(trackID))
+            if len(trail) > 1:
+                trails.append(trail.astype(np.int32))
+        return trails
+
+    @staticmethod
+    def draw(image, trails, color=(0, 0, 255), thickness=2):
+        # Draw all trails with a single polylines call
+        if trails:
+            cv2.polylines(
+                image, trails, isClosed=False, color=color, thickness=thickness
+            )
+        return image
@@ -2,11 +2,13 @@ from flask import Flask, Response
 import cv2
 import numpy as np
 from ultralytics import YOLO
-from pymongo import MongoClient
-from datetime import datetime, date
+from pymongo import DESCENDING, MongoClient
+from datetime import datetime, date, timezone
 import threading
 from flask_cors import CORS
 import os
+from mjpegStream import MJPEGStream
+from recordWriter import RecordWriter
 
 
 app = Flask(__name__)
@@ -19,18 +21,40 @@ model = YOLO('yolov8n.pt')  # or use a different YOLO version
 # Retrive the RTSP stream URL from iSpy or Wireshark
 # Replace the rtsp_url with your own RTSP stream URL
 rtsp_url = ''
-''' 
+
 # MongoDB connection
-client = MongoClient('')
-db = client["CrowdTracking"]
-collection = db["Crowd"]
-''' 
+# Replace the mongo_uri with your own connection string to store the counts
+mongo_uri = ''
+# Number of days the counts are kept before MongoDB removes them
+retention_days = 1
+writer = None
+
+def create_indexes():
+    # Native datetime timestamps with an index for the latest records,
+    # its TTL removes the counts older than the retention
+    collection.create_index([("timestamp", DESCENDING)],
+                            expireAfterSeconds=retention_days * 24 * 60 * 60)
+
+if mongo_uri:
+    client = MongoClient(mongo_uri, serverSelectionTimeoutMS=5000)
+    db = client["CrowdTracking"]
+    collection = db["Crowd"]
+    # Counts are buffered and written in batches on a background thread,
+    # so the video loop never waits for MongoDB
+    writer = RecordWriter(collection, setup=create_indexes)
+
 frame_id = 0
 current_date = date.today()
 
 global_frame = None
 global_result = None
-def generate_frames():
+
+# Every processed frame is encoded once and shared by all video feed clients
+stream = MJPEGStream(quality=80)
+processing_thread = None
+processing_lock = threading.Lock()
+
+def process_frames():
     global frame_id, current_date, global_frame, global_result
     cap = cv2.VideoCapture(rtsp_url)
     while True:
@@ -63,19 +87,18 @@ def generate_frames():
         data = {
             
             "frame_id": frame_id,
-            "timestamp": now.strftime("%d/%m/%Y %H:%M:%S"),
+            "timestamp": datetime.now(timezone.utc),
             "total_persons": len(boxes)
         }
-        collection.insert_one(data)
+        if writer is not None:
+            writer.add(data)
 
-        # Delete the old data from MongoDB when entering a new day
-        # if the current date is greater than the date of the last frame
-        # then reset the frame_id and delete all the data from the collection
+        # Reset the frame_id when entering a new day
+        # The old data is removed by the TTL index of the collection
         if now.date() > current_date:
             frame_id = 0
             current_date = now.date()
-            collection.delete_many({})
-            print (f"Data will be resetted for new day: {current_date}")
+            print (f"Frame IDs will be resetted for new day: {current_date}")
 
         # Display the number of persons detected on the frame       
         cv2.rectangle(frame, (10, 10), (310, 60), (255, 255, 255), -1)
@@ -87,12 +110,21 @@ def generate_frames():
         global_frame = frame
         global_result = len(boxes)
 
-        # Encode the frame to JPEG format
-        ret, buffer = cv2.imencode('.jpg', frame)
-        frame = buffer.tobytes()
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
-        
+        # Publish the frame, it is encoded to JPEG once when a client requests it
+        stream.publish(frame)
+
+def start_processing():
+    # Run a single processing loop no matter how many clients are connected
+    global processing_thread
+    with processing_lock:
+        if processing_thread is None:
+            processing_thread = threading.Thread(target=process_frames, daemon=True)
+            processing_thread.start()
+
+def generate_frames():
+    start_processing()
+    return stream.subscribe()
+
 # Route the display the video feed
 # The video feed will be displayed on the web browser
 @app.route('/video_feed')
@@ -102,6 +134,6 @@ def video_feed():
 
 
 if __name__ == '__main__':
-    threading.Thread(target=generate_frames, daemon=True).start()
+    start_processing()
     app.run(port=8000) #nosec
 
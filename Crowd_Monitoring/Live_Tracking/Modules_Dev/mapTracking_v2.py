@@ -1,7 +1,7 @@
 import cv2
 import numpy as np
 from ultralytics import YOLO
-from collections import defaultdict
+from trackStore import TrackStore
 from utils import calculateHomography, transformPoints
 from pymongo import MongoClient
 import time as time_module
@@ -21,7 +21,8 @@ lastRecorded = time_module.time()
 rtspUrl = 1
 cap = cv2.VideoCapture(rtspUrl)
 
-trackHistory = defaultdict(list)
+# Keep the last 50 points per track and forget tracks not seen for 10 seconds
+trackHistory = TrackStore(capacity=50, maxTracks=1000, ttl=10.0)
 
 # Load the floor image
 from floorReplica import floorReplica
@@ -82,22 +83,19 @@ while True:
                     annotatedFrame = floorImage.copy()
 
                     for trackID in np.unique(trackIDs):
-                        history = trackHistory[trackID]
-                        if len(history) > 1:
-                            points = np.array(history, dtype=np.int32)
+                        points = trackHistory.get(int(trackID))
+                        if len(points) > 1:
                             newPoints = transformPoints(points, homographyMatrix)
                             newPoints = newPoints.astype(np.int32)
 
                             cv2.polylines(annotatedFrame, [newPoints], isClosed=False, color=(0, 0, 255), thickness=2)
 
+                    currentTime = time_module.time()
                     for box, trackID in zip(boxes, trackIDs):
                         x, y, w, h = box
                         center = (int(x), int(y + h / 2))
-                        trackHistory[trackID].append(center)
-
-                        if len(trackHistory[trackID]) > 50:
-                            trackHistory[trackID].pop(0)
-                    currentTime = time_module.time()
+                        trackHistory.append(int(trackID), center, currentTime)
+                    trackHistory.evictStale(currentTime)
                     print(currentTime)
                     # Record the number of people in the frame every second
                     if currentTime - lastRecorded > 1:
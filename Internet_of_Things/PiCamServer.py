@@ -2,10 +2,23 @@ from flask import Flask, Response, render_template
 from picamera2 import Picamera2
 import numpy as np
 import cv2
+import logging
 import time
+import threading
+from mjpegStream import MJPEGStream
 
 app = Flask(__name__)
 
+# Every captured frame is encoded once and shared by all video feed clients
+stream = MJPEGStream(quality=80)
+capture_thread = None
+capture_lock = threading.Lock()
+logger = logging.getLogger(__name__)
+
+# The camera is stopped once no client has used the stream for this many seconds
+IDLE_TIMEOUT = 5.0
+last_client_time = 0.0
+
 def init_camera():
     """Attempt to initialize the camera.
     
@@ -30,24 +43,66 @@ def get_video_config(picam2):
     """
     return picam2.create_video_configuration(main={"format": "XRGB8888", "size": (640, 480)})
 
-def generate_frames(picam2):
-    """Generator function to capture video frames.
+def capture_idle():
+    """Check whether the capture thread should stop.
+    
+    Returns True and clears the capture thread once no client has been subscribed to the stream
+    or requested it for IDLE_TIMEOUT seconds, so the next client starts a new capture thread.
+    """
+    global capture_thread, last_client_time
+    with capture_lock:
+        if stream.subscriberCount() > 0:
+            last_client_time = time.time()
+            return False
+        if time.time() - last_client_time <= IDLE_TIMEOUT:
+            return False
+        capture_thread = None
+        return True
+
+def capture_frames():
+    """Capture loop publishing camera frames to the shared stream.
     
-    Configures the camera with the given settings, starts the camera, and then continuously
-    captures frames, encoding them to JPEG format before yielding them one by one.
-    Stops the camera when the function exits.
+    Initializes and configures the camera, starts it, and then continuously captures frames and
+    publishes them to the MJPEG stream, which encodes each frame to JPEG only once regardless of
+    the number of clients. A failing capture is logged and the camera is restarted for the waiting
+    clients. The loop ends once the stream is idle, and the camera is stopped and released whenever
+    it is left.
     """
-    picam2.configure(get_video_config(picam2))
-    picam2.start()
+    global capture_thread
     try:
-        while True:
-            frame = picam2.capture_array()  # Capture frame as an array
-            frame = cv2.cvtColor(np.array(frame), cv2.COLOR_RGB2BGR)  # Convert RGB to BGR
-            ret, buffer = cv2.imencode('.jpg', frame)  # Encode frame to JPEG format
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n')
+        while not capture_idle():
+            picam2 = init_camera()  # Initialize the camera
+            try:
+                picam2.configure(get_video_config(picam2))
+                picam2.start()
+                while not capture_idle():
+                    frame = picam2.capture_array()  # Capture frame as an array
+                    frame = cv2.cvtColor(np.array(frame), cv2.COLOR_RGB2BGR)  # Convert RGB to BGR
+                    stream.publish(frame)
+            except Exception:
+                logger.exception("Camera capture failed, restarting the camera")
+                time.sleep(2)  # Delay before retrying to avoid rapid failure messages
+            finally:
+                picam2.stop()  # Ensure camera is stopped to release the resource
+                picam2.close()
     finally:
-        picam2.stop()  # Ensure camera is stopped to release the resource
+        # Also clear the thread if the loop ended unexpectedly, so the next client restarts it
+        with capture_lock:
+            if capture_thread is threading.current_thread():
+                capture_thread = None
+
+def start_capture():
+    """Start the capture thread unless it is running.
+    
+    The camera can only be opened by one owner, so a single background thread captures
+    the frames and every client subscribes to the shared stream.
+    """
+    global capture_thread, last_client_time
+    with capture_lock:
+        last_client_time = time.time()
+        if capture_thread is None or not capture_thread.is_alive():
+            capture_thread = threading.Thread(target=capture_frames, daemon=True)
+            capture_thread.start()
 
 @app.route('/')
 def index():
@@ -61,11 +116,11 @@ def index():
 def video_feed():
     """Video feed route.
     
-    Initializes the camera and returns the response generated by the frame generator
-    to stream video. The response's MIME type is set for multipart replacements.
+    Starts the shared capture thread if needed and returns a response that streams the
+    newest encoded frame to this client. The response's MIME type is set for multipart replacements.
     """
-    picam2 = init_camera()  # Initialize the camera
-    return Response(generate_frames(picam2), mimetype='multipart/x-mixed-replace; boundary=frame')
+    start_capture()
+    return Response(stream.subscribe(), mimetype='multipart/x-mixed-replace; boundary=frame')
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)  # nosec